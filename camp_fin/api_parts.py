@@ -1,8 +1,22 @@
 import csv
-from io import StringIO, BytesIO
+import json
+import base64
+import binascii
+import time
+import zlib
+import struct
+from io import StringIO
+from collections import OrderedDict
 import zipfile
 
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.core.exceptions import ValidationError
+
 from rest_framework import serializers, pagination, renderers
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 from rest_framework_csv.renderers import CSVStreamingRenderer
 
 from camp_fin.models import Candidate, PAC, Transaction, LoanTransaction, \
@@ -251,49 +265,402 @@ class DataTablesPagination(pagination.LimitOffsetPagination):
     limit_query_param = 'length'
     offset_query_param = 'start'
 
+def encode_cursor(position):
+    '''
+    Turn a keyset position into an opaque token for the `cursor` parameter.
+    '''
+    # Keep every digit of timestamps, or rows that share one get skipped
+    position = json.dumps(position, default=lambda value: value.isoformat())
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        assert isinstance(position, dict)
+        return position
+    except (AssertionError, UnicodeError, binascii.Error, ValueError):
+        raise NotFound('Invalid cursor')
+
+def keyset_direction(descending, reverse):
+    '''
+    The comparison and sort order that find the rows after a position (or
+    before it, if `reverse`) when paging by a key in the given direction.
+    '''
+    if descending != reverse:
+        return '<', 'DESC'
+    else:
+        return '>', 'ASC'
+
+def wants_cursor(request):
+    '''
+    Cursor pagination is opt-in. Ask for the first page with
+    `?pagination=cursor` and follow the cursors in the response from there.
+    '''
+    return 'cursor' in request.query_params or \
+        request.query_params.get('pagination') == 'cursor'
+
+class KeysetPagination(pagination.LimitOffsetPagination):
+    '''
+    Limit/offset pagination that can also page by a cursor. A cursor is a
+    position in an ordering on one of the view's `cursor_fields` plus the ID,
+    so deep pages cost as much as the first one. Offsets keep working for
+    anyone who doesn't ask for a cursor.
+    '''
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = wants_cursor(request) and isinstance(queryset, QuerySet)
+
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view=view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+
+        fields = getattr(view, 'cursor_fields', ('received_date', 'amount'))
+
+        token = request.query_params.get(self.cursor_query_param)
+
+        if token:
+            position = decode_cursor(token)
+            self.ordering = position.get('ordering', '')
+        else:
+            position = None
+            self.ordering = request.query_params.get('ordering', '')
+
+            if self.ordering.lstrip('-') not in fields:
+                self.ordering = '-' + fields[0]
+
+        field = self.ordering.lstrip('-')
+
+        if field not in fields:
+            raise NotFound('Invalid cursor')
+
+        descending = self.ordering.startswith('-')
+        reverse = bool(position and position.get('reverse'))
+
+        comparison, order = keyset_direction(descending, reverse)
+
+        if position:
+            model_field = queryset.model._meta.get_field(field)
+            qn = connection.ops.quote_name
+
+            try:
+                value = model_field.to_python(position['value'])
+                pk = int(position['id'])
+            except (KeyError, TypeError, ValueError, ValidationError):
+                raise NotFound('Invalid cursor')
+
+            where = '({0}.{1}, {0}.{2}) {3} (%s, %s)'.format(qn(queryset.model._meta.db_table),
+                                                            qn(model_field.column),
+                                                            qn('id'),
+                                                            comparison)
+
+            queryset = queryset.extra(where=[where], params=[value, pk])
+
+        prefix = '-' if order == 'DESC' else ''
+        rows = list(queryset.order_by(prefix + field, prefix + 'id')[:self.limit + 1])
+
+        more = len(rows) > self.limit
+        rows = rows[:self.limit]
+
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, more
+        else:
+            self.has_next, self.has_previous = more, position is not None
+
+        self.field = field
+        self.rows = rows
+
+        return rows
+
+    def position(self, row, reverse=False):
+        return encode_cursor({
+            'ordering': self.ordering,
+            'value': getattr(row, self.field),
+            'id': row.id,
+            'reverse': reverse,
+        })
+
+    def cursor_link(self, token):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, token)
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+
+        if not (self.has_next and self.rows):
+            return None
+
+        return self.cursor_link(self.position(self.rows[-1]))
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+
+        if not (self.has_previous and self.rows):
+            return None
+
+        return self.cursor_link(self.position(self.rows[0], reverse=True))
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+
+        # Counting is what makes deep pages slow, so cursor pages skip it
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
 class TransactionCSVRenderer(CSVStreamingRenderer):
 
     def render(self, data, *args, **kwargs):
         return super().render(data['results'], *args, **kwargs)
 
+# Sizes and offsets from here on up go in zip64 records, with this in their
+# usual place
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_VERSION = 45
+
+# General purpose flag for a CRC and sizes that follow the member's data
+DATA_DESCRIPTOR = 0x08
+
+class ZipStream(object):
+    '''
+    Write a zip archive in pieces that can be sent off as soon as they're
+    collected, without ever seeking back. Members are deflated as they're
+    written and followed by a data descriptor with their CRC and sizes.
+    ZipFile can only write a member a piece at a time from Python 3.6 on.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+        self.members = []
+
+    def emit(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def start_member(self, name):
+        now = time.localtime()
+
+        self.name = name.encode('utf-8')
+        self.dos_time = now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2
+        self.dos_date = (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+        self.header_offset = self.offset
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED,
+                                           -zlib.MAX_WBITS)
+
+        # The sizes aren't known yet, so leave room for big ones
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+
+        self.emit(struct.pack('<4s2B4HL2L2H',
+                              b'PK\x03\x04',
+                              ZIP64_VERSION,
+                              0,
+                              DATA_DESCRIPTOR,
+                              zipfile.ZIP_DEFLATED,
+                              self.dos_time,
+                              self.dos_date,
+                              0,
+                              ZIP64_LIMIT,
+                              ZIP64_LIMIT,
+                              len(self.name),
+                              len(extra)))
+        self.emit(self.name)
+        self.emit(extra)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+
+        compressed = self.compressor.compress(data)
+        self.compress_size += len(compressed)
+        self.emit(compressed)
+
+    def end_member(self):
+        compressed = self.compressor.flush()
+        self.compress_size += len(compressed)
+        self.emit(compressed)
+
+        self.emit(struct.pack('<4sLQQ',
+                              b'PK\x07\x08',
+                              self.crc,
+                              self.compress_size,
+                              self.file_size))
+
+        self.members.append((self.name,
+                             self.dos_time,
+                             self.dos_date,
+                             self.crc,
+                             self.compress_size,
+                             self.file_size,
+                             self.header_offset))
+
+    def finish(self):
+        '''
+        Write the central directory that lists every member.
+        '''
+        start = self.offset
+
+        for name, dos_time, dos_date, crc, compress_size, file_size, header_offset in self.members:
+            # Anything too big for the directory entry goes in a zip64
+            # extra field instead, in this order
+            zip64 = []
+
+            if file_size >= ZIP64_LIMIT:
+                zip64.append(file_size)
+                file_size = ZIP64_LIMIT
+
+            if compress_size >= ZIP64_LIMIT:
+                zip64.append(compress_size)
+                compress_size = ZIP64_LIMIT
+
+            if header_offset >= ZIP64_LIMIT:
+                zip64.append(header_offset)
+                header_offset = ZIP64_LIMIT
+
+            extra = b''
+
+            if zip64:
+                extra = struct.pack('<HH{}Q'.format(len(zip64)), 1, 8 * len(zip64), *zip64)
+
+            self.emit(struct.pack('<4s4B4HL2L5H2L',
+                                  b'PK\x01\x02',
+                                  ZIP64_VERSION,
+                                  3,
+                                  ZIP64_VERSION,
+                                  0,
+                                  DATA_DESCRIPTOR,
+                                  zipfile.ZIP_DEFLATED,
+                                  dos_time,
+                                  dos_date,
+                                  crc,
+                                  compress_size,
+                                  file_size,
+                                  len(name),
+                                  len(extra),
+                                  0,
+                                  0,
+                                  0,
+                                  0o644 << 16,
+                                  header_offset))
+            self.emit(name)
+            self.emit(extra)
+
+        size = self.offset - start
+        count = len(self.members)
+
+        if count >= 0xFFFF or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            end = self.offset
+
+            self.emit(struct.pack('<4sQ2H2L4Q',
+                                  b'PK\x06\x06',
+                                  44,
+                                  ZIP64_VERSION,
+                                  ZIP64_VERSION,
+                                  0,
+                                  0,
+                                  count,
+                                  count,
+                                  size,
+                                  start))
+            self.emit(struct.pack('<4sLQL', b'PK\x06\x07', 0, end, 1))
+
+            count = min(count, 0xFFFF)
+            size = min(size, ZIP64_LIMIT)
+            start = min(start, ZIP64_LIMIT)
+
+        self.emit(struct.pack('<4s4H2LH',
+                              b'PK\x05\x06',
+                              0,
+                              0,
+                              count,
+                              count,
+                              size,
+                              start,
+                              0))
+
+    def collect(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
 class SearchCSVRenderer(renderers.BaseRenderer):
     media_type = 'application/zip'
     format = 'csv'
 
+    table_names = [
+        'candidate',
+        'pac',
+        'contribution',
+        'expenditure',
+        'treasurer',
+        'lobbyisttransaction'
+    ]
+
     def render(self, data, media_type=None, renderer_context=None):
-        table_names = [
-            'candidate',
-            'pac',
-            'contribution',
-            'expenditure',
-            'treasurer',
-            'lobbyisttransaction'
-        ]
+        tables = []
+
+        for table in self.table_names:
+
+            if data.get(table) and data[table]['objects']:
+                objects = data[table]['objects']
+                tables.append((table, [objects[0]._fields] + list(objects)))
 
-        zfoutp = BytesIO()
+        return b''.join(self.stream(tables))
 
-        with zipfile.ZipFile(zfoutp, 'w') as zf:
+    def stream(self, tables, batch_size=2000):
+        '''
+        Write a zip with a CSV for each table, yielding the archive as it
+        grows. `tables` is a sequence of table names and rows, where the first
+        row is the header. Rows are only pulled as they're written, so they
+        can come straight off of a database cursor. Tables without any rows
+        are left out.
+        '''
+        output = ZipStream()
 
-            for table in table_names:
+        for table, rows in tables:
+            rows = iter(rows)
 
-                if data.get(table):
+            header = next(rows, None)
+            first_row = next(rows, None)
 
-                    try:
-                        first_record = data[table]['objects'][0]
-                    except IndexError:
-                        continue
+            if first_row is None:
+                continue
 
-                    outp = StringIO()
+            output.start_member('{}.csv'.format(table))
 
-                    fieldnames = first_record._fields
-                    writer = csv.writer(outp)
+            outp = StringIO()
+            writer = csv.writer(outp)
 
-                    writer.writerow(fieldnames)
-                    writer.writerows(data[table]['objects'])
+            writer.writerow(header)
+            writer.writerow(first_row)
 
+            for count, row in enumerate(rows, start=2):
+                writer.writerow(row)
+
+                if count % batch_size == 0:
+                    output.write(outp.getvalue().encode('utf-8'))
                     outp.seek(0)
-                    zf.writestr('{}.csv'.format(table), outp.getvalue())
+                    outp.truncate()
+
+                    yield output.collect()
+
+            output.write(outp.getvalue().encode('utf-8'))
+            output.end_member()
+
+            yield output.collect()
 
-        zfoutp.seek(0)
+        output.finish()
 
-        return zfoutp.getvalue()
+        yield output.collect()
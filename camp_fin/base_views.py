@@ -15,7 +15,7 @@ from rest_framework.response import Response
 from camp_fin.models import Transaction, Candidate, PAC, Entity, Lobbyist, Organization
 from camp_fin.api_parts import (TransactionSerializer, TopMoneySerializer,
                                 SearchCSVRenderer, DataTablesPagination,
-                                TransactionCSVRenderer)
+                                TransactionCSVRenderer, KeysetPagination)
 
 from pages.models import Page
 
@@ -350,8 +350,12 @@ class TransactionBaseViewSet(viewsets.ModelViewSet):
     default_filter = {}
     queryset = Transaction.objects.filter(filing__date_added__gte=TWENTY_TEN)
     filter_backends = (filters.OrderingFilter,)
+    pagination_class = KeysetPagination
     
     ordering_fields = ('last_name', 'amount', 'received_date', 'description')
+
+    # Fields that ?pagination=cursor can page by, the first one by default
+    cursor_fields = ('received_date', 'amount')
     
     allowed_methods = ['GET']
 
@@ -385,7 +389,7 @@ class TransactionBaseViewSet(viewsets.ModelViewSet):
             elif entity.pac_set.first():
                 self.entity_name = entity.pac_set.first().name
 
-        return queryset.order_by('-received_date')
+        return queryset.order_by('-' + self.cursor_fields[0], '-id')
     
 
 class TopMoneyView(viewsets.ViewSet):
@@ -0,0 +1,291 @@
+import os
+import csv
+import time
+import random
+import shutil
+import tempfile
+from datetime import date, timedelta
+
+from openpyxl import Workbook, load_workbook
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import transaction, connection
+
+from .import_data import FILE_LOOKUP, MAPPER_LOOKUP, IterStream, \
+    xlsx_rows, csv_chunks, Command as ImportCommand
+
+BENCHMARKS = ['xlsx', 'transaction']
+
+
+def legacy_convert_xlsx(file_path, raw_pk_col, csv_path):
+    '''
+    The XLSX conversion that import_data used to do, kept around so that we
+    have something to compare the streaming version to.
+    '''
+    wb = load_workbook(file_path, read_only=True)
+    sheets = wb.worksheets
+    saved_pks = []
+
+    header_row = next(sheets[0].rows)
+    header = [r.value for r in header_row]
+
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+
+        for sheet in sheets:
+            rows = sheet.rows
+            next(rows)  # Strip header row
+            for row in rows:
+                row_values = [r.value for r in row]
+                header_lower = [v.lower() for v in header]
+
+                row_dict = dict(zip(header_lower, row_values))
+                row_pk = row_dict[raw_pk_col]
+
+                if row_pk not in saved_pks:
+                    writer.writerow(row_values)
+                    saved_pks.append(row_pk)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark parts of the import_data pipeline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'benchmarks',
+            nargs='*',
+            help='Which benchmarks to run ({}). Defaults to all of them'.format(', '.join(BENCHMARKS))
+        )
+
+        parser.add_argument(
+            '--rows',
+            dest='rows',
+            type=int,
+            default=1000000,
+            help='Number of rows in the synthetic XLSX sheet and transaction file'
+        )
+
+        parser.add_argument(
+            '--legacy-max-rows',
+            dest='legacy_max_rows',
+            type=int,
+            default=50000,
+            help='Skip the legacy XLSX conversion on synthetic sheets larger than this'
+        )
+
+    def handle(self, *args, **options):
+        benchmarks = options['benchmarks'] or BENCHMARKS
+
+        for benchmark in benchmarks:
+            if benchmark not in BENCHMARKS:
+                raise CommandError('"{}" is not a valid benchmark'.format(benchmark))
+
+        self.tmp_dir = tempfile.mkdtemp()
+
+        try:
+            if 'xlsx' in benchmarks:
+                self.benchmarkXLSX(options['rows'], options['legacy_max_rows'])
+
+            if 'transaction' in benchmarks:
+                self.benchmarkTransactions(options['rows'])
+        finally:
+            shutil.rmtree(self.tmp_dir)
+
+    def benchmarkXLSX(self, synthetic_rows, legacy_max_rows):
+        self.stdout.write(self.style.SUCCESS('XLSX to COPY'))
+        self.stdout.write('{0:<40} {1:>10} {2:>10} {3:>10} {4:>8}'.format('file',
+                                                                         'rows',
+                                                                         'legacy',
+                                                                         'stream',
+                                                                         'speedup'))
+
+        for entity_type, file_name in sorted(FILE_LOOKUP.items(), key=lambda x: x[1]):
+            if file_name.endswith('xlsx'):
+                file_path = os.path.join('data', file_name)
+                raw_pk_col = [k for k, v in MAPPER_LOOKUP[entity_type].items() \
+                                  if v['field'] == 'id'][0]
+
+                self.compareXLSX(file_path, raw_pk_col)
+
+        self.stdout.write('Writing a synthetic sheet with {} rows'.format(synthetic_rows))
+
+        file_path = self.makeSyntheticSheet(synthetic_rows)
+
+        self.compareXLSX(file_path,
+                         'id',
+                         run_legacy=synthetic_rows <= legacy_max_rows)
+
+    def compareXLSX(self, file_path, raw_pk_col, run_legacy=True):
+        wb = load_workbook(file_path, read_only=True)
+        columns = len(next(wb.worksheets[0].iter_rows(values_only=True)))
+        wb.close()
+
+        legacy_time = None
+
+        if run_legacy:
+            csv_path = os.path.join(self.tmp_dir, 'legacy.csv')
+
+            start = time.time()
+
+            legacy_convert_xlsx(file_path, raw_pk_col, csv_path)
+
+            with open(csv_path, 'r') as f:
+                self.copyToTempTable(f, columns)
+
+            legacy_time = time.time() - start
+
+        start = time.time()
+
+        rows = xlsx_rows(file_path, raw_pk_col)
+        count = self.copyToTempTable(IterStream(csv_chunks(rows)), columns)
+
+        stream_time = time.time() - start
+
+        if legacy_time is None:
+            legacy, speedup = 'skipped', '-'
+        else:
+            legacy = '{:.2f}s'.format(legacy_time)
+            speedup = '{:.1f}x'.format(legacy_time / stream_time)
+
+        self.stdout.write('{0:<40} {1:>10} {2:>10} {3:>10} {4:>8}'.format(os.path.basename(file_path),
+                                                                         count,
+                                                                         legacy,
+                                                                         '{:.2f}s'.format(stream_time),
+                                                                         speedup))
+
+    def copyToTempTable(self, f, columns):
+        '''
+        COPY a CSV file into a throwaway table and return the number of rows.
+        '''
+        fields = ', '.join(['col_{} VARCHAR'.format(i) for i in range(columns)])
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('CREATE TEMP TABLE benchmark_xlsx ({}) ON COMMIT DROP'.format(fields))
+                cursor.copy_expert('COPY benchmark_xlsx FROM STDIN WITH CSV HEADER', f)
+                cursor.execute('SELECT COUNT(*) FROM benchmark_xlsx')
+                count = cursor.fetchone()[0]
+
+        return count
+
+    def makeSyntheticSheet(self, rows):
+        '''
+        Write an XLSX file that looks roughly like one of the NMID exports,
+        with a sprinkling of duplicate primary keys.
+        '''
+        random.seed(0)
+
+        wb = Workbook(write_only=True)
+        sheet = wb.create_sheet()
+
+        sheet.append(['Id', 'Name', 'Amount', 'Date'])
+
+        start = date(2010, 1, 1)
+
+        for i in range(rows):
+            pk = i if random.random() > 0.01 else random.randint(0, max(i, 1))
+
+            sheet.append([pk,
+                          'Name {}'.format(pk),
+                          round(random.random() * 1000, 2),
+                          start + timedelta(days=i % 3000)])
+
+        file_path = os.path.join(self.tmp_dir, 'synthetic.xlsx')
+        wb.save(file_path)
+
+        return file_path
+
+    def benchmarkTransactions(self, synthetic_rows):
+        '''
+        Load the transaction file into raw_transaction the way import_data
+        used to (a logged table with its primary key declared up front) and
+        the way it does now (unlogged, keyed and analyzed after COPY).
+        '''
+        importer = ImportCommand(stdout=self.stdout, stderr=self.stderr)
+        importer.configure({'force': True, 'shadow': False, 'tolerant': False})
+        importer.connect()
+
+        importer.entity_type = 'transaction'
+        importer.encoding = 'utf-8'
+        importer.table_mapper = MAPPER_LOOKUP['transaction']
+        importer.raw_pk_col = [k for k, v in importer.table_mapper.items() \
+                                   if v['field'] == 'id'][0]
+
+        file_name = FILE_LOOKUP['transaction']
+        importer.file_path = os.path.join(settings.FTP_DIRECTORY, file_name)
+
+        if not os.path.exists(importer.file_path):
+            importer.file_path = os.path.join('data', file_name)
+
+        if not os.path.exists(importer.file_path):
+            self.stdout.write('{0} not found, writing a synthetic one with {1} rows'.format(file_name, synthetic_rows))
+            importer.file_path = self.makeSyntheticTransactions(importer, synthetic_rows)
+
+        self.stdout.write(self.style.SUCCESS('Raw transaction load'))
+        self.stdout.write('{0:<40} {1:>10} {2:>10} {3:>12}'.format('approach',
+                                                                   'rows',
+                                                                   'time',
+                                                                   'rows/s'))
+
+        try:
+            start = time.time()
+
+            importer.makeRawTable()
+            importer.executeTransaction('DROP TABLE raw_transaction')
+            importer.executeTransaction('''
+                CREATE TABLE raw_transaction (
+                    {0} BIGINT,
+                    {1},
+                    PRIMARY KEY ({0})
+                )
+            '''.format(importer.raw_pk_col,
+                       ', '.join(['"{}" VARCHAR'.format(c) for c in importer.raw_columns \
+                                      if c != importer.raw_pk_col])))
+
+            count = importer.importRawData()
+
+            self.reportLoad('logged, key during COPY', count, time.time() - start)
+
+            start = time.time()
+
+            importer.makeRawTable()
+            count = importer.importRawData()
+            importer.indexRawTable()
+
+            self.reportLoad('unlogged, key and ANALYZE after COPY', count, time.time() - start)
+
+        finally:
+            importer.executeTransaction('DROP TABLE IF EXISTS raw_transaction')
+            importer.connection.close()
+
+    def reportLoad(self, approach, count, elapsed):
+        self.stdout.write('{0:<40} {1:>10} {2:>10} {3:>12}'.format(approach,
+                                                                   count,
+                                                                   '{:.2f}s'.format(elapsed),
+                                                                   '{:.0f}'.format(count / elapsed)))
+
+    def makeSyntheticTransactions(self, importer, rows):
+        '''
+        Write a CSV file with the same columns as the transaction export.
+        The raw table is all VARCHAR apart from the key, so the values only
+        need to be roughly the right size.
+        '''
+        random.seed(0)
+
+        header = [k for k, v in importer.table_mapper.items() \
+                      if not v.get('expression')]
+
+        file_path = os.path.join(self.tmp_dir, 'synthetic_transactions.csv')
+
+        with open(file_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+
+            for i in range(rows):
+                writer.writerow([i if col == importer.raw_pk_col \
+                                     else '{:.2f}'.format(random.random() * 1000) \
+                                     for col in header])
+
+        return file_path
@@ -0,0 +1,197 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.conf import settings
+from django.db import transaction, connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from camp_fin.models import Race, Campaign, Candidate, Entity, Office, \
+    OfficeType, ElectionSeason, Status, PoliticalParty
+
+ORDERINGS = ['num_candidates', 'total_funds']
+
+
+class Rollback(Exception):
+    pass
+
+
+def python_ordered_page(queryset, order_by, per_page):
+    '''
+    The way RacesView used to sort races on properties: load every race for
+    the year and sort them in Python before slicing out the first page.
+    '''
+    races = sorted(queryset,
+                   key=lambda race: getattr(race, order_by),
+                   reverse=True)
+
+    return races[:per_page]
+
+
+def sql_ordered_page(queryset, order_by, per_page):
+    '''
+    The way RacesView sorts races now, with the ordering and the page both
+    handled by Postgres.
+    '''
+    columns = {'num_candidates': 'candidate_count',
+               'total_funds': 'funds_total'}
+
+    queryset = Race.with_totals(queryset).order_by('-' + columns[order_by], '-id')
+
+    return list(queryset[:per_page])
+
+
+class Command(BaseCommand):
+    help = 'Compare sorting races on candidate counts and funds in Python and in SQL'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--year',
+            dest='year',
+            default=settings.ELECTION_YEAR,
+            help='Election year to sort races for'
+        )
+
+        parser.add_argument(
+            '--races',
+            dest='races',
+            type=int,
+            default=500,
+            help='Add synthetic races (rolled back afterwards) until the year has at least this many'
+        )
+
+        parser.add_argument(
+            '--candidates',
+            dest='candidates',
+            type=int,
+            default=4,
+            help='Number of candidates in each synthetic race'
+        )
+
+        parser.add_argument(
+            '--per-page',
+            dest='per_page',
+            type=int,
+            default=25,
+            help='Size of the page to sort races into'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.makeSyntheticRaces(options['year'],
+                                        options['races'],
+                                        options['candidates'])
+
+                self.benchmarkOrdering(options['year'], options['per_page'])
+
+                raise Rollback
+        except Rollback:
+            pass
+
+    def makeSyntheticRaces(self, year, races, candidates):
+        '''
+        Top up the races for a year with fake ones, so that there's something
+        to sort. Their totals are left empty so that `total_funds` has to fall
+        back to summing contributions, like it does before make_races runs.
+        '''
+        existing = Race.objects.filter(election_season__year=year).count()
+
+        if existing >= races:
+            self.stdout.write('Using {0} races from {1}'.format(existing, year))
+            return
+
+        missing = races - existing
+
+        self.stdout.write('Adding {0} synthetic races to the {1} in {2}'.format(missing,
+                                                                              existing,
+                                                                              year))
+
+        # import_data loads rows with their own IDs, so the sequences
+        # might be behind
+        models = [Status, PoliticalParty, OfficeType, ElectionSeason, Office,
+                  Race, Entity, Candidate, Campaign]
+
+        with connection.cursor() as cursor:
+            for statement in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(statement)
+
+        status = Status.objects.create()
+        party = PoliticalParty.objects.create(name='Benchmark')
+        office_type = OfficeType.objects.create(description='Benchmark')
+
+        season = ElectionSeason.objects.create(year=year,
+                                               special=False,
+                                               status=status)
+
+        offices = Office.objects.bulk_create([
+            Office(description='Benchmark office {}'.format(i),
+                   office_type=office_type,
+                   status=status) for i in range(missing)
+        ])
+
+        race_list = Race.objects.bulk_create([
+            Race(office=office, office_type=office_type, election_season=season) \
+                for office in offices
+        ])
+
+        entities = Entity.objects.bulk_create([
+            Entity() for i in range(missing * candidates)
+        ])
+
+        candidate_list = Candidate.objects.bulk_create([
+            Candidate(first_name='Benchmark', last_name=str(i), entity=entity) \
+                for i, entity in enumerate(entities)
+        ])
+
+        now = timezone.now()
+
+        Campaign.objects.bulk_create([
+            Campaign(candidate=candidate,
+                     active_race=race_list[i // candidates],
+                     election_season=season,
+                     office=race_list[i // candidates].office,
+                     political_party=party,
+                     date_added=now) \
+                for i, candidate in enumerate(candidate_list)
+        ])
+
+    def benchmarkOrdering(self, year, per_page):
+        queryset = Race.objects.filter(election_season__year=year)\
+                               .prefetch_related('campaign_set')\
+                               .prefetch_related('campaign_set__candidate')
+
+        races = queryset.count()
+
+        if not races:
+            raise CommandError('No races found for {}'.format(year))
+
+        self.stdout.write(self.style.SUCCESS('First page of {0} races in {1}'.format(races, year)))
+        self.stdout.write('{0:<16} {1:<8} {2:>10} {3:>10}'.format('order_by',
+                                                                  'sort',
+                                                                  'queries',
+                                                                  'time'))
+
+        for order_by in ORDERINGS:
+            python_page = self.timePage(order_by, 'python', python_ordered_page, queryset, per_page)
+            sql_page = self.timePage(order_by, 'sql', sql_ordered_page, queryset, per_page)
+
+            python_values = [getattr(race, order_by) for race in python_page]
+            sql_values = [getattr(race, order_by) for race in sql_page]
+
+            if python_values != sql_values:
+                self.stderr.write(self.style.ERROR('Orderings on {} differ'.format(order_by)))
+
+    def timePage(self, order_by, label, ordered_page, queryset, per_page):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            page = ordered_page(queryset.all(), order_by, per_page)
+            elapsed = time.time() - start
+
+        self.stdout.write('{0:<16} {1:<8} {2:>10} {3:>10}'.format(order_by,
+                                                                  label,
+                                                                  len(queries),
+                                                                  '{:.3f}s'.format(elapsed)))
+
+        return page
@@ -1,7 +1,16 @@
+import io
 import os
+import re
 import csv
+import gzip
+import time
+import hashlib
 import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    wait, as_completed, FIRST_COMPLETED
 
 import sqlalchemy as sa
 
@@ -13,8 +22,15 @@ import pytz
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import connections
 from django.utils.text import slugify
 
+from camp_fin.models import Entity
+from camp_fin.search import SEARCH_SOURCES, SEARCH_DEPENDENCIES, \
+    insert_search_documents
+
 from .table_mappers import *
 
 DB_CONN = 'postgresql://{USER}:{PASSWORD}@{HOST}:{PORT}/{NAME}'
@@ -23,6 +39,92 @@ engine = sa.create_engine(DB_CONN.format(**settings.DATABASES['default']),
                           convert_unicode=True,
                           server_side_cursors=True)
 
+# Shadow imports build the next version of the data in a separate schema and
+# then swap it in. Anything that isn't in the shadow schema gets read out of
+# the public one.
+SHADOW_SCHEMA = 'etl_shadow'
+RETIRED_SCHEMA = 'etl_retired'
+SHADOW_OPTIONS = '-c search_path={},public'.format(SHADOW_SCHEMA)
+
+shadow_engine = sa.create_engine(DB_CONN.format(**settings.DATABASES['default']),
+                                 convert_unicode=True,
+                                 server_side_cursors=True,
+                                 connect_args={'options': SHADOW_OPTIONS})
+
+# Scratch tables that the import leaves behind. These don't get swapped into
+# the public schema at the end of a shadow import.
+WORK_TABLE_PREFIXES = ('raw_', 'new_', 'change_', 'stage_', 'dirty_', 'quarantine_')
+
+AGGREGATE_INTERVALS = ['day', 'week', 'month']
+
+# Rollups that get brought up to date at the end of an import. The
+# contributions_by_* and expenditures_by_* tables are updated incrementally,
+# current_loan_status is a materialized view.
+AGGREGATES = ['{0}_by_{1}'.format(kind, interval) \
+                  for interval in AGGREGATE_INTERVALS \
+                  for kind in ['contributions', 'expenditures']]
+
+ROLLUPS = AGGREGATES + ['current_loan_status']
+
+# Tables that feed the contributions_by_* and expenditures_by_* aggregates,
+# along with the date that decides which bucket their rows end up in
+AGGREGATE_SOURCES = {
+    'transaction': 'received_date',
+    'loan': 'received_date',
+    'loantransaction': 'transaction_date',
+}
+
+# Rows from the aggregate sources that a change to each entity type can move
+# between (entity, bucket) groups, as (source, column that matches the ids in
+# the change set). Filings decide which entity rows belong to, and the
+# transaction types and filing periods decide whether rows count at all.
+AGGREGATE_DEPENDENCIES = {
+    'transaction': [('transaction', 'dat.id')],
+    'loan': [('loan', 'dat.id')],
+    'loantransaction': [('loantransaction', 'dat.id')],
+    'filing': [
+        ('transaction', 'f.id'),
+        ('loan', 'f.id'),
+        ('loantransaction', 'f.id'),
+    ],
+    'filingperiod': [
+        ('transaction', 'f.filing_period_id'),
+        ('loantransaction', 'f.filing_period_id'),
+    ],
+    'transactiontype': [('transaction', 'dat.transaction_type_id')],
+    'loantransactiontype': [('loantransaction', 'dat.transaction_type_id')],
+}
+
+# Shapes of raw values that are sure to survive a cast to each of the types
+# in the table mappers, so that checking them before an import doesn't mean
+# trying the cast on every value. The digit and day limits keep anything out
+# of range from matching. Values that don't match still get the cast tried on
+# them, since they could be odd but valid.
+INTEGER_PATTERN = r'^\s*[+-]?\d{1,9}\s*$'
+
+MONTH_DAY_PATTERN = (r'((0?[1-9]|1\d|2[0-8])-(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)'
+                     r'|(29|30)-(jan|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)'
+                     r'|31-(jan|mar|may|jul|aug|oct|dec))-(\d{2}|[1-9]\d{3})')
+
+ISO_DATE_PATTERN = r'[1-9]\d{3}-(0[1-9]|1[0-2])-(0[1-9]|1\d|2[0-8])'
+
+TIME_PATTERN = r'([ T]([01]\d|2[0-3]):[0-5]\d(:[0-5]\d(\.\d{1,6})?)?)?'
+
+MONEY_PATTERN = r'\$?\s*(\d{1,3}(,\d{3}){0,4}|\d{1,15})(\.\d{0,2})?'
+
+CAST_PATTERNS = {
+    'bigint': r'^\s*[+-]?\d{1,18}\s*$',
+    'int': INTEGER_PATTERN,
+    'int::boolean': INTEGER_PATTERN,
+    'double precision': r'^\s*[+-]?(\d{1,15}(\.\d{0,15})?|\.\d{1,15})\s*$',
+    'money::numeric::double precision': r'^\s*(-?{0}|\({0}\))\s*$'.format(MONEY_PATTERN),
+    'boolean': r'^\s*(t|true|f|false|y|yes|n|no|on|off|1|0)\s*$',
+    'date': r'^\s*({0}|{1})\s*$'.format(MONTH_DAY_PATTERN, ISO_DATE_PATTERN),
+    'timestamp with time zone': r'^\s*({0}|{1}{2})\s*$'.format(MONTH_DAY_PATTERN,
+                                                               ISO_DATE_PATTERN,
+                                                               TIME_PATTERN),
+}
+
 # Field mappings are defined in `table_mappers.py`
 MAPPER_LOOKUP = {
     'candidate': CANDIDATE,
@@ -106,9 +208,265 @@ FILE_LOOKUP = {
     'lobbyistspecialevent': 'Cam_SpecialEventLobbyist.csv',
 }
 
+# Entity types that must finish importing before the given type can start
+# when running with `--jobs`. Candidates, PACs and filings all populate
+# camp_fin_entity, so they run one after another, and the loan step builds
+# the current_loan_status view out of the loan transactions.
+ETL_DEPENDENCIES = {
+    'candidate': ['entity'],
+    'pac': ['entity', 'candidate'],
+    'filing': ['entity', 'candidate', 'pac'],
+    'loan': ['loantransaction'],
+}
+
+
+def build_etl_graph(entity_types):
+    '''
+    Return a dict mapping each entity type to the set of entity types (among
+    the ones being imported) that it depends upon.
+    '''
+    graph = {}
+
+    for entity_type in entity_types:
+        depends_on = ETL_DEPENDENCIES.get(entity_type, [])
+        graph[entity_type] = {d for d in depends_on \
+                                  if d in entity_types and d in MAPPER_LOOKUP}
+
+    return graph
+
+
+def critical_path(graph, durations):
+    '''
+    Find the longest chain of dependent entity types, weighted by how long
+    each one took to import. Returns a tuple of the chain and its total
+    duration.
+    '''
+    finish = {}
+    previous = {}
+
+    def finish_time(entity_type):
+        if entity_type not in finish:
+            finish[entity_type] = durations[entity_type]
+
+            if graph[entity_type]:
+                slowest = max(graph[entity_type], key=finish_time)
+                finish[entity_type] += finish_time(slowest)
+                previous[entity_type] = slowest
+
+        return finish[entity_type]
+
+    if not durations:
+        return [], 0
+
+    last = max(durations, key=finish_time)
+
+    path = [last]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+
+    return list(reversed(path)), finish[last]
+
+
+def run_refresh_job(rollup, options, rebuild, dirty):
+    '''
+    Refresh a single rollup on its own database connection, so that the
+    rollups can be brought up to date alongside each other.
+    '''
+    command = Command()
+    command.configure(options)
+    command.connect()
+
+    start = time.time()
+
+    try:
+        command.refreshRollup(rollup, rebuild=rebuild, dirty=dirty)
+    finally:
+        command.connection.close()
+
+    return rollup, time.time() - start
+
+
+SourceManifest = namedtuple('SourceManifest',
+                            ['file_name', 'file_size', 'file_mtime', 'checksum'])
+
+
+def run_etl_job(entity_type, options):
+    '''
+    Import a single entity type inside of a worker process. Each worker gets
+    its own database connection.
+    '''
+    command = Command()
+    command.configure(options)
+    command.connect()
+
+    start = time.time()
+
+    try:
+        manifest = command.doETL(entity_type)
+
+        if manifest:
+            command.updateTracker(entity_type, manifest)
+    finally:
+        command.connection.close()
+
+    return entity_type, time.time() - start
+
+
+class ProgressReader(io.RawIOBase):
+    '''
+    Wrap a binary file object, keeping track of how many bytes have been read
+    out of it and calling `callback` with the running total every `interval`
+    bytes.
+    '''
+    def __init__(self, source, callback, interval=64 * 1024 * 1024):
+        self.source = source
+        self.callback = callback
+        self.interval = interval
+
+        self.bytes_read = 0
+        self.next_report = interval
+        self.start = time.time()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self.source.read(len(buf))
+        size = len(data)
+
+        buf[:size] = data
+        self.bytes_read += size
+
+        if self.bytes_read >= self.next_report:
+            self.callback(self.bytes_read, self.elapsed)
+            self.next_report += self.interval
+
+        return size
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+
+class IterStream(io.RawIOBase):
+    '''
+    Read-only file object that pulls its contents out of an iterator of byte
+    strings, so that generated data can be handed straight to COPY.
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        size = len(buf)
+
+        pieces = [self.leftover]
+        length = len(self.leftover)
+
+        while length < size:
+            chunk = next(self.chunks, None)
+
+            if chunk is None:
+                break
+
+            pieces.append(chunk)
+            length += len(chunk)
+
+        data = b''.join(pieces)
+
+        buf[:min(size, length)] = data[:size]
+        self.leftover = data[size:]
+
+        return min(size, length)
+
+
+# Integer primary keys below this get tracked in a bitmap (32MB at most),
+# anything else goes into a set.
+BITMAP_MAX_PK = 2 ** 28
+
+
+def dedupe_rows(rows, pk_index):
+    '''
+    Yield the rows whose primary key hasn't been seen yet.
+    '''
+    bitmap = bytearray()
+    seen = set()
+
+    for row in rows:
+        pk = row[pk_index]
+
+        if isinstance(pk, int) and 0 <= pk < BITMAP_MAX_PK:
+            byte, bit = pk >> 3, 1 << (pk & 7)
+
+            if byte >= len(bitmap):
+                bitmap.extend(bytes(max(byte + 1, 2 * len(bitmap)) - len(bitmap)))
+
+            if bitmap[byte] & bit:
+                continue
+
+            bitmap[byte] |= bit
+
+        else:
+            if pk in seen:
+                continue
+
+            seen.add(pk)
+
+        yield row
+
+
+def xlsx_rows(file_path, pk_col):
+    '''
+    Yield the header and then the unique rows from every sheet in an XLSX
+    file. Each sheet is expected to start with the same header row.
+    '''
+    wb = load_workbook(file_path, read_only=True)
+
+    try:
+        header = next(wb.worksheets[0].iter_rows(values_only=True))
+        yield header
+
+        pk_index = [str(h).lower() for h in header].index(pk_col)
+
+        def sheet_rows():
+            for sheet in wb.worksheets:
+                rows = sheet.iter_rows(values_only=True)
+                next(rows, None)  # Strip header row
+                yield from rows
+
+        yield from dedupe_rows(sheet_rows(), pk_index)
+
+    finally:
+        wb.close()
+
+
+def csv_chunks(rows, chunk_size=64 * 1024):
+    '''
+    Encode rows as UTF-8 CSV, yielding roughly `chunk_size` bytes at a time.
+    '''
+    outp = io.StringIO()
+    writer = csv.writer(outp)
+
+    for row in rows:
+        writer.writerow(row)
+
+        if outp.tell() >= chunk_size:
+            yield outp.getvalue().encode('utf-8')
+            outp.seek(0)
+            outp.truncate()
+
+    yield outp.getvalue().encode('utf-8')
+
+
 class Command(BaseCommand):
     help = 'Import New Mexico Campaign Finance data'
 
+    force = False
+    shadow = False
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--entity-types',
@@ -121,41 +479,478 @@ class Command(BaseCommand):
             '--add-aggregates',
             dest='add_aggregates',
             action='store_true',
-            help='Just add the aggregates'
+            help='Just rebuild the aggregates from scratch'
         )
 
+        parser.add_argument(
+            '--check-aggregates',
+            dest='check_aggregates',
+            action='store_true',
+            help='Compare the aggregate tables against a full rebuild and exit'
+        )
+
+        parser.add_argument(
+            '--refresh-only',
+            dest='refresh_only',
+            help='Comma separated list of rollups to rebuild, skipping the import ({})'.format(', '.join(ROLLUPS))
+        )
+
+        parser.add_argument(
+            '--jobs',
+            dest='jobs',
+            type=int,
+            default=1,
+            help='Number of entity types to import in parallel'
+        )
+
+        parser.add_argument(
+            '--force',
+            dest='force',
+            action='store_true',
+            help='Import files even if they have not changed since the last import'
+        )
+
+        parser.add_argument(
+            '--shadow',
+            dest='shadow',
+            action='store_true',
+            help='Build the import in a separate schema and swap it in at the end'
+        )
+
+        parser.add_argument(
+            '--tolerant',
+            dest='tolerant',
+            action='store_true',
+            help='Set aside rows that fail to load in quarantine tables instead of failing the whole file'
+        )
+
+    def configure(self, options):
+        self.options = options
+        self.force = options['force']
+        self.shadow = options['shadow']
+        self.tolerant = options['tolerant']
+
+    def connect(self):
+        if self.shadow:
+            self.connection = shadow_engine.connect()
+        else:
+            self.connection = engine.connect()
+
     def handle(self, *args, **options):
 
-        self.connection = engine.connect()
+        self.configure(options)
+        self.connect()
+
+        generation = Entity.etl_generation(refresh=True)
 
         if options['add_aggregates']:
-            self.makeTransactionAggregates()
+            self.makeTransactionAggregates(rebuild=True)
+            self.trackRefresh(AGGREGATES)
+            self.warmProfiles(generation)
             self.stdout.write(self.style.SUCCESS('Aggregates complete!'))
             return
 
+        if options['check_aggregates']:
+            self.checkTransactionAggregates()
+            return
+
+        if options['refresh_only']:
+            rollups = options['refresh_only'].split(',')
+
+            for rollup in rollups:
+                if rollup not in ROLLUPS:
+                    raise CommandError('"{}" is not a rollup'.format(rollup))
+
+            self.refreshRollups(rollups, rebuild=True)
+            self.trackRefresh(rollups)
+            self.warmProfiles(generation)
+            self.stdout.write(self.style.SUCCESS('Refresh complete!'))
+            return
+
         entity_types = options['entity_types'].split(',')
 
         if entity_types == ['all']:
-            entity_types = FILE_LOOKUP.keys()
+            entity_types = list(FILE_LOOKUP.keys())
+
+        if self.shadow:
+            self.makeShadowSchema(entity_types)
 
         self.makeETLTracker()
+        self.makeSlugFunction()
+
+        if self.tolerant:
+            self.makeCastCheckFunction()
+
+        if options['jobs'] > 1:
+            self.doParallelETL(list(entity_types), options)
+
+        else:
+            for entity_type in entity_types:
+                manifest = self.doETL(entity_type)
+
+                if manifest:
+                    self.updateTracker(entity_type, manifest)
+
+        if self.tolerant:
+            self.reportQuarantine(entity_types)
+
+        count = self.refreshSearchDocuments(entity_types)
+        self.stdout.write(self.style.SUCCESS('Refreshed {} search documents'.format(count)))
+
+        rollups = list(AGGREGATES)
+
+        if set(entity_types) & {'loan', 'loantransaction'}:
+            rollups.append('current_loan_status')
+
+        self.refreshRollups(rollups)
+        self.stdout.write(self.style.SUCCESS('Updated rollups'))
+
+        if self.shadow:
+            self.swapShadowSchema()
+            self.stdout.write(self.style.SUCCESS('Swapped in shadow schema'))
+
+        self.warmProfiles(generation)
+
+        self.stdout.write(self.style.SUCCESS('Import complete!'))
+
+    def warmProfiles(self, generation):
+        '''
+        Cache the financial profiles behind the candidate and committee
+        detail pages for the data we just loaded. Profiles cached for the
+        `generation` the import started on are still good if nothing got
+        loaded since.
+        '''
+        if isinstance(caches['default'], DummyCache):
+            return
+
+        if Entity.etl_generation(refresh=True) == generation:
+            self.stdout.write(self.style.SUCCESS('Nothing new was loaded, keeping cached entity profiles'))
+            return
+
+        # Profiles are built from the rollups, which a new database won't
+        # have until the first full import
+        missing = [r for r in ROLLUPS if self.relationKind(r, schema='public') is None]
+
+        if missing:
+            self.stdout.write(self.style.WARNING('Not caching entity profiles without {}'.format(', '.join(missing))))
+            return
+
+        start = time.time()
+
+        warmed = Entity.warm_profiles()
+
+        self.stdout.write(self.style.SUCCESS('Cached {0} entity profiles in {1:.1f}s'.format(warmed,
+                                                                                            time.time() - start)))
+
+    def doParallelETL(self, entity_types, options):
+        graph = build_etl_graph(entity_types)
+
+        # Worker processes are forked, so make sure that they don't inherit
+        # any open connections from this one.
+        self.connection.close()
+        engine.dispose()
+        shadow_engine.dispose()
+        connections.close_all()
+
+        durations = {}
+        pending = dict(graph)
+        running = {}
+
+        start = time.time()
+
+        with ProcessPoolExecutor(max_workers=options['jobs']) as executor:
+            while pending or running:
+                ready = [e for e, deps in pending.items() \
+                             if deps.issubset(durations)]
+
+                for entity_type in ready:
+                    del pending[entity_type]
+                    future = executor.submit(run_etl_job, entity_type, options)
+                    running[future] = entity_type
+
+                if not running:
+                    raise CommandError('Circular dependency between {}'.format(', '.join(pending)))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    del running[future]
+                    entity_type, duration = future.result()
+                    durations[entity_type] = duration
+
+        wall_time = time.time() - start
+
+        self.connect()
+
+        self.stdout.write(self.style.SUCCESS('Wall time by entity type:'))
+
+        for entity_type, duration in sorted(durations.items(),
+                                            key=lambda x: x[1],
+                                            reverse=True):
+            self.stdout.write('  {0}: {1:.1f}s'.format(entity_type, duration))
+
+        path, path_time = critical_path(graph, durations)
+
+        self.stdout.write(self.style.SUCCESS('Critical path: {0} ({1:.1f}s)'.format(' -> '.join(path), path_time)))
+        self.stdout.write(self.style.SUCCESS('Imported {0} entity types in {1:.1f}s'.format(len(durations), wall_time)))
+
+    def shadowTables(self, entity_types):
+        '''
+        Tables that an import of the given entity types writes to, which
+        need copying into the shadow schema before it starts.
+        '''
+        tables = ['etl_tracker']
+
+        # The aggregates and search documents get updated in place rather
+        # than rebuilt
+        tables.extend(AGGREGATES)
+        tables.append('search_document')
 
         for entity_type in entity_types:
-            self.doETL(entity_type)
+            if entity_type in MAPPER_LOOKUP:
+                tables.append('camp_fin_{}'.format(entity_type))
+
+        # The loan step can import loan transactions on its own, and
+        # candidates, PACs and filings all add to the entity table
+        if 'loan' in entity_types and 'loantransaction' not in entity_types:
+            tables.append('camp_fin_loantransaction')
+
+        if set(entity_types) & {'candidate', 'pac', 'filing'} and 'entity' not in entity_types:
+            tables.append('camp_fin_entity')
+
+        return tables
+
+    def makeShadowSchema(self, entity_types):
+        self.executeTransaction('DROP SCHEMA IF EXISTS {} CASCADE'.format(SHADOW_SCHEMA))
+        self.executeTransaction('CREATE SCHEMA {}'.format(SHADOW_SCHEMA))
+
+        for table in self.shadowTables(entity_types):
+            if self.relationKind(table, schema='public') != 'r':
+                continue
 
-            self.updateTracker(entity_type)
+            # Copying with INCLUDING ALL brings along the indexes (including
+            # the search vector indexes) and the column defaults, which keep
+            # pointing at the sequences of the public tables
+            create = '''
+                CREATE TABLE {0}.{1} (
+                  LIKE public.{1} INCLUDING ALL
+                )
+            '''.format(SHADOW_SCHEMA, table)
+
+            self.executeTransaction(create)
+
+            self.executeTransaction('''
+                INSERT INTO {0}.{1} SELECT * FROM public.{1}
+            '''.format(SHADOW_SCHEMA, table))
+
+            # Triggers (such as the ones keeping the search vectors up to
+            # date) need to be set up by hand
+            triggers = self.connection.execute(sa.text('''
+                SELECT pg_get_triggerdef(oid) AS definition
+                FROM pg_trigger
+                WHERE tgrelid = CAST(:table AS regclass)
+                  AND NOT tgisinternal
+            '''), table='public.{}'.format(table)).fetchall()
+
+            for trigger in triggers:
+                definition = re.sub(r' ON (public\.)?{} '.format(table),
+                                    ' ON {0}.{1} '.format(SHADOW_SCHEMA, table),
+                                    trigger.definition)
 
-        self.addTransactionFullName()
-        self.addLoanFullName()
-        self.addCandidateFullName()
-        self.addContactFullName()
-        self.addTreasurerFullName()
+                self.executeTransaction(definition)
 
-        # Make or refresh materialized views
-        self.makeTransactionAggregates()
-        self.stdout.write(self.style.SUCCESS('Made transaction aggregate views'))
+            self.stdout.write(self.style.SUCCESS('Copied {} into the shadow schema'.format(table)))
 
-        self.stdout.write(self.style.SUCCESS('Import complete!'.format(self.entity_type)))
+    def swapShadowSchema(self):
+        relations = self.connection.execute(sa.text('''
+            SELECT
+              c.relname,
+              c.relkind
+            FROM pg_class AS c
+            JOIN pg_namespace AS n
+              ON c.relnamespace = n.oid
+            WHERE n.nspname = :schema
+              AND c.relkind IN ('r', 'm')
+        '''), schema=SHADOW_SCHEMA).fetchall()
+
+        relations = [r for r in relations \
+                         if not r.relname.startswith(WORK_TABLE_PREFIXES)]
+
+        names = [r.relname for r in relations]
+
+        for name in names:
+            self.executeTransaction('ANALYZE {0}.{1}'.format(SHADOW_SCHEMA, name))
+
+        # Sequences belong to the tables that are about to be retired, so
+        # they need to be handed over to the new ones
+        sequences = self.connection.execute(sa.text('''
+            SELECT
+              seq.relname AS sequence_name,
+              tbl.relname AS table_name,
+              att.attname AS column_name
+            FROM pg_depend AS dep
+            JOIN pg_class AS seq
+              ON dep.objid = seq.oid
+            JOIN pg_class AS tbl
+              ON dep.refobjid = tbl.oid
+            JOIN pg_namespace AS n
+              ON tbl.relnamespace = n.oid
+            JOIN pg_attribute AS att
+              ON att.attrelid = tbl.oid
+              AND att.attnum = dep.refobjsubid
+            WHERE seq.relkind = 'S'
+              AND dep.deptype = 'a'
+              AND n.nspname = 'public'
+              AND tbl.relname = ANY(:names)
+        '''), names=names).fetchall()
+
+        # Foreign keys don't get copied into the shadow schema, so remake
+        # them on the new tables. They're added as NOT VALID so that we don't
+        # hold locks while checking every row, and validated once the swap
+        # is done.
+        foreign_keys = self.connection.execute(sa.text('''
+            SELECT
+              con.conname,
+              src.relname AS table_name,
+              pg_get_constraintdef(con.oid) AS definition,
+              src.relname = ANY(:names) AS swapped
+            FROM pg_constraint AS con
+            JOIN pg_class AS src
+              ON con.conrelid = src.oid
+            JOIN pg_namespace AS src_n
+              ON src.relnamespace = src_n.oid
+            JOIN pg_class AS ref
+              ON con.confrelid = ref.oid
+            JOIN pg_namespace AS ref_n
+              ON ref.relnamespace = ref_n.oid
+            WHERE con.contype = 'f'
+              AND ((src_n.nspname = 'public' AND src.relname = ANY(:names))
+                   OR (ref_n.nspname = 'public' AND ref.relname = ANY(:names)))
+        '''), names=names).fetchall()
+
+        self.executeTransaction('DROP SCHEMA IF EXISTS {} CASCADE'.format(RETIRED_SCHEMA))
+        self.executeTransaction('CREATE SCHEMA {}'.format(RETIRED_SCHEMA))
+
+        trans = self.connection.begin()
+
+        try:
+            for sequence in sequences:
+                self.connection.execute('''
+                    ALTER SEQUENCE public.{} OWNED BY NONE
+                '''.format(sequence.sequence_name))
+
+            for foreign_key in foreign_keys:
+                if not foreign_key.swapped:
+                    self.connection.execute('''
+                        ALTER TABLE public.{0} DROP CONSTRAINT {1}
+                    '''.format(foreign_key.table_name, foreign_key.conname))
+
+            for relation in relations:
+                kind = 'MATERIALIZED VIEW' if relation.relkind == 'm' else 'TABLE'
+
+                self.connection.execute('''
+                    ALTER {0} IF EXISTS public.{1} SET SCHEMA {2}
+                '''.format(kind, relation.relname, RETIRED_SCHEMA))
+
+                self.connection.execute('''
+                    ALTER {0} {1}.{2} SET SCHEMA public
+                '''.format(kind, SHADOW_SCHEMA, relation.relname))
+
+            for sequence in sequences:
+                self.connection.execute('''
+                    ALTER SEQUENCE public.{0} OWNED BY public.{1}.{2}
+                '''.format(sequence.sequence_name,
+                           sequence.table_name,
+                           sequence.column_name))
+
+            for foreign_key in foreign_keys:
+                self.connection.execute('''
+                    ALTER TABLE public.{0} ADD CONSTRAINT {1} {2} NOT VALID
+                '''.format(foreign_key.table_name,
+                           foreign_key.conname,
+                           foreign_key.definition))
+
+            self.restoreIndexNames(names)
+
+            trans.commit()
+
+        except sa.exc.SQLAlchemyError:
+            trans.rollback()
+            raise
+
+        self.executeTransaction('DROP SCHEMA {} CASCADE'.format(RETIRED_SCHEMA))
+
+        for foreign_key in foreign_keys:
+            self.executeTransaction('''
+                ALTER TABLE public.{0} VALIDATE CONSTRAINT {1}
+            '''.format(foreign_key.table_name, foreign_key.conname))
+
+    def restoreIndexNames(self, names):
+        '''
+        Copying a table with LIKE gives its indexes (and the primary key and
+        unique constraints behind them) new names, which the migrations that
+        refer to them by name wouldn't find. Once the copies are in the public
+        schema, give each index the name of the one it replaced on the retired
+        table, matching them up on the columns they cover.
+        '''
+        indexes = self.connection.execute(sa.text('''
+            WITH indexes AS (
+              SELECT
+                n.nspname AS schema_name,
+                tbl.relname AS table_name,
+                idx.relname AS index_name,
+                i.indisunique,
+                i.indisprimary,
+                substring(pg_get_indexdef(i.indexrelid) FROM ' USING .*') AS definition,
+                con.oid IS NOT NULL AS is_constraint
+              FROM pg_index AS i
+              JOIN pg_class AS idx
+                ON i.indexrelid = idx.oid
+              JOIN pg_class AS tbl
+                ON i.indrelid = tbl.oid
+              JOIN pg_namespace AS n
+                ON tbl.relnamespace = n.oid
+              LEFT JOIN pg_constraint AS con
+                ON con.conindid = i.indexrelid
+                AND con.conrelid = i.indrelid
+              WHERE n.nspname IN ('public', :retired)
+                AND tbl.relname = ANY(:names)
+            )
+            SELECT
+              new.table_name,
+              new.index_name AS new_name,
+              old.index_name AS old_name,
+              new.is_constraint
+            FROM indexes AS new
+            JOIN indexes AS old
+              USING (table_name, indisunique, indisprimary, definition)
+            WHERE new.schema_name = 'public'
+              AND old.schema_name = :retired
+            ORDER BY new.table_name, new.index_name, old.index_name
+        '''), names=names, retired=RETIRED_SCHEMA).fetchall()
+
+        renamed, taken = set(), set()
+
+        # Identical indexes on the same table match each other more than once,
+        # so pair them up one to one
+        for index in indexes:
+            if index.new_name in renamed or index.old_name in taken:
+                continue
+
+            renamed.add(index.new_name)
+            taken.add(index.old_name)
+
+            if index.new_name == index.old_name:
+                continue
+
+            if index.is_constraint:
+                rename = 'ALTER TABLE public.{0} RENAME CONSTRAINT "{1}" TO "{2}"'
+            else:
+                rename = 'ALTER INDEX public."{1}" RENAME TO "{2}"'
+
+            self.connection.execute(rename.format(index.table_name,
+                                                  index.new_name,
+                                                  index.old_name))
 
     def doETL(self, entity_type):
         self.entity_type = entity_type
@@ -163,161 +958,543 @@ class Command(BaseCommand):
 
         if file_name:
 
-            self.stdout.write(self.style.SUCCESS('Importing {}'.format(file_name)))
+            self.stdout.write(self.style.SUCCESS('Importing {}'.format(file_name)))
+
+            self.file_path = 'data/{}'.format(file_name)
+
+            ftp_file = os.path.join(settings.FTP_DIRECTORY, file_name)
+
+            if os.path.exists(ftp_file):
+                self.file_path = ftp_file
+
+            self.encoding = 'utf-8'
+            if entity_type in ['address', 'contact', 'campaign']:
+                self.encoding = 'windows-1252'
+
+            self.table_mapper = MAPPER_LOOKUP[self.entity_type]
+
+            self.django_table = 'camp_fin_{}'.format(self.entity_type)
+            self.raw_pk_col = [k for k, v in self.table_mapper.items() \
+                                   if v['field'] == 'id'][0]
+
+            manifest = self.sourceManifest()
+
+            if not self.force and self.sourceUnchanged(manifest):
+                self.stdout.write(self.style.SUCCESS('{} has not changed since the last import, skipping'.format(file_name)))
+
+                # Leave empty change sets behind so that the steps that run
+                # after the import don't pick up records from the last run
+                self.makeChangeTable()
+                self.makeNewTable()
+                self.indexWorkTable('change_{}'.format(self.entity_type), 'id')
+                self.indexWorkTable('new_{}'.format(self.entity_type), 'id')
+                self.executeTransaction('DROP TABLE IF EXISTS quarantine_{}'.format(self.entity_type))
+
+                # Loan transactions might still have changed
+                if self.entity_type == 'loan':
+                    self.loadLoanTransactions()
+
+                self.stdout.write(self.style.SUCCESS('\n'))
+
+                return None
+
+            self.makeRawTable()
+            count = self.importRawData()
+
+            self.stdout.write(self.style.SUCCESS('Found {0} records in {1}'.format(count, file_name)))
+
+            if self.tolerant:
+                count = self.quarantineRows()
+                self.stdout.write(self.style.SUCCESS('Quarantined {0} records from {1}'.format(count, file_name)))
+
+            self.indexRawTable()
+
+            self.addRowHashColumn()
+
+            if self.entity_type in AGGREGATE_DEPENDENCIES:
+                self.makeDirtyTable()
+
+            count = self.updateExistingRecords()
+
+            self.stdout.write(self.style.SUCCESS('Updated {0} records in {1}'.format(count, self.django_table)))
+
+            self.makeNewTable()
+            count = self.findNewRecords()
+
+            self.addNewRecords()
+
+            if self.entity_type in AGGREGATE_DEPENDENCIES:
+                self.markDirtyRows('change')
+                self.markDirtyRows('new')
+
+            self.stdout.write(self.style.SUCCESS('Inserted {0} new records into {1}'.format(count, self.django_table)))
+
+            # This should only be necessary until we get the actual entity table
+
+            if self.entity_type in ['candidate', 'pac', 'filing']:
+                self.populateEntityTable()
+                self.stdout.write(self.style.SUCCESS('Populated entity table for {}'.format(self.entity_type)))
+
+            if self.entity_type in ['candidate', 'pac', 'lobbyist', 'organization']:
+                self.populateSlugField()
+                self.stdout.write(self.style.SUCCESS('Populated slug fields for {}'.format(self.entity_type)))
+
+            if self.entity_type == 'loan':
+                self.loadLoanTransactions()
+
+            self.stdout.write(self.style.SUCCESS('\n'))
+
+            return manifest
+
+        else:
+            self.stdout.write(self.style.ERROR('"{}" is not a valid entity'.format(self.entity_type)))
+            self.stdout.write(self.style.SUCCESS('\n'))
+
+    def makeTransactionAggregates(self, rebuild=False):
+        self.refreshRollups(AGGREGATES, rebuild=rebuild)
+
+    def refreshRollups(self, rollups, rebuild=False):
+        '''
+        Bring rollups up to date, each on its own connection. The aggregate
+        tables only recompute the (entity, bucket) groups that the dirty rows
+        from this import touch, unless a rebuild is asked for.
+        '''
+        dirty = [t for t in AGGREGATE_DEPENDENCIES \
+                     if self.relationKind('dirty_{}'.format(t))]
+
+        with ThreadPoolExecutor(max_workers=len(rollups)) as executor:
+            futures = [executor.submit(run_refresh_job, rollup, self.options, rebuild, dirty) \
+                           for rollup in rollups]
+
+            for future in as_completed(futures):
+                rollup, duration = future.result()
+                self.stdout.write('  {0}: {1:.1f}s'.format(rollup, duration))
+
+        # Dirty rows only get cleared once every aggregate has seen them
+        if set(AGGREGATES).issubset(rollups):
+            for entity_type in dirty:
+                self.executeTransaction('DROP TABLE IF EXISTS dirty_{}'.format(entity_type))
+
+    def refreshSearchDocuments(self, entity_types):
+        '''
+        Rebuild the search documents that show anything this import added or
+        changed, following the change sets that each entity type left behind.
+        Returns how many documents were written.
+        '''
+        changes = []
+
+        for entity_type in entity_types:
+            for change_set in ('change', 'new'):
+                changed = '{0}_{1}'.format(change_set, entity_type)
+
+                if not self.relationKind(changed):
+                    continue
+
+                for kinds, query in SEARCH_DEPENDENCIES.get(entity_type, []):
+                    for kind in kinds:
+                        changes.append('''
+                            SELECT '{0}' AS kind, id AS object_id
+                            FROM ({1}) AS ids (id)
+                        '''.format(kind, query.format(changed=changed)))
+
+        if not changes:
+            return 0
+
+        trans = self.connection.begin()
+
+        try:
+            self.connection.execute("SET local timezone to 'UTC'")
+
+            self.connection.execute('''
+                CREATE TEMP TABLE search_refresh
+                ON COMMIT DROP
+                AS SELECT DISTINCT * FROM ({}) AS changes
+            '''.format(' UNION ALL '.join(changes)))
+
+            self.connection.execute('ANALYZE search_refresh')
+
+            self.connection.execute('''
+                DELETE FROM search_document AS doc
+                USING search_refresh AS r
+                WHERE doc.kind = r.kind
+                  AND doc.object_id = r.object_id
+            ''')
+
+            count = 0
+
+            for kind in SEARCH_SOURCES:
+                inserted = self.connection.execute(insert_search_documents(kind, 'search_refresh'))
+                count += inserted.rowcount
+
+            trans.commit()
+
+        except sa.exc.SQLAlchemyError:
+            trans.rollback()
+            raise
+
+        return count
+
+    def refreshRollup(self, rollup, rebuild=False, dirty=None):
+        if rollup == 'current_loan_status':
+            self.buildLoanBalanceView()
+            return
+
+        interval = rollup.split('_by_')[1]
+
+        if rebuild or self.relationKind(rollup) != 'r':
+            self.rebuildAggregate(rollup, self.aggregateQuery(rollup), interval)
+
+        elif dirty:
+            groups = 'dirty_groups_{}'.format(rollup)
+
+            self.makeDirtyGroups(groups, interval, dirty)
+            self.updateAggregate(rollup,
+                                 self.aggregateQuery(rollup, groups=groups),
+                                 groups,
+                                 interval)
+            self.executeTransaction('DROP TABLE {}'.format(groups))
+
+    def aggregateQuery(self, rollup, groups=None):
+        kind, interval = rollup.split('_by_')
+
+        if kind == 'contributions':
+            return self.contributionsQuery(interval, groups=groups)
+
+        return self.expendituresQuery(interval, groups=groups)
+
+    def contributionsQuery(self, interval, groups=None):
+        return '''
+            SELECT
+              SUM(amount) AS amount,
+              entity_id,
+              {0}
+            FROM (
+              SELECT
+                SUM(t.amount) AS amount,
+                f.entity_id,
+                MAX(date_trunc('{0}', t.received_date)) AS {0}
+              FROM camp_fin_transaction AS t
+              JOIN camp_fin_transactiontype AS tt
+                ON t.transaction_type_id = tt.id
+              JOIN camp_fin_filing AS f
+                ON t.filing_id = f.id
+              {1}
+              WHERE tt.contribution = TRUE
+                AND (tt.description = 'Monetary contribution' or
+                     tt.description = 'Anonymous Contribution')
+              GROUP BY f.entity_id, date_trunc('{0}', t.received_date)
+              UNION
+              SELECT
+                SUM(l.amount) AS amount,
+                f.entity_id,
+                MAX(date_trunc('{0}', l.received_date)) AS {0}
+              FROM camp_fin_loan AS l
+              JOIN camp_fin_filing AS f
+                ON l.filing_id = f.id
+              {2}
+              GROUP BY f.entity_id, date_trunc('{0}', l.received_date)
+            ) AS s
+            GROUP BY entity_id, {0}
+        '''.format(interval,
+                   self.groupFilter(groups, interval, 'f', 't.received_date'),
+                   self.groupFilter(groups, interval, 'f', 'l.received_date'))
+
+    def expendituresQuery(self, interval, groups=None):
+        return '''
+            SELECT
+              entity_id,
+              SUM(amount) AS amount,
+              {0}
+            FROM (
+              SELECT
+                filing.entity_id,
+                SUM(e.amount) AS amount,
+                date_trunc('{0}', e.received_date) AS {0}
+              FROM camp_fin_transaction AS e
+              JOIN camp_fin_transactiontype AS tt
+                ON e.transaction_type_id = tt.id
+              JOIN camp_fin_filing AS filing
+                ON e.filing_id = filing.id
+              JOIN camp_fin_filingperiod AS fp
+                ON filing.filing_period_id = fp.id
+              {1}
+              WHERE tt.contribution = FALSE
+                AND fp.filing_date >= '2010-01-01'
+              GROUP BY filing.entity_id, date_trunc('{0}', e.received_date)
+
+              UNION
+
+              SELECT
+                filing.entity_id,
+                SUM(lt.amount) AS amount,
+                date_trunc('{0}', lt.transaction_date) AS {0}
+              FROM camp_fin_loantransaction AS lt
+              JOIN camp_fin_loantransactiontype AS ltt
+                ON lt.transaction_type_id = ltt.id
+              JOIN camp_fin_filing AS filing
+                ON lt.filing_id = filing.id
+              JOIN camp_fin_filingperiod AS fp
+                ON filing.filing_period_id = fp.id
+              {2}
+              WHERE ltt.description = 'Payment'
+                AND fp.filing_date >= '2010-01-01'
+              GROUP BY filing.entity_id, date_trunc('{0}', lt.transaction_date)
+            ) AS s
+            GROUP BY entity_id, {0}
+        '''.format(interval,
+                   self.groupFilter(groups, interval, 'filing', 'e.received_date'),
+                   self.groupFilter(groups, interval, 'filing', 'lt.transaction_date'))
+
+    def groupFilter(self, groups, interval, filing_alias, date_col):
+        '''
+        Limit one part of an aggregate query to the groups in a table of
+        (entity_id, bucket) pairs.
+        '''
+        if not groups:
+            return ''
+
+        return '''
+            JOIN {0} AS g
+              ON {1}.entity_id = g.entity_id
+              AND date_trunc('{2}', {3}) = g.bucket
+        '''.format(groups, filing_alias, interval, date_col)
+
+    def rebuildAggregate(self, name, query, interval):
+        '''
+        Make an aggregate table from scratch. It gets built under another name
+        and renamed into place, so readers only wait on the swap. This also
+        takes care of replacing the materialized views that these used to be.
+        '''
+        kind = self.relationKind(name)
+
+        schema = SHADOW_SCHEMA if self.shadow else 'public'
+        build = '{}_rebuild'.format(name)
+
+        self.executeTransaction('DROP TABLE IF EXISTS {0}.{1}'.format(schema, build))
+
+        self.executeTransaction('''
+            CREATE TABLE {0}.{1} AS (
+              {2}
+            )
+        '''.format(schema, build, query))
+
+        self.executeTransaction('''
+            CREATE UNIQUE INDEX {0}_key ON {1}.{0} (entity_id, {2})
+        '''.format(build, schema, interval))
+
+        trans = self.connection.begin()
+
+        try:
+            if kind == 'm':
+                self.connection.execute('DROP MATERIALIZED VIEW {0}.{1}'.format(schema, name))
+            elif kind == 'r':
+                self.connection.execute('DROP TABLE {0}.{1}'.format(schema, name))
+
+            self.connection.execute('''
+                ALTER TABLE {0}.{1} RENAME TO {2}
+            '''.format(schema, build, name))
 
-            self.file_path = 'data/{}'.format(file_name)
+            self.connection.execute('''
+                ALTER INDEX {0}.{1}_key RENAME TO {2}_key
+            '''.format(schema, build, name))
 
-            ftp_file = os.path.join(settings.FTP_DIRECTORY, file_name)
+            trans.commit()
 
-            if os.path.exists(ftp_file):
-                self.file_path = ftp_file
+        except sa.exc.SQLAlchemyError:
+            trans.rollback()
+            raise
 
-            self.encoding = 'utf-8'
-            if entity_type in ['address', 'contact', 'campaign']:
-                self.encoding = 'windows-1252'
+    def updateAggregate(self, name, query, groups, interval):
+        '''
+        Swap out the dirty groups in an aggregate table for freshly computed
+        ones. Groups that no longer have any rows simply go away.
+        '''
+        if self.shadow:
+            name = '{0}.{1}'.format(SHADOW_SCHEMA, name)
 
-            self.table_mapper = MAPPER_LOOKUP[self.entity_type]
+        trans = self.connection.begin()
 
-            self.django_table = 'camp_fin_{}'.format(self.entity_type)
-            self.raw_pk_col = [k for k, v in self.table_mapper.items() \
-                                   if v['field'] == 'id'][0]
+        try:
+            self.connection.execute("SET local timezone to 'America/Denver'")
 
-            if self.file_path.endswith('xlsx'):
-                self.convertXLSX()
+            self.connection.execute('''
+                DELETE FROM {0} AS a
+                USING {1} AS g
+                WHERE a.entity_id = g.entity_id
+                  AND a.{2} = g.bucket
+            '''.format(name, groups, interval))
 
-            if self.file_path.endswith('zip'):
-                self.unzipFile()
+            self.connection.execute('''
+                INSERT INTO {0} {1}
+            '''.format(name, query))
 
-            self.makeRawTable()
-            count = self.importRawData()
+            trans.commit()
 
-            self.stdout.write(self.style.SUCCESS('Found {0} records in {1}'.format(count, file_name)))
+        except sa.exc.SQLAlchemyError:
+            trans.rollback()
+            raise
 
-            count = self.updateExistingRecords()
+    def makeDirtyGroups(self, groups, interval, entity_types):
+        '''
+        Work out which (entity, bucket) groups the dirty rows fall into.
+        '''
+        dirty_rows = ' UNION ALL '.join(['SELECT entity_id, received_date FROM dirty_{}'.format(e) \
+                                             for e in entity_types])
 
-            self.stdout.write(self.style.SUCCESS('Updated {0} records in {1}'.format(count, self.django_table)))
+        self.executeTransaction('DROP TABLE IF EXISTS {}'.format(groups))
 
-            self.makeNewTable()
-            count = self.findNewRecords()
+        trans = self.connection.begin()
 
-            self.addNewRecords()
+        try:
+            # Buckets have to line up with the ones in the aggregate tables
+            self.connection.execute("SET local timezone to 'America/Denver'")
 
-            self.stdout.write(self.style.SUCCESS('Inserted {0} new records into {1}'.format(count, self.django_table)))
+            self.connection.execute('''
+                CREATE UNLOGGED TABLE {0} AS
+                  SELECT DISTINCT
+                    entity_id,
+                    date_trunc('{1}', received_date) AS bucket
+                  FROM ({2}) AS d
+            '''.format(groups, interval, dirty_rows))
 
-            # This should only be necessary until we get the actual entity table
+            trans.commit()
 
-            if self.entity_type in ['candidate', 'pac', 'filing']:
-                self.populateEntityTable()
-                self.stdout.write(self.style.SUCCESS('Populated entity table for {}'.format(self.entity_type)))
+        except sa.exc.SQLAlchemyError:
+            trans.rollback()
+            raise
 
-            if self.entity_type in ['candidate', 'pac', 'lobbyist', 'organization']:
-                self.populateSlugField()
-                self.stdout.write(self.style.SUCCESS('Populated slug fields for {}'.format(self.entity_type)))
+        self.executeTransaction('ANALYZE {}'.format(groups))
 
-            if self.entity_type == 'loan':
-                self.makeLoanBalanceView()
-                self.stdout.write(self.style.SUCCESS('Made loan balance view'))
+    def makeDirtyTable(self):
+        '''
+        Keep track of the entities and dates that the aggregated rows touched
+        by this import had before and after it, so that the aggregates know
+        which groups to recompute. The entity gets looked up when the rows
+        are marked, so that a filing moving to another entity dirties both of
+        them. Rows from earlier imports that never made it into the
+        aggregates are kept.
+        '''
+        if self.relationKind('dirty_{}'.format(self.entity_type)):
+            return
 
-            self.stdout.write(self.style.SUCCESS('\n'))
+        self.executeTransaction('''
+            CREATE UNLOGGED TABLE dirty_{0} (
+              entity_id INTEGER,
+              received_date TIMESTAMP WITH TIME ZONE
+            )
+        '''.format(self.entity_type))
 
-        else:
-            self.stdout.write(self.style.ERROR('"{}" is not a valid entity'.format(self.entity_type)))
-            self.stdout.write(self.style.SUCCESS('\n'))
+    def markDirtyRows(self, change_set):
+        for source, changed_col in AGGREGATE_DEPENDENCIES[self.entity_type]:
+            self.executeTransaction('''
+                INSERT INTO dirty_{0} (entity_id, received_date)
+                  SELECT f.entity_id, dat.{1}
+                  FROM camp_fin_{2} AS dat
+                  JOIN camp_fin_filing AS f
+                    ON dat.filing_id = f.id
+                  JOIN {3}_{0} AS changed
+                    ON {4} = changed.id
+            '''.format(self.entity_type,
+                       AGGREGATE_SOURCES[source],
+                       source,
+                       change_set,
+                       changed_col))
+
+    def checkTransactionAggregates(self):
+        '''
+        Compare each aggregate table with what a full rebuild would give and
+        report any groups that differ. Amounts are compared to the cent, since
+        floating point sums can come out slightly differently.
+        '''
+        mismatches = 0
+
+        for name in AGGREGATES:
+            if self.relationKind(name) != 'r':
+                self.stdout.write(self.style.ERROR('{} is not an aggregate table'.format(name)))
+                mismatches += 1
+                continue
+
+            check = '''
+                WITH stored AS (
+                  SELECT entity_id, {1}, ROUND(amount::numeric, 2) AS amount
+                  FROM {0}
+                ), expected AS (
+                  SELECT entity_id, {1}, ROUND(amount::numeric, 2) AS amount
+                  FROM ({2}) AS s
+                )
+                SELECT
+                  (SELECT COUNT(*) FROM (TABLE stored EXCEPT ALL TABLE expected) AS d) AS extra,
+                  (SELECT COUNT(*) FROM (TABLE expected EXCEPT ALL TABLE stored) AS d) AS missing
+            '''.format(name, name.split('_by_')[1], self.aggregateQuery(name))
 
-    def makeTransactionAggregates(self):
+            trans = self.connection.begin()
 
-        for interval in ['day', 'week', 'month']:
             try:
-                self.executeTransaction('''
-                    REFRESH MATERIALIZED VIEW contributions_by_{}
-                '''.format(interval))
-            except sa.exc.ProgrammingError:
-                view = '''
-                    CREATE MATERIALIZED VIEW contributions_by_{0} AS (
-                      SELECT
-                        SUM(amount) AS amount,
-                        entity_id,
-                        {0}
-                      FROM (
-                        SELECT
-                          SUM(t.amount) AS amount,
-                          f.entity_id,
-                          MAX(date_trunc('{0}', t.received_date)) AS {0}
-                        FROM camp_fin_transaction AS t
-                        JOIN camp_fin_transactiontype AS tt
-                          ON t.transaction_type_id = tt.id
-                        JOIN camp_fin_filing AS f
-                          ON t.filing_id = f.id
-                        WHERE tt.contribution = TRUE
-                          AND (tt.description = 'Monetary contribution' or
-                               tt.description = 'Anonymous Contribution')
-                        GROUP BY f.entity_id, date_trunc('{0}', t.received_date)
-                        UNION
-                        SELECT
-                          SUM(l.amount) AS amount,
-                          f.entity_id,
-                          MAX(date_trunc('{0}', l.received_date)) AS {0}
-                        FROM camp_fin_loan AS l
-                        JOIN camp_fin_filing AS f
-                          ON l.filing_id = f.id
-                        GROUP BY f.entity_id, date_trunc('{0}', l.received_date)
-                      ) AS s
-                      GROUP BY entity_id, {0}
-                    )
-                '''.format(interval)
-
-                self.executeTransaction(view)
+                self.connection.execute("SET local timezone to 'America/Denver'")
+                result = self.connection.execute(check).first()
+            finally:
+                trans.rollback()
+
+            if result.extra or result.missing:
+                mismatches += 1
+                self.stdout.write(self.style.ERROR('{0}: {1} stale rows, {2} missing rows'.format(name, result.extra, result.missing)))
+            else:
+                self.stdout.write(self.style.SUCCESS('{}: OK'.format(name)))
 
-            try:
-                self.executeTransaction('''
-                    REFRESH MATERIALIZED VIEW expenditures_by_{}
-                '''.format(interval))
-            except sa.exc.ProgrammingError:
-                view = '''
-                    CREATE MATERIALIZED VIEW expenditures_by_{0} AS (
-                      SELECT
-                        entity_id,
-                        SUM(amount) AS amount,
-                        {0}
-                      FROM (
-                        SELECT
-                          filing.entity_id,
-                          SUM(e.amount) AS amount,
-                          date_trunc('{0}', e.received_date) AS {0}
-                        FROM camp_fin_transaction AS e
-                        JOIN camp_fin_transactiontype AS tt
-                          ON e.transaction_type_id = tt.id
-                        JOIN camp_fin_filing AS filing
-                          ON e.filing_id = filing.id
-                        JOIN camp_fin_filingperiod AS fp
-                          ON filing.filing_period_id = fp.id
-                        WHERE tt.contribution = FALSE
-                          AND fp.filing_date >= '2010-01-01'
-                        GROUP BY filing.entity_id, date_trunc('{0}', e.received_date)
-
-                        UNION
-
-                        SELECT
-                          filing.entity_id,
-                          SUM(lt.amount) AS amount,
-                          date_trunc('{0}', lt.transaction_date) AS {0}
-                        FROM camp_fin_loantransaction AS lt
-                        JOIN camp_fin_loantransactiontype AS ltt
-                          ON lt.transaction_type_id = ltt.id
-                        JOIN camp_fin_filing AS filing
-                          ON lt.filing_id = filing.id
-                        JOIN camp_fin_filingperiod AS fp
-                          ON filing.filing_period_id = fp.id
-                        WHERE ltt.description = 'Payment'
-                          AND fp.filing_date >= '2010-01-01'
-                        GROUP BY filing.entity_id, date_trunc('{0}', lt.transaction_date)
-                      ) AS s
-                      GROUP BY entity_id, {0}
-                    )
-                '''.format(interval)
-
-                self.executeTransaction(view)
+        if mismatches:
+            raise CommandError('{} aggregate tables are out of date. Rebuild them with --add-aggregates'.format(mismatches))
+
+    def relationKind(self, name, schema=None):
+        '''
+        What sort of relation (r for table, m for materialized view) a name
+        refers to in the schema that the import is working on, if any.
+        '''
+        if schema is None:
+            schema = SHADOW_SCHEMA if self.shadow else 'public'
+
+        kind = self.connection.execute(sa.text('''
+            SELECT c.relkind
+            FROM pg_class AS c
+            JOIN pg_namespace AS n
+              ON c.relnamespace = n.oid
+            WHERE n.nspname = :schema
+              AND c.relname = :name
+        '''), schema=schema, name=name).first()
+
+        if kind:
+            return kind.relkind
+
+    def makeMaterializedView(self, name, query, unique_columns):
+        '''
+        Refresh a materialized view, creating it if it doesn't exist yet.
+        Refreshes happen concurrently so that readers aren't locked out,
+        which needs a unique index on the view. Shadow imports work on a copy
+        of the view in the shadow schema.
+        '''
+        index = '''
+            CREATE UNIQUE INDEX {0}_key ON {1} ({2})
+        '''.format(name,
+                   '{0}.{1}'.format(SHADOW_SCHEMA, name) if self.shadow else name,
+                   ', '.join(unique_columns))
+
+        if self.shadow:
+            name = '{0}.{1}'.format(SHADOW_SCHEMA, name)
+
+        # Views made before they had a unique index need one added
+        self.executeTransaction(index, raise_exc=False)
+
+        try:
+            self.executeTransaction('''
+                REFRESH MATERIALIZED VIEW CONCURRENTLY {}
+            '''.format(name))
+        except sa.exc.ProgrammingError:
+            self.executeTransaction('''
+                CREATE MATERIALIZED VIEW {0} AS (
+                  {1}
+                )
+            '''.format(name, query))
 
+            self.executeTransaction(index)
 
     def makeETLTracker(self):
         create = '''
@@ -325,23 +1502,97 @@ class Command(BaseCommand):
               id SERIAL,
               entity_type VARCHAR,
               last_update timestamp with time zone,
+              file_name VARCHAR,
+              file_size BIGINT,
+              file_mtime timestamp with time zone,
+              checksum VARCHAR(32),
               PRIMARY KEY (id)
             )
         '''
         self.executeTransaction(create)
 
-    def updateTracker(self, entity_type):
+        # Trackers made before we started keeping a manifest need the extra
+        # columns. This will fail once they are there, which is fine.
+        add_manifest = '''
+            ALTER TABLE etl_tracker
+              ADD COLUMN file_name VARCHAR,
+              ADD COLUMN file_size BIGINT,
+              ADD COLUMN file_mtime timestamp with time zone,
+              ADD COLUMN checksum VARCHAR(32)
+        '''
+        self.executeTransaction(add_manifest, raise_exc=False)
+
+    def updateTracker(self, entity_type, manifest):
         update = '''
             INSERT INTO etl_tracker (
               entity_type,
-              last_update
+              last_update,
+              file_name,
+              file_size,
+              file_mtime,
+              checksum
             ) VALUES (
               :entity_type,
-              NOW()
+              NOW(),
+              :file_name,
+              :file_size,
+              :file_mtime,
+              :checksum
             )
         '''
         self.executeTransaction(sa.text(update),
-                                entity_type=entity_type)
+                                entity_type=entity_type,
+                                **manifest._asdict())
+
+    def trackRefresh(self, rollups):
+        '''
+        Note rollups that got rebuilt outside of an import in the tracker,
+        so that what's cached from them is thrown out like it is after an
+        import.
+        '''
+        self.makeETLTracker()
+
+        for rollup in rollups:
+            self.executeTransaction(sa.text('''
+                INSERT INTO etl_tracker (entity_type, last_update)
+                VALUES (:rollup, NOW())
+            '''), rollup=rollup)
+
+    def sourceManifest(self):
+        '''
+        Describe the source file for the current entity type, including a
+        checksum of its contents.
+        '''
+        stat = os.stat(self.file_path)
+        checksum = hashlib.md5()
+
+        with open(self.file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                checksum.update(chunk)
+
+        return SourceManifest(file_name=os.path.basename(self.file_path),
+                              file_size=stat.st_size,
+                              file_mtime=datetime.fromtimestamp(stat.st_mtime, tz=pytz.utc),
+                              checksum=checksum.hexdigest())
+
+    def sourceUnchanged(self, manifest):
+        '''
+        Whether the source file is byte for byte the same one that we
+        imported last time around.
+        '''
+        last_import = self.connection.execute(sa.text('''
+            SELECT file_size, checksum
+            FROM etl_tracker
+            WHERE entity_type = :entity_type
+            ORDER BY id DESC
+            LIMIT 1
+        '''), entity_type=self.entity_type).first()
+
+        if last_import:
+            return (last_import.file_size == manifest.file_size and
+                    last_import.checksum == manifest.checksum)
+
+        return False
 
     def loadLoanTransactions(self):
         timezone = pytz.timezone(settings.TIME_ZONE)
@@ -352,12 +1603,17 @@ class Command(BaseCommand):
             WHERE entity_type = 'loantransaction'
         ''').first().last_update
 
+        stale = True
+
         if transactions_updated:
             an_hour_ago = timezone.localize(datetime.now()) - timedelta(hours=1)
-            if transactions_updated < an_hour_ago:
-                self.doETL('loantransaction')
-        else:
-            self.doETL('loantransaction')
+            stale = transactions_updated < an_hour_ago
+
+        if stale:
+            manifest = self.doETL('loantransaction')
+
+            if manifest:
+                self.updateTracker('loantransaction', manifest)
 
     def makeAllExpenditureView(self):
         self.loadLoanTransactions()
@@ -390,216 +1646,63 @@ class Command(BaseCommand):
             WHERE loan_transaction_type.description = 'Payment'
         '''
 
-    def makeLoanBalanceView(self):
-        self.loadLoanTransactions()
-
-        try:
-            self.executeTransaction('''
-                REFRESH MATERIALIZED VIEW current_loan_status
-            ''', raise_exc=True)
-        except sa.exc.ProgrammingError:
-            self.executeTransaction('''
-                CREATE MATERIALIZED VIEW current_loan_status AS (
-                  SELECT
-                    loan.id AS loan_id,
-                    MAX(loan.amount) AS loan_amount,
-                    SUM(loantrans.amount) AS payments_made,
-                    (MAX(loan.amount) - SUM(loantrans.amount)) AS outstanding_balance
-                  FROM camp_fin_loan AS loan
-                  JOIN camp_fin_loantransaction AS loantrans
-                    ON loan.id = loantrans.loan_id
-                  GROUP BY loan.id
-                  HAVING ((MAX(loan.amount::numeric::money) - SUM(loantrans.amount::numeric::money)) > 0::money)
-                )
-            ''')
-
-    def addTransactionFullName(self):
-        update = '''
-            UPDATE camp_fin_transaction SET
-              full_name = s.full_name
-            FROM (
-              SELECT
-                CASE WHEN
-                  company_name IS NULL OR TRIM(company_name) = ''
-                THEN
-                  TRIM(concat_ws(' ',
-                                 name_prefix,
-                                 first_name,
-                                 middle_name,
-                                 last_name,
-                                 suffix))
-                ELSE
-                  company_name
-                END AS full_name,
-                t.id
-              FROM camp_fin_transaction AS t
-              LEFT JOIN change_transaction AS c
-                ON t.id = c.id
-              LEFT JOIN new_transaction AS n
-                ON t.id = n.id
-              WHERE c.id IS NOT NULL
-                OR n.id IS NOT NULL
-            ) AS s
-            WHERE camp_fin_transaction.id = s.id
-        '''
-
-        self.executeTransaction(update)
-
-    def addLoanFullName(self):
-        update = '''
-            UPDATE camp_fin_loan SET
-              full_name = s.full_name
-            FROM (
-              SELECT
-                CASE WHEN
-                  company_name IS NULL OR TRIM(company_name) = ''
-                THEN
-                  TRIM(concat_ws(' ',
-                                 name_prefix,
-                                 first_name,
-                                 middle_name,
-                                 last_name,
-                                 suffix))
-                ELSE
-                  company_name
-                END AS full_name,
-                t.id
-              FROM camp_fin_loan AS t
-              LEFT JOIN change_loan AS c
-                ON t.id = c.id
-              LEFT JOIN new_loan AS n
-                ON t.id = n.id
-              WHERE c.id IS NOT NULL
-                OR n.id IS NOT NULL
-            ) AS s
-            WHERE camp_fin_loan.id = s.id
-        '''
-
-        self.executeTransaction(update)
-
-    def addTreasurerFullName(self):
-        update = '''
-            UPDATE camp_fin_treasurer SET
-              full_name = s.full_name
-            FROM (
-              SELECT
-                  TRIM(concat_ws(' ',
-                                 prefix,
-                                 first_name,
-                                 middle_name,
-                                 last_name,
-                                 suffix)) AS full_name,
-                t.id
-              FROM camp_fin_treasurer AS t
-              LEFT JOIN change_treasurer AS c
-                ON t.id = c.id
-              LEFT JOIN new_treasurer AS n
-                ON t.id = n.id
-              WHERE c.id IS NOT NULL
-                OR n.id IS NOT NULL
-            ) AS s
-            WHERE camp_fin_treasurer.id = s.id
+    def buildLoanBalanceView(self):
+        loan_balance = '''
+            SELECT
+              loan.id AS loan_id,
+              MAX(loan.amount) AS loan_amount,
+              SUM(loantrans.amount) AS payments_made,
+              (MAX(loan.amount) - SUM(loantrans.amount)) AS outstanding_balance
+            FROM camp_fin_loan AS loan
+            JOIN camp_fin_loantransaction AS loantrans
+              ON loan.id = loantrans.loan_id
+            GROUP BY loan.id
+            HAVING ((MAX(loan.amount::numeric::money) - SUM(loantrans.amount::numeric::money)) > 0::money)
         '''
 
-        self.executeTransaction(update)
+        self.makeMaterializedView('current_loan_status', loan_balance, ['loan_id'])
 
-    def addCandidateFullName(self):
-        update = '''
-            UPDATE camp_fin_candidate SET
-              full_name = s.full_name
-            FROM (
-              SELECT
-                  TRIM(concat_ws(' ',
-                                 prefix,
-                                 first_name,
-                                 middle_name,
-                                 last_name,
-                                 suffix)) AS full_name,
-                t.id
-              FROM camp_fin_candidate AS t
-              LEFT JOIN change_candidate AS c
-                ON t.id = c.id
-              LEFT JOIN new_candidate AS n
-                ON t.id = n.id
-              WHERE c.id IS NOT NULL
-                OR n.id IS NOT NULL
-            ) AS s
-            WHERE camp_fin_candidate.id = s.id
+    @contextmanager
+    def openSource(self):
         '''
-
-        self.executeTransaction(update)
-
-    def addContactFullName(self):
-        update = '''
-            UPDATE camp_fin_contact SET
-              full_name = s.full_name
-            FROM (
-              SELECT
-                CASE WHEN
-                  company_name IS NULL OR TRIM(company_name) = ''
-                THEN
-                  TRIM(concat_ws(' ',
-                                 prefix,
-                                 first_name,
-                                 middle_name,
-                                 last_name,
-                                 suffix))
-                ELSE
-                  company_name
-                END AS full_name,
-                t.id
-              FROM camp_fin_contact AS t
-              LEFT JOIN change_contact AS c
-                ON t.id = c.id
-              LEFT JOIN new_contact AS n
-                ON t.id = n.id
-              WHERE c.id IS NOT NULL
-                OR n.id IS NOT NULL
-            ) AS s
-            WHERE camp_fin_contact.id = s.id
+        Open the source file as a stream of bytes, decompressing zip and gzip
+        files on the fly rather than extracting them to disk. XLSX files come
+        out as CSV.
         '''
+        if self.file_path.endswith('xlsx'):
+            rows = xlsx_rows(self.file_path, self.raw_pk_col)
 
-        self.executeTransaction(update)
-
-
-    def unzipFile(self):
-        file_name = self.file_path.split('/')[-1].rsplit('.', 1)[0]
-        file_name = '{}.csv'.format(file_name)
-        with zipfile.ZipFile(self.file_path) as zf:
-            zf.extract(file_name, path='data')
-
-        self.file_path = 'data/{}'.format(file_name)
-
-    def convertXLSX(self):
-        wb = load_workbook(self.file_path, read_only=True)
-        sheets = wb.worksheets
-        saved_pks = []
+            try:
+                yield IterStream(csv_chunks(rows))
+            finally:
+                rows.close()
 
-        header_row = next(sheets[0].rows)
-        header = [r.value for r in header_row]
+        elif self.file_path.endswith('zip'):
+            base_name = os.path.basename(self.file_path).rsplit('.', 1)[0]
+            member_name = '{}.csv'.format(base_name)
 
-        base_name = os.path.basename(self.file_path.rsplit('.', 1)[0])
-        csv_path = '{}.csv'.format(os.path.join('data', base_name))
+            with zipfile.ZipFile(self.file_path) as zf:
+                if member_name not in zf.namelist():
+                    member_name = zf.namelist()[0]
 
-        with open(csv_path, 'w') as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
+                with zf.open(member_name) as f:
+                    yield f
 
-            for sheet in sheets:
-                rows = sheet.rows
-                next(rows)  # Strip header row
-                for row in rows:
-                    row_values = [r.value for r in row]
-                    header_lower = [v.lower() for v in header]
+        elif self.file_path.endswith('gz'):
+            with gzip.open(self.file_path, 'rb') as f:
+                yield f
 
-                    row_dict = dict(zip(header_lower, row_values))
-                    row_pk = row_dict[self.raw_pk_col]
+        else:
+            with open(self.file_path, 'rb') as f:
+                yield f
 
-                    if row_pk not in saved_pks:
-                        writer.writerow(row_values)
-                        saved_pks.append(row_pk)
+    def reportProgress(self, bytes_read, elapsed):
+        megabytes = bytes_read / (1024 * 1024)
+        rate = megabytes / elapsed if elapsed else 0
 
-            self.file_path = csv_path
+        self.stdout.write('Read {0:.1f} MB from {1} ({2:.1f} MB/s)'.format(megabytes,
+                                                                          os.path.basename(self.file_path),
+                                                                          rate))
 
     def populateEntityTable(self):
         entities = '''
@@ -613,6 +1716,21 @@ class Command(BaseCommand):
 
         self.executeTransaction(entities)
 
+    def makeSlugFunction(self):
+        '''
+        Turn a name into the first part of a slug. This is immutable so that
+        it can be used in expression indexes. It lives in the public schema
+        even during shadow imports.
+        '''
+        slugify = '''
+            CREATE OR REPLACE FUNCTION public.slugify_name(name TEXT)
+            RETURNS TEXT AS $$
+              SELECT regexp_replace(TRANSLATE(REPLACE(LOWER(name), ' ', '-'), 'áàâãäåāăąÁÂÃÄÅĀĂĄèééêëēĕėęěĒĔĖĘĚìíîïìĩīĭÌÍÎÏÌĨĪĬóôõöōŏőÒÓÔÕÖŌŎŐùúûüũūŭůÙÚÛÜŨŪŬŮ','aaaaaaaaaaaaaaaaaeeeeeeeeeeeeeeeiiiiiiiiiiiiiiiiooooooooooooooouuuuuuuuuuuuuuuu'), '[^\\w -]', '', 'g')
+            $$ LANGUAGE sql IMMUTABLE
+        '''
+
+        self.executeTransaction(slugify)
+
     def populateSlugField(self):
         if self.entity_type in ['candidate', 'lobbyist']:
             name_components = [
@@ -631,64 +1749,97 @@ class Command(BaseCommand):
         elif self.entity_type in ['pac', 'organization']:
             name_select = 'name'
 
+        # Only touch records that are new, have changed, or never got a slug,
+        # and leave alone any whose slug would come out the same
         slugify = '''
             UPDATE {django_table} SET
               slug = s.slug
             FROM (
               SELECT
-                regexp_replace(TRANSLATE(REPLACE(LOWER({name_select}), ' ', '-'), 'áàâãäåāăąÁÂÃÄÅĀĂĄèééêëēĕėęěĒĔĖĘĚìíîïìĩīĭÌÍÎÏÌĨĪĬóôõöōŏőÒÓÔÕÖŌŎŐùúûüũūŭůÙÚÛÜŨŪŬŮ','aaaaaaaaaaaaaaaaaeeeeeeeeeeeeeeeiiiiiiiiiiiiiiiiooooooooooooooouuuuuuuuuuuuuuuu'), '[^\w -]', '', 'g') || '-' || id::varchar as slug,
-                id
-              FROM {django_table}
+                public.slugify_name({name_select}) || '-' || t.id::varchar AS slug,
+                t.id
+              FROM {django_table} AS t
+              LEFT JOIN change_{entity_type} AS c
+                ON t.id = c.id
+              LEFT JOIN new_{entity_type} AS n
+                ON t.id = n.id
+              WHERE c.id IS NOT NULL
+                OR n.id IS NOT NULL
+                OR t.slug IS NULL
             ) AS s
             WHERE {django_table}.id = s.id
+              AND {django_table}.slug IS DISTINCT FROM s.slug
         '''.format(django_table=self.django_table,
+                   entity_type=self.entity_type,
                    name_select=name_select)
 
         self.executeTransaction(slugify)
 
+    def rawValue(self, raw_col, mapping):
+        '''
+        SQL expression for the value of a mapped field, taken from the raw
+        table (aliased as `raw`).
+        '''
+        if mapping.get('expression'):
+            return '({})'.format(mapping['expression'].strip())
+
+        return 'raw."{}"'.format(raw_col)
+
     def addNewRecords(self):
 
-        select_fields = ', '.join(['raw."{0}"::{2} AS {1}'.format(k,v['field'], v['data_type']) for k,v in \
+        select_fields = ', '.join(['{0}::{2} AS {1}'.format(self.rawValue(k, v), v['field'], v['data_type']) for k,v in \
                                     self.table_mapper.items()])
 
         dat_fields = ', '.join([c['field'] for c in self.table_mapper.values()])
 
         insert_new = '''
             INSERT INTO {django_table} (
-              {dat_fields}
+              {dat_fields},
+              row_hash
             )
-              SELECT {select_fields}
+              SELECT {select_fields}, {row_hash}
               FROM raw_{entity_type} AS raw
               JOIN new_{entity_type} AS new
                 ON raw."{raw_pk_col}" = new.id
         '''.format(django_table=self.django_table,
                    dat_fields=dat_fields,
                    select_fields=select_fields,
+                   row_hash=self.rowHash(),
                    entity_type=self.entity_type,
                    raw_pk_col=self.raw_pk_col)
 
         self.executeTransaction(insert_new)
 
-    def updateExistingRecords(self):
-        changes = '''
-            CREATE TABLE change_{} (
-                id BIGINT,
-                PRIMARY KEY (id)
-            )
-        '''.format(self.entity_type)
+    def rowHash(self):
+        '''
+        SQL expression for a hash of all of the raw columns in a row, used to
+        tell whether it has changed since the last import.
+        '''
+        raw_fields = ', '.join(['raw."{}"'.format(k) for k, v in \
+                                  self.table_mapper.items() if not v.get('expression')])
 
-        self.executeTransaction('DROP TABLE IF EXISTS change_{}'.format(self.entity_type))
-        self.executeTransaction(changes)
+        return 'md5(ROW({})::text)'.format(raw_fields)
 
-        wheres = []
+    def addRowHashColumn(self):
+        add_column = '''
+            ALTER TABLE {} ADD COLUMN row_hash VARCHAR(32)
+        '''.format(self.django_table)
 
-        for raw_col, mapping in self.table_mapper.items():
-            condition = '''
-                ((raw."{0}" IS NOT NULL OR dat.{1} IS NOT NULL) AND raw."{0}"::{2} <> dat.{1})
-            '''.format(raw_col, mapping['field'], mapping['data_type'])
-            wheres.append(condition)
+        # This will fail once the column already exists, which is fine
+        self.executeTransaction(add_column, raise_exc=False)
+
+    def makeChangeTable(self):
+        create = '''
+            CREATE UNLOGGED TABLE change_{0} (
+                id BIGINT
+            )
+        '''.format(self.entity_type)
 
-        where_clause = ' OR '.join(wheres)
+        self.executeTransaction('DROP TABLE IF EXISTS change_{0}'.format(self.entity_type))
+        self.executeTransaction(create)
+
+    def updateExistingRecords(self):
+        self.makeChangeTable()
 
         find_changes = '''
             INSERT INTO change_{entity_type}
@@ -696,24 +1847,31 @@ class Command(BaseCommand):
               FROM raw_{entity_type} AS raw
               JOIN {django_table} AS dat
                 ON raw."{raw_pk_col}" = dat.id
-              WHERE {where_clause}
+              WHERE dat.row_hash IS DISTINCT FROM {row_hash}
         '''.format(entity_type=self.entity_type,
                    raw_pk_col=self.raw_pk_col,
                    django_table=self.django_table,
-                   where_clause=where_clause)
+                   row_hash=self.rowHash())
 
         self.executeTransaction(find_changes)
+        self.indexWorkTable('change_{}'.format(self.entity_type), 'id')
+
+        # Changed rows might be moving out of an aggregate bucket, so note
+        # where they were before the update
+        if self.entity_type in AGGREGATE_DEPENDENCIES:
+            self.markDirtyRows('change')
 
         set_fields = ', '.join(['{1}=s."{0}"::{2}'.format(k,v['field'], v['data_type']) for k,v in \
                                     self.table_mapper.items()])
 
-        raw_fields = ', '.join(['raw."{}"'.format(c) for c in \
-                                  self.table_mapper.keys()])
+        raw_fields = ', '.join(['{0} AS "{1}"'.format(self.rawValue(k, v), k) for k,v in \
+                                  self.table_mapper.items()])
         update_dat = '''
             UPDATE {django_table} SET
-              {set_fields}
+              {set_fields},
+              row_hash=s.row_hash
             FROM (
-              SELECT {raw_fields}
+              SELECT {raw_fields}, {row_hash} AS row_hash
               FROM raw_{entity_type} AS raw
               JOIN change_{entity_type} AS change
                 ON raw."{raw_pk_col}" = change.id
@@ -722,6 +1880,7 @@ class Command(BaseCommand):
         '''.format(django_table=self.django_table,
                    set_fields=set_fields,
                    raw_fields=raw_fields,
+                   row_hash=self.rowHash(),
                    entity_type=self.entity_type,
                    raw_pk_col=self.raw_pk_col)
 
@@ -745,15 +1904,15 @@ class Command(BaseCommand):
                    raw_pk_col=self.raw_pk_col)
 
         self.executeTransaction(find)
+        self.indexWorkTable('new_{}'.format(self.entity_type), 'id')
 
         new_count = self.connection.execute('SELECT COUNT(*) AS count FROM new_{}'.format(self.entity_type))
         return new_count.first().count
 
     def makeNewTable(self):
         create = '''
-            CREATE TABLE new_{0} (
-                id BIGINT,
-                PRIMARY KEY (id)
+            CREATE UNLOGGED TABLE new_{0} (
+                id BIGINT
             )
         '''.format(self.entity_type)
 
@@ -762,18 +1921,21 @@ class Command(BaseCommand):
 
     def makeRawTable(self):
 
-        with open(self.file_path, 'r', encoding=self.encoding) as f:
-            reader = csv.reader(f)
+        with self.openSource() as f:
+            reader = csv.reader(io.TextIOWrapper(f,
+                                                 encoding=self.encoding,
+                                                 newline=''))
             fields = next(reader)
 
+        self.raw_columns = [f.lower() for f in fields]
+
         fields = ', '.join(['"{}" VARCHAR'.format(f.lower()) for f in fields \
                                 if f.lower() != self.raw_pk_col])
 
         create_table = '''
-            CREATE TABLE raw_{0} (
+            CREATE UNLOGGED TABLE raw_{0} (
                 {1} BIGINT,
-                {2},
-                PRIMARY KEY ({1})
+                {2}
             )
         '''.format(self.entity_type,
                    self.raw_pk_col,
@@ -783,31 +1945,218 @@ class Command(BaseCommand):
         self.executeTransaction('DROP TABLE IF EXISTS raw_{0}'.format(self.entity_type))
         self.executeTransaction(create_table)
 
+        if self.tolerant:
+            self.makeStageTables()
+
+    def makeStageTables(self):
+        '''
+        Tolerant imports COPY into a staging table without any constraints or
+        types so that one bad row can't sink the whole file. Rows that don't
+        make it out of there end up in the quarantine table.
+        '''
+        fields = ', '.join(['"{}" VARCHAR'.format(f) for f in self.raw_columns])
+
+        for table in ['stage', 'quarantine']:
+            self.executeTransaction('DROP TABLE IF EXISTS {0}_{1}'.format(table, self.entity_type))
+
+        self.executeTransaction('''
+            CREATE UNLOGGED TABLE stage_{0} ({1})
+        '''.format(self.entity_type, fields))
+
+        self.executeTransaction('''
+            CREATE UNLOGGED TABLE quarantine_{0} (
+                {1},
+                reason VARCHAR
+            )
+        '''.format(self.entity_type, fields))
+
+    def makeCastCheckFunction(self):
+        '''
+        Check whether a value can be cast to a type (or a chain of casts like
+        the ones in the table mappers) without blowing up the query.
+        '''
+        is_castable = '''
+            CREATE OR REPLACE FUNCTION public.is_castable(value TEXT, data_type TEXT)
+            RETURNS BOOLEAN AS $$
+            BEGIN
+              EXECUTE format('SELECT %%L::%%s', value, data_type);
+              RETURN TRUE;
+            EXCEPTION WHEN others THEN
+              RETURN FALSE;
+            END;
+            $$ LANGUAGE plpgsql STABLE
+        '''
+
+        self.executeTransaction(is_castable)
+
+    def castCheck(self, raw_col, data_type):
+        '''
+        SQL for whether a column in the staging table can be cast to a type.
+        Values in one of the usual shapes for the type pass on a regex, and
+        only the rest go through is_castable, which has to try the cast in a
+        subtransaction of its own.
+        '''
+        pattern = CAST_PATTERNS.get(data_type)
+
+        if pattern is None:
+            return '''public.is_castable(s."{0}", '{1}')'''.format(raw_col, data_type)
+
+        return '''
+            CASE
+              WHEN s."{0}" ~* '{2}' THEN TRUE
+              ELSE public.is_castable(s."{0}", '{1}')
+            END
+        '''.format(raw_col, data_type, pattern)
+
+    def quarantineRows(self):
+        '''
+        Move the rows in the staging table that pass the checks into the raw
+        table and the rest into the quarantine table, in a single pass.
+
+        The reason is one of invalid_pk, invalid_<column> or duplicate_pk.
+        When a primary key shows up more than once, the first valid row wins.
+        '''
+        pk = self.raw_pk_col
+
+        checks = [
+            '''WHEN s."{0}" IS NULL OR NOT {1} THEN 'invalid_pk' '''.format(pk, self.castCheck(pk, 'bigint'))
+        ]
+
+        for raw_col, mapping in self.table_mapper.items():
+            if raw_col == pk or raw_col not in self.raw_columns \
+                    or mapping.get('expression') \
+                    or mapping['data_type'] in ['varchar', 'text']:
+                continue
+
+            checks.append('''
+                WHEN s."{0}" IS NOT NULL AND NOT {1} THEN 'invalid_{0}'
+            '''.format(raw_col, self.castCheck(raw_col, mapping['data_type'])))
+
+        columns = ', '.join(['"{}"'.format(c) for c in self.raw_columns])
+        raw_columns = ', '.join(['"{}"::BIGINT'.format(c) if c == pk else '"{}"'.format(c) \
+                                     for c in self.raw_columns])
+
+        quarantine = '''
+            WITH validated AS (
+              SELECT
+                {columns},
+                s.ctid AS source_row,
+                CASE {checks} END AS reason
+              FROM stage_{entity_type} AS s
+            ), checked AS (
+              SELECT
+                {columns},
+                CASE
+                  WHEN reason IS NULL AND row_number() OVER (
+                    PARTITION BY (CASE WHEN reason IS NULL THEN "{pk}"::BIGINT END)
+                    ORDER BY source_row
+                  ) > 1 THEN 'duplicate_pk'
+                  ELSE reason
+                END AS reason
+              FROM validated
+            ), quarantined AS (
+              INSERT INTO quarantine_{entity_type} ({columns}, reason)
+              SELECT {columns}, reason
+              FROM checked
+              WHERE reason IS NOT NULL
+            )
+            INSERT INTO raw_{entity_type} ({columns})
+            SELECT {raw_columns}
+            FROM checked
+            WHERE reason IS NULL
+        '''.format(columns=columns,
+                   raw_columns=raw_columns,
+                   checks=' '.join(checks),
+                   pk=pk,
+                   entity_type=self.entity_type)
+
+        self.executeTransaction(quarantine)
+        self.executeTransaction('DROP TABLE stage_{}'.format(self.entity_type))
+
+        quarantine_count = self.connection.execute('SELECT COUNT(*) AS count FROM quarantine_{}'.format(self.entity_type))
+
+        return quarantine_count.first().count
+
+    def reportQuarantine(self, entity_types):
+        self.stdout.write(self.style.SUCCESS('Quarantined records by entity type:'))
+
+        for entity_type in entity_types:
+            exists = self.connection.execute(sa.text('SELECT to_regclass(:table) AS t'),
+                                             table='quarantine_{}'.format(entity_type)).first().t
+
+            if not exists:
+                continue
+
+            reasons = self.connection.execute('''
+                SELECT reason, COUNT(*) AS count
+                FROM quarantine_{}
+                GROUP BY reason
+                ORDER BY reason
+            '''.format(entity_type))
+
+            reasons = ', '.join(['{0}: {1}'.format(r.reason, r.count) for r in reasons])
+
+            self.stdout.write('  {0}: {1}'.format(entity_type, reasons or 0))
+
     def importRawData(self):
 
         DB_CONN_STR = DB_CONN.format(**settings.DATABASES['default'])
 
+        target = 'stage' if self.tolerant else 'raw'
+
         copy_st = '''
-            COPY raw_{0} FROM STDIN WITH CSV HEADER
-        '''.format(self.entity_type)
+            COPY {0}_{1} FROM STDIN WITH CSV HEADER
+        '''.format(target, self.entity_type)
+
+        with self.openSource() as source:
+            progress = ProgressReader(source, self.reportProgress)
+
+            # UTF-8 can go straight to the database, anything else gets
+            # decoded here and sent along as UTF-8 by psycopg2
+            f = progress
+            if self.encoding != 'utf-8':
+                f = io.TextIOWrapper(progress,
+                                     encoding=self.encoding,
+                                     newline='')
 
-        with open(self.file_path, 'r', encoding=self.encoding) as f:
-            with psycopg2.connect(DB_CONN_STR) as conn:
+            connect_args = {}
+            if self.shadow:
+                connect_args['options'] = SHADOW_OPTIONS
+
+            with psycopg2.connect(DB_CONN_STR, **connect_args) as conn:
                 with conn.cursor() as curs:
-                    try:
-                        curs.copy_expert(copy_st, f)
-                    except psycopg2.IntegrityError as e:
-                        self.stderr.write(str(e))
-                        conn.rollback()
+                    curs.copy_expert(copy_st, f, size=64 * 1024)
 
-        self.executeTransaction('''
-            ALTER TABLE raw_{0} ADD PRIMARY KEY ("{1}")
-        '''.format(self.entity_type, self.raw_pk_col), raise_exc=False)
+            self.reportProgress(progress.bytes_read, progress.elapsed)
 
-        import_count = self.connection.execute('SELECT COUNT(*) AS count FROM raw_{}'.format(self.entity_type))
+        import_count = self.connection.execute('SELECT COUNT(*) AS count FROM {0}_{1}'.format(target, self.entity_type))
 
         return import_count.first().count
 
+    def indexRawTable(self):
+        '''
+        The raw table is loaded without a primary key so that COPY doesn't
+        have to maintain an index row by row. Build it in one go afterwards.
+        If the file has duplicate keys, nothing from it gets imported.
+        '''
+        try:
+            self.indexWorkTable('raw_{}'.format(self.entity_type), self.raw_pk_col)
+        except sa.exc.IntegrityError as e:
+            self.stderr.write(str(e.orig))
+            self.stderr.write('Rerun with --tolerant to quarantine the rows that failed')
+            self.executeTransaction('TRUNCATE raw_{}'.format(self.entity_type))
+
+    def indexWorkTable(self, table, column):
+        '''
+        Add the primary key to a freshly loaded work table and gather
+        statistics so that the diff queries that join on it get sensible plans.
+        '''
+        self.executeTransaction('''
+            ALTER TABLE {0} ADD PRIMARY KEY ("{1}")
+        '''.format(table, column))
+
+        self.executeTransaction('ANALYZE {}'.format(table))
+
     def executeTransaction(self, query, *args, **kwargs):
         trans = self.connection.begin()
 
@@ -826,3 +2175,6 @@ class Command(BaseCommand):
             trans.rollback()
             if raise_exc:
                 raise e
+        except sa.exc.DBAPIError:
+            trans.rollback()
+            raise
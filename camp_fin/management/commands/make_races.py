@@ -1,8 +1,9 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.conf import settings
 import sqlalchemy as sa
 
-from camp_fin.models import Campaign, Race
+from camp_fin.models import Race
 
 
 DB_CONN = 'postgresql://{USER}:{PASSWORD}@{HOST}:{PORT}/{NAME}'
@@ -22,6 +23,9 @@ UNIQUE_RACES_MAP = {
     'None': ['office', 'county', 'election_season']
 }
 
+# Every field that a race can be keyed on
+RACE_FIELDS = ['office', 'district', 'division', 'county', 'election_season']
+
 engine = sa.create_engine(DB_CONN.format(**settings.DATABASES['default']),
                           convert_unicode=True,
                           server_side_cursors=True)
@@ -56,52 +60,132 @@ class Command(BaseCommand):
 
             self.stdout.write(self.style.SUCCESS('Existing data deleted!'))
 
-        campaigns = Campaign.objects.all()
-
-        num_races = 0
-        num_campaigns = len(campaigns)
-
-        for campaign in campaigns:
-
-            if campaign.office.office_type:
-                unique_fields = UNIQUE_RACES_MAP[campaign.office.office_type.description]
-            else:
-                unique_fields = UNIQUE_RACES_MAP['None']
-
-            unique_kwargs = {field: getattr(campaign, field, None) for field in unique_fields}
+        with engine.connect() as conn:
+            with conn.begin():
+                conn.execute(self.campaignKeysQuery())
 
-            race, created = Race.objects.get_or_create(**unique_kwargs)
+                num_campaigns = conn.execute('''
+                    SELECT COUNT(*) AS count FROM campaign_race_keys
+                ''').first().count
 
-            kwargs = {
-                'office': campaign.office,
-                'office_type': campaign.office.office_type,
-                'division': campaign.division,
-                'district': campaign.district,
-                'county': campaign.county,
-                'election_season': campaign.election_season,
-            }
+                counts = conn.execute(self.upsertRacesQuery()).first()
 
-            rows_updated = Race.objects.filter(id=race.id).update(**kwargs)
+                conn.execute(self.assignRacesQuery())
 
-            assert rows_updated == 1
+                conn.execute('''
+                    UPDATE camp_fin_race AS race SET
+                      total_contributions = totals.total
+                    FROM ({}) AS totals
+                    WHERE race.id = totals.race_id
+                '''.format(Race.contribution_totals_query()))
 
-            if created:
-                num_races += 1
+        num_races = counts.created
 
-            campaign.active_race = race
-
-            # Set any missing race statuses to 'active'
-            if not campaign.race_status:
-                campaign.race_status = 'active'
-
-            campaign.save()
-
-        for race in Race.objects.all():
-
-            # Update total contributions
-            race.total_contributions = race.sum_campaign_contributions()
-            race.save()
+        # Nothing here goes through the ORM, so the cache doesn't get cleared
+        # on its own
+        call_command('clear_cache')
 
         msg = 'Created {num_races} races from {num_campaigns} campaigns!'
         self.stdout.write(self.style.SUCCESS(msg.format(num_races=num_races,
                                                         num_campaigns=num_campaigns)))
+
+    def campaignKeysQuery(self):
+        '''
+        Work out which of the race fields count towards each campaign's race,
+        based on the type of office that it's for.
+        '''
+        unique_fields = ', '.join(["('{0}', {1})".format(office_type,
+                                                        ', '.join(['TRUE' if f in fields else 'FALSE' \
+                                                                       for f in RACE_FIELDS])) \
+                                       for office_type, fields in UNIQUE_RACES_MAP.items()])
+
+        return '''
+            CREATE TEMP TABLE campaign_race_keys ON COMMIT DROP AS
+              SELECT
+                campaign.id AS campaign_id,
+                office.office_type_id,
+                {fields},
+                {uses}
+              FROM camp_fin_campaign AS campaign
+              JOIN camp_fin_office AS office
+                ON campaign.office_id = office.id
+              LEFT JOIN camp_fin_officetype AS office_type
+                ON office.office_type_id = office_type.id
+              JOIN (VALUES {unique_fields}) AS unique_fields (office_type, {flags})
+                ON COALESCE(office_type.description, 'None') = unique_fields.office_type
+        '''.format(fields=', '.join(['campaign.{}_id'.format(f) for f in RACE_FIELDS]),
+                   uses=', '.join(['unique_fields.uses_{}'.format(f) for f in RACE_FIELDS]),
+                   flags=', '.join(['uses_{}'.format(f) for f in RACE_FIELDS]),
+                   unique_fields=unique_fields)
+
+    def raceMatch(self):
+        '''
+        Match a race to a campaign in campaign_race_keys, only comparing the
+        fields that count for the campaign's type of office. Every type of
+        office is keyed on the office itself, which keeps this quick.
+        '''
+        match = ['race.office_id = keys.office_id']
+
+        for field in RACE_FIELDS:
+            match.append('''
+                (NOT keys.uses_{0} OR race.{0}_id IS NOT DISTINCT FROM keys.{0}_id)
+            '''.format(field))
+
+        return '''
+            SELECT MIN(race.id)
+            FROM camp_fin_race AS race
+            WHERE {}
+        '''.format(' AND '.join(match))
+
+    def upsertRacesQuery(self):
+        '''
+        Make one race for each group of campaigns that share the same key, or
+        update the race that's already there. Fields that aren't part of the
+        key come from the most recent campaign in the group.
+        '''
+        group_key = ', '.join(['keys.uses_{}'.format(f) for f in RACE_FIELDS] + \
+                              ['CASE WHEN keys.uses_{0} THEN keys.{0}_id END'.format(f) \
+                                   for f in RACE_FIELDS])
+
+        fields = ['office_type_id'] + ['{}_id'.format(f) for f in RACE_FIELDS]
+
+        return '''
+            WITH groups AS (
+              SELECT DISTINCT ON ({group_key})
+                keys.*,
+                ({race_match}) AS race_id
+              FROM campaign_race_keys AS keys
+              ORDER BY {group_key}, keys.campaign_id DESC
+            ), updated AS (
+              UPDATE camp_fin_race AS race SET
+                {set_fields}
+              FROM groups
+              WHERE race.id = groups.race_id
+              RETURNING race.id
+            ), created AS (
+              INSERT INTO camp_fin_race ({fields})
+              SELECT {fields}
+              FROM groups
+              WHERE race_id IS NULL
+              RETURNING id
+            )
+            SELECT
+              (SELECT COUNT(*) FROM created) AS created,
+              (SELECT COUNT(*) FROM updated) AS updated
+        '''.format(group_key=group_key,
+                   race_match=self.raceMatch(),
+                   set_fields=', '.join(['{0} = groups.{0}'.format(f) for f in fields]),
+                   fields=', '.join(fields))
+
+    def assignRacesQuery(self):
+        '''
+        Point every campaign at its race, and set any missing race statuses
+        to 'active'.
+        '''
+        return '''
+            UPDATE camp_fin_campaign AS campaign SET
+              active_race_id = ({race_match}),
+              race_status = COALESCE(NULLIF(campaign.race_status, ''), 'active')
+            FROM campaign_race_keys AS keys
+            WHERE campaign.id = keys.campaign_id
+        '''.format(race_match=self.raceMatch())
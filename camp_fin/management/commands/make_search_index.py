@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction, connection
 
+from camp_fin.search import build_search_documents
+
 class Command(BaseCommand):
     help = 'Create search index for New Mexico Campaign Finance data'
 
@@ -41,6 +43,7 @@ class Command(BaseCommand):
         self.makeLobbyistIndex()
         self.makeOrganizationIndex()
         self.makeLobbyistTransactionIndex()
+        self.makeSearchDocuments()
 
         self.stdout.write(self.style.SUCCESS('Worked'))
 
@@ -236,3 +239,13 @@ class Command(BaseCommand):
             ''')
 
             cursor.execute(self.create_trigger.format('organization', 'name'))
+
+    def makeSearchDocuments(self):
+        '''
+        Rebuild the search_document table, which holds a row for everything
+        that can be searched for with what the search page shows for it and a
+        weighted vector to rank matches with. Imports keep it up to date
+        between rebuilds.
+        '''
+        with transaction.atomic():
+            build_search_documents(connection.cursor())
@@ -1,5 +1,27 @@
 from collections import OrderedDict
 
+# Some fields don't come straight out of a single raw column. These are
+# mapped with an `expression` that computes them from the raw row (aliased
+# as `raw`) while it is being inserted or updated.
+FULL_NAME = '''
+    TRIM(concat_ws(' ',
+                   raw.prefix,
+                   raw.firstname,
+                   raw.middlename,
+                   raw.lastname,
+                   raw.suffix))
+'''
+
+FULL_NAME_OR_COMPANY = '''
+    CASE WHEN
+      raw.companyname IS NULL OR TRIM(raw.companyname) = ''
+    THEN
+      {}
+    ELSE
+      raw.companyname
+    END
+'''.format(FULL_NAME)
+
 CANDIDATE = OrderedDict([
     ('candidateid', {'field': 'id', 'data_type': 'bigint'}),
     ('entityid', {'field': 'entity_id', 'data_type': 'bigint'}),
@@ -18,6 +40,7 @@ CANDIDATE = OrderedDict([
     ('datelastupdated', {'field': 'date_updated', 'data_type': 'timestamp with time zone'}),
     ('qualcandidateid', {'field': 'qual_candidate_id', 'data_type': 'bigint'}),
     ('deceased', {'field': 'deceased', 'data_type': 'varchar'}),
+    ('full_name', {'field': 'full_name', 'data_type': 'varchar', 'expression': FULL_NAME}),
 ])
 
 PAC = OrderedDict([
@@ -122,6 +145,7 @@ CONTRIB_EXP = OrderedDict([
     ("contacttypeother",{'field': 'contact_type_other', 'data_type': 'varchar'}),
     ("occupation",{'field': 'occupation', 'data_type': 'varchar'}),
     ("isexpenditureforcertifiedcandidate",{'field': 'expenditure_for_certified_candidate', 'data_type': 'boolean'}),
+    ('full_name', {'field': 'full_name', 'data_type': 'varchar', 'expression': FULL_NAME_OR_COMPANY}),
 ])
 
 CONTRIB_EXP_TYPE = OrderedDict([
@@ -261,6 +285,7 @@ LOAN = OrderedDict([
     ("interestrate",{'field': 'interest_rate', 'data_type': 'double precision'}),
     ("duedate",{'field': 'due_date', 'data_type': 'timestamp with time zone'}),
     ("paymentscheduleid",{'field': 'payment_schedule_id', 'data_type': 'bigint'}),
+    ('full_name', {'field': 'full_name', 'data_type': 'varchar', 'expression': FULL_NAME_OR_COMPANY}),
 ])
 
 LOAN_TRANSACTION = OrderedDict([
@@ -327,6 +352,7 @@ TREASURER = OrderedDict([
     ('dateadded', {'field': 'date_added', 'data_type': 'timestamp with time zone'}),
     ('statusid', {'field': 'status_id', 'data_type': 'bigint'}),
     ('olddbentityid', {'field': 'olddb_entity_id', 'data_type': 'bigint'}),
+    ('full_name', {'field': 'full_name', 'data_type': 'varchar', 'expression': FULL_NAME}),
 ])
 
 ADDRESS = OrderedDict([
@@ -366,7 +392,7 @@ CONTACT = OrderedDict([
     ('entityid', {'field': 'entity_id', 'data_type': 'bigint'}),
     ('fromfileid', {'field': 'from_file_id', 'data_type': 'bigint'}),
     ('occupation', {'field': 'occupation', 'data_type': 'varchar'}),
-    
+    ('full_name', {'field': 'full_name', 'data_type': 'varchar', 'expression': FULL_NAME_OR_COMPANY}),
 ])
 
 LOBBYIST = OrderedDict([
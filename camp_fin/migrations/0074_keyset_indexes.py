@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camp_fin', '0073_auto_20181102_1259'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='loantransaction',
+            index=models.Index(fields=['transaction_date', 'id'], name='camp_fin_loantx_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loantransaction',
+            index=models.Index(fields=['amount', 'id'], name='camp_fin_loantx_amount_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['received_date', 'id'], name='camp_fin_tx_received_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['amount', 'id'], name='camp_fin_tx_amount_id_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def make_search_documents(apps, schema_editor):
+    from camp_fin.search import build_search_documents
+
+    connection = schema_editor.connection
+
+    # make_search_index might have made the table already
+    if 'search_document' in connection.introspection.table_names():
+        return
+
+    with connection.cursor() as cursor:
+        build_search_documents(cursor)
+
+
+def drop_search_documents(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS search_document')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camp_fin', '0074_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(make_search_documents, drop_search_documents),
+    ]
@@ -1,14 +1,22 @@
 from collections import namedtuple
 from datetime import datetime, timedelta
 
-from django.db import models, connection
-from dateutil.rrule import rrule, MONTHLY
+from django.db import models, connection, transaction, ProgrammingError
+from django.db.models.expressions import RawSQL
+import numpy as np
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import ugettext as _
 
 from camp_fin.templatetags.helpers import format_money
 from camp_fin.decorators import check_date_params
 
+# Entity profiles are keyed on the latest import, so they can stick around
+# until the next one
+ETL_GENERATION_KEY = 'etl-generation'
+ETL_GENERATION_TIMEOUT = 60
+PROFILE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
 class Candidate(models.Model):
     entity = models.ForeignKey("Entity", db_constraint=False)
     prefix = models.CharField(max_length=10, null=True)
@@ -144,6 +152,12 @@ class Campaign(models.Model):
         Accepts optional filter argument `since` with the same requirements as
         all other methods on this class.
         '''
+        # Races can load the funds for all of their campaigns in one go
+        loaded_funds = getattr(self, '_loaded_funds', {})
+
+        if since in loaded_funds:
+            return loaded_funds[since]
+
         # Campaigns should always have candidates, but there are occasionally
         # errors in the SOS's system. Fail gracefully by returning 0 in this
         # case, since we can't link contributions to this campaign
@@ -330,8 +344,10 @@ class Race(models.Model):
         Return all campaigns involved in this race, in reverse order of how much
         money they've raised.
         '''
+        funds = self.campaign_funds()
+
         return sorted([camp for camp in self.campaigns],
-                      key=lambda camp: camp.funds_raised(since=self.funding_period),
+                      key=lambda camp: funds.get(camp.id, 0),
                       reverse=True)
 
     @property
@@ -339,8 +355,10 @@ class Race(models.Model):
         '''
         Campaigns that are still active in this race.
         '''
+        funds = self.campaign_funds()
+
         return sorted([camp for camp in self.campaigns if camp.get_status() == 'active'],
-                      key=lambda camp: camp.funds_raised(since=self.funding_period),
+                      key=lambda camp: funds.get(camp.id, 0),
                       reverse=True)
 
     @property
@@ -348,8 +366,10 @@ class Race(models.Model):
         '''
         Campaigns that have dropped out of this race, sorted by funds raised.
         '''
+        funds = self.campaign_funds()
+
         return sorted([camp for camp in self.campaigns if camp.get_status() != 'active'],
-                      key=lambda camp: camp.funds_raised(since=self.funding_period),
+                      key=lambda camp: funds.get(camp.id, 0),
                       reverse=True)
 
     @property
@@ -357,6 +377,9 @@ class Race(models.Model):
         '''
         Return the number of candidates involved in this race.
         '''
+        if hasattr(self, 'candidate_count'):
+            return self.candidate_count
+
         return self.campaigns.count()
 
     @property
@@ -365,7 +388,7 @@ class Race(models.Model):
         Return the amount of funds raised for the largest campaign in this race.
         '''
         if self.num_candidates > 0:
-            return self.sorted_campaigns[0].funds_raised(since=self.funding_period)
+            return self.campaign_funds().get(self.sorted_campaigns[0].id, 0)
         else:
             return 0
 
@@ -394,12 +417,176 @@ class Race(models.Model):
         '''
         return sum(campaign.funds_raised(since=self.funding_period) for campaign in self.campaigns)
 
+    @staticmethod
+    def contribution_totals_query(filtered=False):
+        '''
+        SQL for the sum of contributions to the campaigns in every race since
+        the start of its funding period, with one row per race. If `filtered`,
+        the query takes a list of race IDs as a parameter.
+        '''
+        query = '''
+            SELECT
+              race.id AS race_id,
+              COALESCE(SUM(contributions.amount), 0) AS total
+            FROM camp_fin_race AS race
+            LEFT JOIN camp_fin_electionseason AS season
+              ON race.election_season_id = season.id
+            LEFT JOIN camp_fin_campaign AS campaign
+              ON campaign.active_race_id = race.id
+            LEFT JOIN camp_fin_candidate AS candidate
+              ON campaign.candidate_id = candidate.id
+            LEFT JOIN contributions_by_month AS contributions
+              ON contributions.entity_id = candidate.entity_id
+              AND (COALESCE(season.year, '') = ''
+                   OR contributions.month >= ((season.year::int - 1) || '-01-01')::date)
+            {where}
+            GROUP BY race.id
+        '''
+
+        if filtered:
+            return query.format(where='WHERE race.id = ANY(%s)')
+
+        return query.format(where='')
+
+    @classmethod
+    def contribution_totals(cls, race_ids=None):
+        '''
+        Sum contributions for a batch of races (or every race) in one query.
+        Returns a dict mapping race IDs to totals, matching what
+        `sum_campaign_contributions` gives for each race.
+        '''
+        cursor = connection.cursor()
+
+        if race_ids is None:
+            cursor.execute(cls.contribution_totals_query())
+        else:
+            cursor.execute(cls.contribution_totals_query(filtered=True),
+                           [list(race_ids)])
+
+        return dict(cursor.fetchall())
+
+    @staticmethod
+    def with_totals(queryset):
+        '''
+        Annotate a queryset of races with `candidate_count` and `funds_total`,
+        the values of `num_candidates` and `total_funds`, so that races can be
+        sorted and paginated on them in SQL. Both are correlated subqueries
+        so that the queryset doesn't pick up a GROUP BY.
+        '''
+        candidate_count = '''
+            SELECT COUNT(*)
+            FROM camp_fin_campaign AS campaign
+            WHERE campaign.active_race_id = camp_fin_race.id
+        '''
+
+        funds_total = '''
+            COALESCE(camp_fin_race.total_contributions, (
+              SELECT COALESCE(SUM(contributions.amount), 0)
+              FROM camp_fin_campaign AS campaign
+              JOIN camp_fin_candidate AS candidate
+                ON campaign.candidate_id = candidate.id
+              JOIN contributions_by_month AS contributions
+                ON contributions.entity_id = candidate.entity_id
+              LEFT JOIN camp_fin_electionseason AS season
+                ON season.id = camp_fin_race.election_season_id
+              WHERE campaign.active_race_id = camp_fin_race.id
+                AND (COALESCE(season.year, '') = ''
+                     OR contributions.month >= ((season.year::int - 1) || '-01-01')::date)
+            ))
+        '''
+
+        return queryset.annotate(candidate_count=RawSQL(candidate_count, []),
+                                 funds_total=RawSQL(funds_total, []))
+
+    def since(self, years_back):
+        '''
+        The year `years_back` years before this race, in the format that the
+        `since` argument to Campaign.funds_raised expects.
+        '''
+        if self.year:
+            return str(int(self.year) - years_back)
+        else:
+            return None
+
+    def campaign_funds(self, years_back=1):
+        '''
+        Return a dict mapping the campaigns in this race to the funds that
+        they have raised since `years_back` years before the race. The default
+        of 1 is the race's funding period. Funds get loaded with one query the
+        first time they are needed, unless `load_campaign_funds` got to them
+        first.
+        '''
+        since = self.since(years_back)
+
+        if since not in getattr(self, '_campaign_funds', {}):
+            Race.load_campaign_funds([self], years_back=years_back)
+
+        return self._campaign_funds[since]
+
+    @classmethod
+    def load_campaign_funds(cls, races, years_back=1):
+        '''
+        Load the funds raised by every campaign in a batch of races with a
+        single query. The campaigns that the races have prefetched get them
+        too, so that `funds_raised` doesn't need to go back to the database.
+        '''
+        races = list(races)
+
+        if not races:
+            return
+
+        funds_query = '''
+            SELECT
+              race.race_id,
+              campaign.id,
+              COALESCE(SUM(contributions.amount), 0) AS funds
+            FROM unnest(%s::int[], %s::text[]) AS race (race_id, since)
+            JOIN camp_fin_campaign AS campaign
+              ON campaign.active_race_id = race.race_id
+            LEFT JOIN camp_fin_candidate AS candidate
+              ON campaign.candidate_id = candidate.id
+            LEFT JOIN contributions_by_month AS contributions
+              ON contributions.entity_id = candidate.entity_id
+              AND (race.since IS NULL
+                   OR contributions.month >= (race.since || '-01-01')::date)
+            GROUP BY race.race_id, campaign.id
+        '''
+
+        cursor = connection.cursor()
+        cursor.execute(funds_query, [[race.id for race in races],
+                                     [race.since(years_back) for race in races]])
+
+        funds = {race.id: {} for race in races}
+
+        for race_id, campaign_id, amount in cursor:
+            funds[race_id][campaign_id] = amount
+
+        for race in races:
+            since = race.since(years_back)
+
+            if not hasattr(race, '_campaign_funds'):
+                race._campaign_funds = {}
+
+            race._campaign_funds[since] = funds[race.id]
+
+            prefetched = getattr(race, '_prefetched_objects_cache', {})
+
+            if race.campaign_set.field.related_query_name() in prefetched:
+                for campaign in race.campaigns:
+                    if not hasattr(campaign, '_loaded_funds'):
+                        campaign._loaded_funds = {}
+
+                    campaign._loaded_funds[since] = funds[race.id].get(campaign.id, 0)
+
     @property
     def total_funds(self):
         '''
         Return the total amount of money raised in this race, aggreggated from
         the total contributions to each campaign during the election season.
         '''
+        if hasattr(self, 'funds_total'):
+            return self.funds_total
+
         # Default to the attribute that should be aggregated during the `make_races`
         # management command
         if self.total_contributions is not None:
@@ -413,24 +600,30 @@ class Race(models.Model):
         '''
         Return a list of campaigns in this race, organized by party.
         '''
+        race_campaigns = [(camp, getattr(camp.political_party, 'name', None)) \
+                              for camp in self.campaigns]
+
         campaigns = [
-            ('democrat', self.campaign_set.filter(political_party__name='Democrat')),
-            ('republican', self.campaign_set.filter(political_party__name='Republican')),
-            ('other', self.campaign_set.exclude(political_party__name__in=['Democrat', 'Republican']))
+            ('democrat', [camp for camp, party in race_campaigns if party == 'Democrat']),
+            ('republican', [camp for camp, party in race_campaigns if party == 'Republican']),
+            ('other', [camp for camp, party in race_campaigns \
+                           if party not in ['Democrat', 'Republican']])
         ]
 
-        biggest_party = max(queryset.count() for party, queryset in campaigns)
+        biggest_party = max(len(party_campaigns) for party, party_campaigns in campaigns)
+
+        funds = self.campaign_funds(years_back=0)
 
         campaign_list = []
-        for party, queryset in campaigns:
-            if queryset.count() > 0:
+        for party, party_campaigns in campaigns:
+            if len(party_campaigns) > 0:
                 # Sort campaigns by funds raised
-                formatted_campaigns = sorted([campaign for campaign in queryset],
-                                             key=lambda camp: camp.funds_raised(since=self.year),
+                formatted_campaigns = sorted(party_campaigns,
+                                             key=lambda camp: funds.get(camp.id, 0),
                                              reverse=True)
-                if queryset.count() < biggest_party:
+                if len(party_campaigns) < biggest_party:
                     # Add empty campaigns so that the table rows will line up
-                    formatted_campaigns += [{} for missing in range(biggest_party - queryset.count())]
+                    formatted_campaigns += [{} for missing in range(biggest_party - len(party_campaigns))]
 
                 campaign_list.append((party, formatted_campaigns))
 
@@ -512,6 +705,13 @@ class Transaction(models.Model):
 
     full_name = models.CharField(max_length=500, null=True)
 
+    class Meta:
+        # Keys for paging through transactions with a cursor
+        indexes = [
+            models.Index(fields=['received_date', 'id'], name='camp_fin_tx_received_id_idx'),
+            models.Index(fields=['amount', 'id'], name='camp_fin_tx_amount_id_idx'),
+        ]
+
     def __str__(self):
         return self.full_name
 
@@ -617,6 +817,13 @@ class LoanTransaction(models.Model):
     filing = models.ForeignKey('Filing', db_constraint=False)
     from_file_id = models.IntegerField(null=True)
 
+    class Meta:
+        # Keys for paging through loan transactions with a cursor
+        indexes = [
+            models.Index(fields=['transaction_date', 'id'], name='camp_fin_loantx_date_id_idx'),
+            models.Index(fields=['amount', 'id'], name='camp_fin_loantx_amount_id_idx'),
+        ]
+
     def __str__(self):
         return '{0} {1}'.format(self.transaction_type,
                                 format_money(self.amount))
@@ -811,6 +1018,54 @@ class ElectionSeason(models.Model):
     def __str__(self):
         return 'Election year {}'.format(self.year)
 
+def monthly_trends(since, end_month, contributions, expenditures):
+    '''
+    Build the stacked donation and expenditure series for `Entity.trends`.
+    Every month from the start of `since` through `end_month` is a step of two
+    points, at the start of the month before and the start of the month,
+    with the amount for that month (or 0 when there wasn't one). Amounts keep
+    whatever type the database gave them.
+    '''
+    start = np.datetime64('{}-01'.format(since), 'M')
+    months = np.arange(start, np.datetime64(end_month, 'M') + 1)
+
+    def month_parts(months):
+        month_numbers = months.astype(int)
+        return np.column_stack([month_numbers // 12 + 1970,
+                                month_numbers % 12 + 1,
+                                np.ones(len(months), dtype=int)])
+
+    begin_parts = month_parts(months - 1)
+    end_parts = month_parts(months)
+
+    def rates(rows):
+        filled = np.zeros(len(months), dtype=object)
+
+        if rows:
+            days = np.array([r.month.date() for r in rows], dtype='datetime64[D]')
+            amounts = np.array([r.amount for r in rows], dtype=object)
+
+            # Only amounts dated on the first of a month in range have a slot
+            index = (days.astype('datetime64[M]') - start).astype(int)
+            in_range = (days == days.astype('datetime64[M]').astype('datetime64[D]')) \
+                & (index >= 0) & (index < len(months))
+
+            filled[index[in_range]] = amounts[in_range]
+
+        return filled
+
+    def steps(rates):
+        points = np.empty((2 * len(months), 4), dtype=object)
+        points[0::2, 0] = rates
+        points[1::2, 0] = rates
+        points[0::2, 1:] = begin_parts
+        points[1::2, 1:] = end_parts
+
+        return points.tolist()
+
+    return steps(rates(contributions)), steps(-1 * rates(expenditures))
+
+
 class Entity(models.Model):
     user_id = models.IntegerField(null=True)
     entity_type = models.ForeignKey('EntityType', db_constraint=False, null=True)
@@ -825,54 +1080,22 @@ class Entity(models.Model):
         Generate a dict of filing trends for use in contribution/expenditure charts
         for this Entity.
         '''
-        def stack_trends(trend):
-            '''
-            Private helper method for compiling trends.
-            '''
-            stacked_trend = []
-            for begin, end, rate in trend:
-                if not stacked_trend:
-                    stacked_trend.append((rate, begin))
-                    stacked_trend.append((rate, end))
-
-                elif begin == stacked_trend[-1][1]:
-                    stacked_trend.append((rate, begin))
-                    stacked_trend.append((rate, end))
-
-                elif begin > stacked_trend[-1][1]:
-                    previous_rate, previous_end = stacked_trend[-1]
-                    stacked_trend.append((previous_rate, begin))
-                    stacked_trend.append((rate, begin))
-                    stacked_trend.append((rate, end))
-
-                elif begin < stacked_trend[-1][1]:
-                    previous_rate, previous_end = stacked_trend.pop()
-                    stacked_trend.append((previous_rate, begin))
-                    stacked_trend.append((rate + previous_rate, begin))
-
-                    if end < previous_end:
-                        stacked_trend.append((rate + previous_rate, end))
-                        stacked_trend.append((previous_rate, end))
-                        stacked_trend.append((previous_rate, previous_end))
-
-                    elif end > previous_end:
-                        stacked_trend.append((rate + previous_rate, previous_end))
-                        stacked_trend.append((rate, previous_end))
-                        stacked_trend.append((rate, end))
-                    else:
-                        stacked_trend.append((rate + previous_rate, end))
-
-            flattened_trend = []
-
-            for i, point in enumerate(stacked_trend):
-                rate, date = point
-                flattened_trend.append([rate, *date])
-
-            return flattened_trend
+        return Entity.trends_for([self.id], since=since)[self.id]
+
+    @classmethod
+    @check_date_params
+    def trends_for(cls, entity_ids, since='2010'):
+        '''
+        Generate filing trends for a batch of Entities at once, in three
+        queries no matter how many there are. Returns a dict mapping each
+        Entity ID to the same dict that `trends` gives for it.
+        '''
+        entity_ids = list(entity_ids)
 
         # Balances and debts
         summed_filings = '''
             SELECT
+              f.entity_id,
               SUM(f.total_contributions) + \
                 SUM(COALESCE(f.total_supplemental_contributions, 0)) AS total_contributions,
               SUM(f.total_expenditures) AS total_expenditures,
@@ -886,23 +1109,79 @@ class Entity(models.Model):
             FROM camp_fin_filing AS f
             JOIN camp_fin_filingperiod AS fp
               ON f.filing_period_id = fp.id
-            WHERE f.entity_id = %s
+            WHERE f.entity_id = ANY(%s)
               AND fp.exclude_from_cascading = FALSE
               AND fp.regular_filing_period_id IS NULL
               AND fp.filing_date >= '{year}-01-01'
-            GROUP BY fp.filing_date
-            ORDER BY fp.filing_date
+            GROUP BY f.entity_id, fp.filing_date
+            ORDER BY f.entity_id, fp.filing_date
         '''.format(year=since)
 
         cursor = connection.cursor()
 
-        cursor.execute(summed_filings, [self.id])
+        cursor.execute(summed_filings, [entity_ids])
 
         columns = [c[0] for c in cursor.description]
         filing_tuple = namedtuple('Filings', columns)
 
-        summed_filings = [filing_tuple(*r) for r in cursor]
+        filings = {entity_id: [] for entity_id in entity_ids}
+
+        for row in cursor:
+            filing = filing_tuple(*row)
+            filings[filing.entity_id].append(filing)
+
+        # Donations and expenditures
+        monthly_query = '''
+            SELECT
+              'contributions' AS kind,
+              contributions.entity_id,
+              contributions.amount,
+              contributions.month
+            FROM contributions_by_month AS contributions
+            WHERE contributions.entity_id = ANY(%s)
+              AND contributions.month >= '{year}-01-01'::date
+            UNION ALL
+            SELECT
+              'expenditures' AS kind,
+              expenditures.entity_id,
+              expenditures.amount,
+              expenditures.month
+            FROM expenditures_by_month AS expenditures
+            WHERE expenditures.entity_id = ANY(%s)
+              AND expenditures.month >= '{year}-01-01'::date
+            ORDER BY month
+        '''.format(year=since)
+
+        cursor.execute(monthly_query, [entity_ids, entity_ids])
 
+        columns = [c[0] for c in cursor.description]
+        amount_tuple = namedtuple('Amount', columns)
+
+        monthly = {(kind, entity_id): [] for kind in ('contributions', 'expenditures') \
+                                            for entity_id in entity_ids}
+
+        for row in cursor:
+            amount = amount_tuple(*row)
+            monthly[(amount.kind, amount.entity_id)].append(amount)
+
+        end_month = None
+
+        if any(monthly.values()):
+            end_month = FilingPeriod.objects.order_by('-filing_date').first().filing_date.date()
+
+        return {entity_id: cls.build_trends(since,
+                                            filings[entity_id],
+                                            monthly[('contributions', entity_id)],
+                                            monthly[('expenditures', entity_id)],
+                                            end_month) \
+                    for entity_id in entity_ids}
+
+    @staticmethod
+    def build_trends(since, summed_filings, contributions, expenditures, end_month):
+        '''
+        Turn the summed filings and monthly amounts for one Entity into the
+        trends that `trends` returns.
+        '''
         balance_trend, debt_trend = [], []
 
         if summed_filings:
@@ -944,78 +1223,178 @@ class Entity(models.Model):
             'debt_trend': debt_trend
         }
 
-        # Donations and expenditures
-        monthly_query = '''
-            SELECT
-              {table}.amount AS amount,
-              {table}.month AS month
-            FROM {table}_by_month AS {table}
-            WHERE {table}.entity_id = %s
-              AND {table}.month >= '{year}-01-01'::date
-            ORDER BY month
+        donation_trend, expend_trend = [], []
+
+        if contributions or expenditures:
+
+            donation_trend, expend_trend = monthly_trends(since,
+                                                          end_month,
+                                                          contributions,
+                                                          expenditures)
+
+        output_trends['donation_trend'] = donation_trend
+        output_trends['expend_trend'] = expend_trend
+
+        return output_trends
+
+    @staticmethod
+    def etl_generation(refresh=False):
+        '''
+        The ID of the latest row in `etl_tracker`, which changes whenever
+        import_data loads new data or rebuilds the rollups. It's cached for a
+        minute so that a page view doesn't need to ask the database for it.
+        Pass `refresh` to skip the cache.
         '''
+        generation = None if refresh else cache.get(ETL_GENERATION_KEY)
 
-        contributions_query = monthly_query.format(table='contributions', year=since)
-        expenditures_query = monthly_query.format(table='expenditures', year=since)
+        if generation is None:
+            try:
+                with transaction.atomic():
+                    cursor = connection.cursor()
+                    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM etl_tracker')
+                    generation = cursor.fetchone()[0]
+            except ProgrammingError:
+                # Nothing has been imported yet
+                generation = 0
 
-        cursor.execute(contributions_query, [self.id])
+            cache.set(ETL_GENERATION_KEY, generation, ETL_GENERATION_TIMEOUT)
 
-        columns = [c[0] for c in cursor.description]
-        amount_tuple = namedtuple('Amount', columns)
+        return generation
 
-        contributions = [amount_tuple(*r) for r in cursor]
+    @staticmethod
+    def profile_cache_key(entity_id, generation):
+        return 'entity-profile:{0}:{1}'.format(generation, entity_id)
 
-        cursor.execute(expenditures_query, [self.id])
+    @classmethod
+    def profile_for(cls, entity_id):
+        '''
+        The financial profile of an Entity (see `profiles_for`), from the
+        cache if it has been built since the last import.
+        '''
+        key = cls.profile_cache_key(entity_id, cls.etl_generation())
 
-        columns = [c[0] for c in cursor.description]
-        amount_tuple = namedtuple('Amount', columns)
+        profile = cache.get(key)
 
-        expenditures = [amount_tuple(*r) for r in cursor]
+        if profile is None:
+            profile = cls.profiles_for([entity_id])[entity_id]
+            cache.set(key, profile, PROFILE_CACHE_TIMEOUT)
 
-        donation_trend, expend_trend = [], []
+        return profile
 
-        if contributions or expenditures:
+    @classmethod
+    def profiles_for(cls, entity_ids):
+        '''
+        Build the financial profiles that candidate and committee detail pages
+        show for a batch of Entities. Each one is a dict with the filing
+        trends since the year of the Entity's first contribution or
+        expenditure (no earlier than 2010), its latest filing, donations net
+        of loans and in-kind contributions, and its open loans.
+        '''
+        entity_ids = list(entity_ids)
+
+        # Determine the date of the first contribution/expenditure
+        min_date_query = '''
+            WITH all_cash AS (
+                SELECT entity_id, month
+                FROM contributions_by_month
+                WHERE entity_id = ANY(%s)
+                UNION
+                SELECT entity_id, month
+                FROM expenditures_by_month
+                WHERE entity_id = ANY(%s)
+              )
+            SELECT entity_id, MIN(all_cash.month::date)
+            FROM all_cash
+            GROUP BY entity_id
+        '''
 
-            contributions_lookup = {r.month.date(): r.amount for r in contributions}
-            expenditures_lookup = {r.month.date(): r.amount for r in expenditures}
+        cursor = connection.cursor()
 
-            all_months = list(contributions_lookup.keys()) + list(expenditures_lookup.keys())
+        cursor.execute(min_date_query, [entity_ids, entity_ids])
 
-            start_month = datetime(int(since), 1, 1)
-            end_month = FilingPeriod.objects.order_by('-filing_date').first().filing_date.date()
+        first_years = {entity_id: min_date.year for entity_id, min_date in cursor}
 
-            for month in rrule(freq=MONTHLY, dtstart=start_month, until=end_month):
+        by_year = {}
 
-                replacements = {'month': month.month - 1}
+        for entity_id in entity_ids:
+            year = first_years.get(entity_id, 2010)
+            year = str(year) if year > 2010 else '2010'
 
-                if replacements['month'] < 1:
-                    replacements['month'] = 12
-                    replacements['year'] = month.year - 1
+            by_year.setdefault(year, []).append(entity_id)
 
-                begin_date = month.replace(**replacements)
+        profiles = {}
 
-                begin_date_array = [begin_date.year,
-                                    begin_date.month,
-                                    begin_date.day]
+        for year, year_entity_ids in by_year.items():
+            for entity_id, trends in cls.trends_for(year_entity_ids, since=year).items():
+                profiles[entity_id] = dict(trends,
+                                           since=year,
+                                           latest_filing=None,
+                                           donations=None,
+                                           loans=[])
 
-                end_date_array = [month.year,
-                                  month.month,
-                                  month.day]
+        latest_filings = Filing.objects.filter(entity_id__in=entity_ids,
+                                               filing_period__exclude_from_cascading=False)\
+                                       .exclude(final__isnull=True)\
+                                       .select_related('filing_period',
+                                                       'campaign__election_season',
+                                                       'campaign__office__office_type')\
+                                       .order_by('entity_id', '-date_added')\
+                                       .distinct('entity_id')
 
-                contribution_amount = contributions_lookup.get(month.date(), 0)
-                expenditure_amount = expenditures_lookup.get(month.date(), 0)
+        for latest_filing in latest_filings:
+            profile = profiles[latest_filing.entity_id]
+            profile['latest_filing'] = latest_filing
 
-                donation_trend.append([begin_date_array, end_date_array, contribution_amount])
-                expend_trend.append([begin_date_array, end_date_array, (-1 * expenditure_amount)])
+            total_loans = latest_filing.total_loans or 0
+            total_inkind = latest_filing.total_inkind or 0
 
-            donation_trend = stack_trends(donation_trend)
-            expend_trend = stack_trends(expend_trend)
+            # Count pure donations, if applicable
+            if total_loans > 0 or total_inkind > 0:
+                profile['donations'] = latest_filing.total_contributions - (total_loans +
+                                                                            total_inkind)
 
-        output_trends['donation_trend'] = donation_trend
-        output_trends['expend_trend'] = expend_trend
+        current_loans = '''
+            SELECT
+              f.entity_id AS filing_entity_id,
+              loan.*,
+              status.*
+            FROM camp_fin_filing AS f
+            JOIN camp_fin_loan AS loan
+              ON f.id = loan.filing_id
+            JOIN current_loan_status AS status
+              ON loan.id = status.loan_id
+            WHERE f.entity_id = ANY(%s)
+        '''
 
-        return output_trends
+        cursor.execute(current_loans, [entity_ids])
+
+        columns = [c[0] for c in cursor.description]
+
+        for row in cursor:
+            loan = dict(zip(columns, row))
+            profiles[loan.pop('filing_entity_id')]['loans'].append(loan)
+
+        return profiles
+
+    @classmethod
+    def warm_profiles(cls, batch_size=500):
+        '''
+        Build and cache the profiles of every candidate and PAC for the
+        current import, a batch at a time. Returns how many were cached.
+        '''
+        generation = cls.etl_generation(refresh=True)
+
+        entity_ids = list(Candidate.objects.values_list('entity_id', flat=True)\
+                                   .union(PAC.objects.values_list('entity_id', flat=True)))
+
+        for start in range(0, len(entity_ids), batch_size):
+            profiles = cls.profiles_for(entity_ids[start:start + batch_size])
+
+            cache.set_many({cls.profile_cache_key(entity_id, generation): profile \
+                                for entity_id, profile in profiles.items()},
+                           PROFILE_CACHE_TIMEOUT)
 
+        return len(entity_ids)
 
 class EntityType(models.Model):
     description = models.CharField(max_length=25)
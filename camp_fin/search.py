@@ -0,0 +1,466 @@
+from collections import OrderedDict
+
+from camp_fin.api_parts import CandidateSearchSerializer, PACSearchSerializer, \
+    TransactionSearchSerializer, LobbyistSearchSerializer, \
+    OrganizationSearchSerializer, LobbyistTransactionSearchSerializer
+
+# Everything that shows up on the search page, in the order it shows up.
+#
+# `query` finds the rows for a table and decorates them for display. It gets
+# formatted with a `condition` on `alias`, which is a full text match on
+# search_name when searching a table directly, or a filter on the rows to
+# rebuild when making search documents.
+#
+# `vector` lists the text that the search document for each row is matched
+# against, as SQL expressions on the underlying `table` (aliased as `base`)
+# along with how much weight a match on each should carry when ranking.
+SEARCH_SOURCES = OrderedDict([
+    ('candidate', {
+        'table': 'camp_fin_candidate',
+        'alias': 'candidate',
+        'serializer': CandidateSearchSerializer,
+        'dated': False,
+        'vector': [
+            ('A', "concat_ws(' ', base.prefix, base.first_name, base.middle_name, base.last_name, base.suffix)"),
+        ],
+        'query': '''
+            SELECT * FROM (
+              SELECT DISTINCT ON (candidate.id)
+                candidate.*,
+                campaign.committee_name,
+                county.name AS county_name,
+                election.year AS election_year,
+                party.name AS party_name,
+                office.description AS office_name,
+                officetype.description AS office_type,
+                district.name AS district_name,
+                division.name AS division_name
+              FROM camp_fin_candidate AS candidate
+              JOIN camp_fin_campaign AS campaign
+                ON candidate.id = campaign.candidate_id
+              JOIN camp_fin_electionseason AS election
+                ON campaign.election_season_id = election.id
+              JOIN camp_fin_politicalparty AS party
+                ON campaign.political_party_id = party.id
+              LEFT JOIN camp_fin_county AS county
+                ON campaign.county_id = county.id
+              JOIN camp_fin_office AS office
+                ON campaign.office_id = office.id
+              JOIN camp_fin_officetype AS officetype
+                ON office.office_type_id = officetype.id
+              LEFT JOIN camp_fin_district AS district
+                ON campaign.district_id = district.id
+              LEFT JOIN camp_fin_division AS division
+                ON campaign.division_id = division.id
+              WHERE {condition}
+                AND campaign.date_added >= '2010-01-01'
+              ORDER BY candidate.id, election.year DESC
+            ) AS s
+        ''',
+    }),
+    ('pac', {
+        'table': 'camp_fin_pac',
+        'alias': 'pac',
+        'serializer': PACSearchSerializer,
+        'dated': False,
+        'vector': [
+            ('A', "COALESCE(base.name, '')"),
+        ],
+        'query': '''
+            SELECT * FROM (
+              SELECT DISTINCT ON (pac.id)
+                pac.*,
+                address.street || ' ' ||
+                address.city || ', ' ||
+                state.postal_code || ' ' ||
+                address.zipcode AS address
+             FROM camp_fin_pac AS pac
+             LEFT JOIN camp_fin_address AS address
+                ON pac.address_id = address.id
+             LEFT JOIN camp_fin_state AS state
+                ON address.state_id = state.id
+             JOIN camp_fin_filing AS filing
+                ON filing.entity_id = pac.entity_id
+             WHERE {condition}
+                AND filing.date_added >= '2010-01-01'
+             ORDER BY pac.id
+            ) AS s
+        ''',
+    }),
+    ('contribution', {
+        'table': 'camp_fin_transaction',
+        'alias': 'o',
+        'serializer': TransactionSearchSerializer,
+        'dated': True,
+        'vector': [
+            ('A', "COALESCE(NULLIF(TRIM(concat_ws(' ', base.company_name, base.name_prefix, base.first_name, "
+                  "base.middle_name, base.last_name, base.suffix)), ''), 'Anonymous')"),
+            ('C', "concat_ws(' ', base.address, base.city, base.state, base.zipcode)"),
+        ],
+        'query': '''
+            SELECT
+              o.*,
+              CASE WHEN o.occupation = 'None' THEN ''
+                   ELSE initcap(o.occupation)
+              END AS donor_occupation,
+              tt.description AS transaction_type,
+              CASE WHEN
+                pac.name IS NULL OR TRIM(pac.name) = ''
+              THEN
+                candidate.full_name
+              ELSE pac.name
+              END AS transaction_subject,
+              pac.slug AS pac_slug,
+              candidate.slug AS candidate_slug,
+              o.address || ' ' ||
+                o.city || ', ' ||
+                o.state || ' ' ||
+                o.zipcode AS full_address
+            FROM camp_fin_transaction AS o
+            JOIN camp_fin_transactiontype AS tt
+              ON o.transaction_type_id = tt.id
+            JOIN camp_fin_filing AS filing
+              ON o.filing_id = filing.id
+            JOIN camp_fin_entity AS entity
+              ON filing.entity_id = entity.id
+            LEFT JOIN camp_fin_pac AS pac
+              ON entity.id = pac.entity_id
+            LEFT JOIN camp_fin_candidate AS candidate
+              ON entity.id = candidate.entity_id
+            LEFT JOIN camp_fin_contact AS contact
+              ON o.contact_id = contact.id
+            LEFT JOIN camp_fin_address AS address
+              ON contact.address_id = address.id
+            LEFT JOIN camp_fin_state AS state
+              ON address.state_id = state.id
+            WHERE {condition}
+              AND tt.contribution = TRUE
+              AND o.received_date >= '2010-01-01'
+        ''',
+    }),
+    ('expenditure', {
+        'table': 'camp_fin_transaction',
+        'alias': 'o',
+        'serializer': TransactionSearchSerializer,
+        'dated': True,
+        'vector': [
+            ('A', "COALESCE(NULLIF(TRIM(concat_ws(' ', base.company_name, base.name_prefix, base.first_name, "
+                  "base.middle_name, base.last_name, base.suffix)), ''), 'Anonymous')"),
+            ('C', "concat_ws(' ', base.address, base.city, base.state, base.zipcode)"),
+        ],
+        'query': '''
+            SELECT
+              o.*,
+              tt.description AS transaction_type,
+              CASE WHEN
+                pac.name IS NULL OR TRIM(pac.name) = ''
+              THEN
+                candidate.full_name
+              ELSE pac.name
+              END AS transaction_subject,
+              pac.slug AS pac_slug,
+              candidate.slug AS candidate_slug
+            FROM camp_fin_transaction AS o
+            JOIN camp_fin_transactiontype AS tt
+              ON o.transaction_type_id = tt.id
+            JOIN camp_fin_filing AS filing
+              ON o.filing_id = filing.id
+            JOIN camp_fin_entity AS entity
+              ON filing.entity_id = entity.id
+            LEFT JOIN camp_fin_pac AS pac
+              ON entity.id = pac.entity_id
+            LEFT JOIN camp_fin_candidate AS candidate
+              ON entity.id = candidate.entity_id
+            WHERE {condition}
+              AND tt.contribution = FALSE
+              AND o.received_date >= '2010-01-01'
+        ''',
+    }),
+    ('lobbyist', {
+        'table': 'camp_fin_lobbyist',
+        'alias': 'lob',
+        'serializer': LobbyistSearchSerializer,
+        'dated': False,
+        'vector': [
+            ('A', "concat_ws(' ', base.first_name, base.middle_name, base.last_name, base.suffix)"),
+        ],
+        'query': '''
+            SELECT
+                lob.id,
+                lob.slug,
+                concat_ws(' ', lob.prefix, lob.first_name, lob.middle_name,
+                               lob.last_name, lob.suffix)
+                AS name
+            FROM camp_fin_lobbyist AS lob
+            WHERE {condition}
+        ''',
+    }),
+    ('organization', {
+        'table': 'camp_fin_organization',
+        'alias': 'org',
+        'serializer': OrganizationSearchSerializer,
+        'dated': False,
+        'vector': [
+            ('A', "COALESCE(base.name, '')"),
+        ],
+        'query': '''
+            SELECT
+                org.id,
+                org.name AS name,
+                org.slug AS slug,
+                CASE WHEN
+                    add.street IS NULL OR TRIM(add.street) = ''
+                THEN
+                    ''
+                ELSE
+                    add.street || ' ' ||
+                    add.city || ', ' ||
+                    state.postal_code || ' ' ||
+                    add.zipcode
+                END AS address
+            FROM camp_fin_organization AS org
+            JOIN camp_fin_address AS add
+              ON org.permanent_address_id = add.id
+            JOIN camp_fin_state AS state
+              ON add.state_id = state.id
+            WHERE {condition}
+        ''',
+    }),
+    ('lobbyisttransaction', {
+        'table': 'camp_fin_lobbyisttransaction',
+        'alias': 'trans',
+        'serializer': LobbyistTransactionSearchSerializer,
+        'dated': True,
+        'vector': [
+            ('A', "COALESCE(base.name, '')"),
+            ('B', "COALESCE(base.beneficiary, '')"),
+            ('C', "COALESCE(base.expenditure_purpose, '')"),
+        ],
+        'query': '''
+            SELECT
+              trans.id,
+              lobbyist.slug AS lobbyist_slug,
+              concat_ws(' ', lobbyist.prefix, lobbyist.first_name, lobbyist.middle_name,
+                             lobbyist.last_name, lobbyist.suffix) AS lobbyist_name,
+              trans.name,
+              trans.beneficiary,
+              trans.expenditure_purpose,
+              trans.received_date,
+              trans.amount,
+              trans.date_added,
+              tt.description AS transaction_type,
+              CASE WHEN tt.group_id = 2
+                THEN 'Political contribution'
+              ELSE 'Candidate'
+              END AS transaction_group
+            FROM camp_fin_lobbyisttransaction AS trans
+            JOIN camp_fin_lobbyisttransactiontype AS tt
+              ON trans.lobbyist_transaction_type_id = tt.id
+            JOIN camp_fin_lobbyistreport AS report
+              ON trans.lobbyist_report_id = report.id
+            JOIN camp_fin_lobbyist AS lobbyist
+              ON report.entity_id = lobbyist.entity_id
+            WHERE {condition}
+        ''',
+    }),
+])
+
+TRANSACTION_KINDS = ['contribution', 'expenditure']
+
+# Transactions show the name and slug of the candidate or PAC that filed them
+FILER_TRANSACTIONS = '''
+    SELECT t.id
+    FROM camp_fin_transaction AS t
+    JOIN camp_fin_filing AS f
+      ON t.filing_id = f.id
+    JOIN camp_fin_{filer} AS filer
+      ON f.entity_id = filer.entity_id
+    JOIN {{changed}} AS changed
+      ON filer.id = changed.id
+'''
+
+# Search documents that need rebuilding when rows in a table change, by the
+# kind of document and a query for their IDs given a table of the changed
+# IDs. Changes to the small lookup tables (offices, parties, states and so
+# on) aren't followed, so make_search_index has to run after those.
+SEARCH_DEPENDENCIES = {
+    'candidate': [
+        (['candidate'], 'SELECT id FROM {changed}'),
+        (TRANSACTION_KINDS, FILER_TRANSACTIONS.format(filer='candidate')),
+    ],
+    'pac': [
+        (['pac'], 'SELECT id FROM {changed}'),
+        (TRANSACTION_KINDS, FILER_TRANSACTIONS.format(filer='pac')),
+    ],
+    'campaign': [
+        (['candidate'], '''
+            SELECT c.candidate_id
+            FROM camp_fin_campaign AS c
+            JOIN {changed} AS changed
+              ON c.id = changed.id
+        '''),
+    ],
+    'filing': [
+        (['pac'], '''
+            SELECT p.id
+            FROM camp_fin_pac AS p
+            JOIN camp_fin_filing AS f
+              ON p.entity_id = f.entity_id
+            JOIN {changed} AS changed
+              ON f.id = changed.id
+        '''),
+        (TRANSACTION_KINDS, '''
+            SELECT t.id
+            FROM camp_fin_transaction AS t
+            JOIN {changed} AS changed
+              ON t.filing_id = changed.id
+        '''),
+    ],
+    'transaction': [
+        (TRANSACTION_KINDS, 'SELECT id FROM {changed}'),
+    ],
+    'address': [
+        (['pac'], '''
+            SELECT p.id
+            FROM camp_fin_pac AS p
+            JOIN {changed} AS changed
+              ON p.address_id = changed.id
+        '''),
+        (['organization'], '''
+            SELECT o.id
+            FROM camp_fin_organization AS o
+            JOIN {changed} AS changed
+              ON o.permanent_address_id = changed.id
+        '''),
+    ],
+    'lobbyist': [
+        (['lobbyist'], 'SELECT id FROM {changed}'),
+        (['lobbyisttransaction'], '''
+            SELECT t.id
+            FROM camp_fin_lobbyisttransaction AS t
+            JOIN camp_fin_lobbyistreport AS r
+              ON t.lobbyist_report_id = r.id
+            JOIN camp_fin_lobbyist AS l
+              ON r.entity_id = l.entity_id
+            JOIN {changed} AS changed
+              ON l.id = changed.id
+        '''),
+    ],
+    'lobbyistreport': [
+        (['lobbyisttransaction'], '''
+            SELECT t.id
+            FROM camp_fin_lobbyisttransaction AS t
+            JOIN {changed} AS changed
+              ON t.lobbyist_report_id = changed.id
+        '''),
+    ],
+    'organization': [
+        (['organization'], 'SELECT id FROM {changed}'),
+    ],
+    'lobbyisttransaction': [
+        (['lobbyisttransaction'], 'SELECT id FROM {changed}'),
+    ],
+}
+
+SEARCH_DOCUMENT_TABLE = '''
+    CREATE TABLE search_document (
+      kind VARCHAR NOT NULL,
+      object_id INTEGER NOT NULL,
+      payload JSONB NOT NULL,
+      search_vector TSVECTOR NOT NULL,
+      received_date TIMESTAMP WITH TIME ZONE,
+      amount DOUBLE PRECISION,
+      PRIMARY KEY (kind, object_id)
+    )
+'''
+
+SEARCH_DOCUMENT_INDEX = '''
+    CREATE INDEX search_document_vector_idx
+    ON search_document
+    USING gin(search_vector)
+'''
+
+
+def source_query(kind, condition):
+    '''
+    SQL for the decorated rows of one kind that meet a condition.
+    '''
+    source = SEARCH_SOURCES[kind]
+
+    return source['query'].format(condition=condition.format(alias=source['alias']))
+
+
+def insert_search_documents(kind, refresh_table=None):
+    '''
+    SQL that adds the search documents for a kind, either for every row or
+    just for the IDs listed for it in `refresh_table`. The payload holds
+    whichever of the fields that the search serializer for the kind puts out
+    the row has, so that showing a hit doesn't mean joining anything back
+    together. Timestamps in the payload come out in the session time zone,
+    so run this in UTC. They get a Z instead of +00:00, like the serializers
+    give them.
+    '''
+    source = SEARCH_SOURCES[kind]
+
+    if refresh_table:
+        condition = '''
+            {{alias}}.id IN (
+              SELECT object_id FROM {0} WHERE kind = '{1}'
+            )
+        '''.format(refresh_table, kind)
+    else:
+        condition = 'TRUE'
+
+    fields = ', '.join("'{}'".format(field) for field in source['serializer'].Meta.fields)
+
+    vector = ' || '.join("setweight(to_tsvector('english', {0}), '{1}')".format(text, weight) \
+                             for weight, text in source['vector'])
+
+    return '''
+        INSERT INTO search_document (
+          kind,
+          object_id,
+          payload,
+          search_vector,
+          received_date,
+          amount
+        )
+        SELECT
+          '{kind}',
+          s.id,
+          regexp_replace((
+            SELECT jsonb_object_agg(key, value)
+            FROM jsonb_each(to_jsonb(s))
+            WHERE key IN ({fields})
+          )::text, '"(\\d{{4}}-\\d\\d-\\d\\dT[\\d:.]+)\\+00:00"', '"\\1Z"', 'g')::jsonb,
+          {vector},
+          {received_date},
+          {amount}
+        FROM ({query}) AS s
+        JOIN {table} AS base
+          ON s.id = base.id
+    '''.format(kind=kind,
+               fields=fields,
+               vector=vector,
+               received_date='base.received_date' if source['dated'] else 'NULL',
+               amount='base.amount' if source['dated'] else 'NULL',
+               query=source_query(kind, condition),
+               table=source['table'])
+
+
+def build_search_documents(cursor):
+    '''
+    Make the search_document table from scratch, with a document for
+    everything that can be searched for. Run this inside of a transaction,
+    since it puts the session in UTC for the payloads.
+    '''
+    cursor.execute("SET LOCAL timezone TO 'UTC'")
+
+    cursor.execute('DROP TABLE IF EXISTS search_document')
+    cursor.execute(SEARCH_DOCUMENT_TABLE)
+
+    for kind in SEARCH_SOURCES:
+        cursor.execute(insert_search_documents(kind))
+
+    cursor.execute(SEARCH_DOCUMENT_INDEX)
+    cursor.execute('ANALYZE search_document')
@@ -1,5 +1,18 @@
+import csv
+import datetime
+import zipfile
+from io import BytesIO, TextIOWrapper
+from urllib.parse import urlencode
+
 from camp_fin.tests.conftest import DatabaseTestCase
 from django.urls import reverse
+from django.test import RequestFactory
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection, transaction, DataError
+
+from camp_fin.models import Race, Entity, Candidate, Campaign, Transaction, Filing
+from camp_fin.views import RacesView, CandidateDetail, SearchAPIView
 
 class TestRace(DatabaseTestCase):
     '''
@@ -10,6 +23,102 @@ class TestRace(DatabaseTestCase):
                                                  self.loan.amount +
                                                  self.second_contribution.amount))
 
+    def test_race_contribution_totals(self):
+        totals = Race.contribution_totals()
+        self.assertEqual(totals[self.race.id], self.race.sum_campaign_contributions())
+
+        totals = Race.contribution_totals([self.race.id])
+        self.assertEqual(list(totals.keys()), [self.race.id])
+
+    def test_race_campaign_funds(self):
+        race = Race.objects.prefetch_related('campaign_set').get(id=self.race.id)
+
+        Race.load_campaign_funds([race])
+
+        with self.assertNumQueries(0):
+            funds = race.campaign_funds()
+            race.sorted_campaigns
+            race.largest_contribution
+
+            for campaign in race.campaigns:
+                self.assertEqual(campaign.funds_raised(since=race.funding_period),
+                                 funds[campaign.id])
+
+        for campaign in self.campaigns:
+            self.assertEqual(funds[campaign.id],
+                             campaign.funds_raised(since=self.race.funding_period))
+
+    def test_race_with_totals(self):
+        race = Race.with_totals(Race.objects.filter(id=self.race.id)).get()
+
+        self.assertEqual(race.candidate_count, self.race.num_candidates)
+        self.assertEqual(race.funds_total, self.race.total_funds)
+
+        with self.assertNumQueries(0):
+            race.num_candidates
+            race.total_funds
+
+    def test_races_view_sql_ordering(self):
+        def make_race(total_contributions, candidates):
+            race = Race.objects.create(office=self.office,
+                                       office_type=self.office_type,
+                                       election_season=self.election_season,
+                                       total_contributions=total_contributions)
+
+            for i in range(candidates):
+                candidate = Candidate.objects.create(first_name='Ordering',
+                                                     last_name=str(i),
+                                                     entity=Entity.objects.create())
+
+                Campaign.objects.create(candidate=candidate,
+                                        active_race=race,
+                                        election_season=self.election_season,
+                                        office=self.office,
+                                        date_added=self.first_campaign.date_added,
+                                        political_party=self.first_campaign.political_party)
+
+            return race
+
+        # The fixture race has three candidates and raised less than the
+        # first of these, and the last two tie on both counts
+        richest = make_race(1000000.0, 1)
+        first_tied = make_race(1.0, 0)
+        second_tied = make_race(1.0, 0)
+
+        expected = {
+            'total_funds': [richest, self.race, second_tied, first_tied],
+            'num_candidates': [self.race, richest, second_tied, first_tied],
+        }
+
+        for order_by, races in expected.items():
+            for sort_order in ('desc', 'asc'):
+                view = RacesView()
+                view.request = RequestFactory().get('/races/', {'year': self.year,
+                                                                'type': self.office_type.id,
+                                                                'order_by': order_by,
+                                                                'sort_order': sort_order})
+
+                ordered = list(view.get_queryset())
+
+                if sort_order == 'asc':
+                    races = list(reversed(races))
+
+                self.assertEqual([race.id for race in ordered],
+                                 [race.id for race in races],
+                                 '{0} {1}'.format(order_by, sort_order))
+
+    def test_entity_trends_for(self):
+        entity_ids = [campaign.candidate.entity_id for campaign in self.campaigns]
+
+        with self.assertNumQueries(3):
+            trends = Entity.trends_for(entity_ids, since=self.last_year)
+
+        for entity_id in entity_ids:
+            entity = Entity.objects.get(id=entity_id)
+            self.assertEqual(trends[entity_id], entity.trends(since=self.last_year))
+
+        self.assertTrue(any(trend['donation_trend'] for trend in trends.values()))
+
     def test_race_sorted_campaigns(self):
         self.assertEqual(self.race.sorted_campaigns, self.campaigns)
 
@@ -61,3 +170,676 @@ class TestCampaign(DatabaseTestCase):
         self.assertEqual(self.first_campaign.share_of_funds(total=total), 70)
         self.assertEqual(self.second_campaign.share_of_funds(total=total), 30)
         self.assertEqual(self.third_campaign.share_of_funds(total=total), 0)
+
+
+class TestTransactionAggregates(DatabaseTestCase):
+    '''
+    Test that the incremental updates to the aggregate tables match a full
+    rebuild.
+    '''
+    def test_incremental_aggregates(self):
+        from camp_fin.management.commands.import_data import Command
+
+        command = Command()
+        command.configure({'force': False, 'shadow': False, 'tolerant': False})
+        command.connect()
+
+        command.entity_type = 'transaction'
+        command.django_table = 'camp_fin_transaction'
+
+        try:
+            command.makeDirtyTable()
+            command.makeChangeTable()
+            command.executeTransaction('INSERT INTO change_transaction VALUES (%s)',
+                                       self.first_contribution.id)
+            command.markDirtyRows('change')
+
+            # Move the contribution into a different bucket
+            self.first_contribution.amount = 500.0
+            self.first_contribution.received_date -= datetime.timedelta(days=60)
+            self.first_contribution.save()
+
+            command.markDirtyRows('change')
+            command.makeTransactionAggregates()
+
+            command.checkTransactionAggregates()
+
+            self.assertEqual(self.first_campaign.funds_raised(),
+                             self.first_contribution.amount + self.loan.amount)
+        finally:
+            command.executeTransaction('DROP TABLE IF EXISTS change_transaction')
+            command.connection.close()
+
+    def test_filing_changes_entity(self):
+        from camp_fin.management.commands.import_data import Command
+
+        command = Command()
+        command.configure({'force': False, 'shadow': False, 'tolerant': False})
+        command.connect()
+
+        command.entity_type = 'filing'
+
+        try:
+            command.makeTransactionAggregates(rebuild=True)
+
+            command.makeDirtyTable()
+            command.makeChangeTable()
+            command.executeTransaction('INSERT INTO change_filing VALUES (%s)',
+                                       self.first_filing.id)
+            command.markDirtyRows('change')
+
+            # Move the filing, along with its transactions, to another entity
+            Filing.objects.filter(id=self.first_filing.id)\
+                          .update(entity=self.fourth_entity)
+
+            command.markDirtyRows('change')
+            command.makeTransactionAggregates()
+
+            # Raises a CommandError if any of the groups are out of date
+            command.checkTransactionAggregates()
+
+            entities = [row.entity_id for row in command.connection.execute('''
+                SELECT DISTINCT entity_id FROM contributions_by_month
+            ''')]
+        finally:
+            command.executeTransaction('DROP TABLE IF EXISTS change_filing')
+            command.connection.close()
+
+        self.assertIn(self.fourth_entity.id, entities)
+        self.assertNotIn(self.first_entity.id, entities)
+
+
+class TestQuarantine(DatabaseTestCase):
+    '''
+    Test the checks that decide which raw rows get quarantined.
+    '''
+    def test_cast_check(self):
+        from camp_fin.management.commands.import_data import Command
+
+        values = ['12', ' -7 ', '2147483648', '9223372036854775808', '1.5',
+                  'NaN', '$1,234.56', '($99.10)', '$1,2,3', 'yes', 'Off', 'maybe',
+                  '1-Jan-10', '29-Feb-16', '29-Feb-17', '31-Apr-10',
+                  '2016-05-31 12:30:00', '2016-13-01', 'junk']
+
+        types = ['bigint', 'int', 'int::boolean', 'double precision',
+                 'money::numeric::double precision', 'boolean', 'date',
+                 'timestamp with time zone', 'numeric']
+
+        command = Command()
+        command.configure({'force': False, 'shadow': False, 'tolerant': False})
+        command.connect()
+
+        try:
+            command.makeCastCheckFunction()
+
+            for data_type in types:
+                for value in values:
+                    check = '''
+                        SELECT {0} AS castable
+                        FROM (SELECT %(value)s::TEXT AS value) AS s
+                    '''.format(command.castCheck('value', data_type))
+
+                    castable = command.connection.execute(check, value=value).first().castable
+
+                    with connection.cursor() as cursor:
+                        try:
+                            with transaction.atomic():
+                                cursor.execute('SELECT %s::{}'.format(data_type), [value])
+                            expected = True
+                        except DataError:
+                            expected = False
+
+                    self.assertEqual(castable, expected, (data_type, value))
+        finally:
+            command.connection.close()
+
+
+class TestShadowImport(DatabaseTestCase):
+    '''
+    Test swapping the tables built by a shadow import into the public schema.
+    '''
+    tables = ['camp_fin_transaction', 'camp_fin_candidate']
+
+    def schema_objects(self):
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT indexname
+                FROM pg_indexes
+                WHERE schemaname = 'public'
+                  AND tablename = ANY(%s)
+                ORDER BY indexname
+            ''', [self.tables])
+            indexes = [row[0] for row in cursor]
+
+            cursor.execute('''
+                SELECT conname
+                FROM pg_constraint AS con
+                JOIN pg_class AS src
+                  ON con.conrelid = src.oid
+                LEFT JOIN pg_class AS ref
+                  ON con.confrelid = ref.oid
+                WHERE src.relname = ANY(%s)
+                   OR ref.relname = ANY(%s)
+                ORDER BY conname
+            ''', [self.tables, self.tables])
+            constraints = [row[0] for row in cursor]
+
+        return indexes, constraints
+
+    def test_swap_shadow_schema(self):
+        from camp_fin.management.commands.import_data import Command, SHADOW_SCHEMA
+
+        indexes, constraints = self.schema_objects()
+        transactions = Transaction.objects.count()
+
+        self.assertIn('camp_fin_tx_received_id_idx', indexes)
+
+        command = Command()
+        command.configure({'force': False, 'shadow': True, 'tolerant': False})
+        command.connect()
+
+        try:
+            command.makeShadowSchema(['transaction', 'candidate'])
+            command.executeTransaction('''
+                CREATE TABLE {}.quarantine_transaction (id TEXT, reason TEXT)
+            '''.format(SHADOW_SCHEMA))
+
+            command.swapShadowSchema()
+        finally:
+            command.connection.close()
+
+        self.assertEqual(self.schema_objects(), (indexes, constraints))
+
+        with connection.cursor() as cursor:
+            # The story tables point at candidates
+            cursor.execute('''
+                SELECT convalidated
+                FROM pg_constraint
+                WHERE contype = 'f'
+                  AND confrelid = 'public.camp_fin_candidate'::regclass
+            ''')
+            self.assertEqual([row[0] for row in cursor], [True])
+
+            cursor.execute("SELECT to_regclass('public.quarantine_transaction')")
+            self.assertIsNone(cursor.fetchone()[0])
+
+        self.assertEqual(Transaction.objects.count(), transactions)
+
+
+class TestMakeRaces(DatabaseTestCase):
+    '''
+    Test grouping campaigns into races.
+    '''
+    def test_make_races(self):
+        from camp_fin.models import ElectionSeason
+
+        self.office_type.description = 'Statewide'
+        self.office_type.save()
+
+        special_election = ElectionSeason.objects.create(year=self.year,
+                                                         special=True,
+                                                         status=self.election_season.status)
+
+        self.non_race_campaign.election_season = special_election
+        self.non_race_campaign.race_status = None
+        self.non_race_campaign.save()
+
+        call_command('make_races')
+
+        # Statewide races are keyed on office and election season, so the
+        # existing race gets reused for everything but the special election
+        self.assertEqual(Race.objects.count(), 2)
+
+        for campaign in self.campaigns:
+            campaign.refresh_from_db()
+            self.assertEqual(campaign.active_race_id, self.race.id)
+
+        self.non_race_campaign.refresh_from_db()
+        self.assertNotEqual(self.non_race_campaign.active_race_id, self.race.id)
+        self.assertEqual(self.non_race_campaign.active_race.election_season, special_election)
+        self.assertEqual(self.non_race_campaign.race_status, 'active')
+
+        self.race.refresh_from_db()
+        self.assertEqual(self.race.total_contributions, self.race.sum_campaign_contributions())
+
+
+class TestEntityProfile(DatabaseTestCase):
+    '''
+    Test the cached financial profiles behind the candidate and committee
+    detail pages.
+    '''
+    def setUp(self):
+        super().setUp()
+        call_command('import_data', refresh_only='current_loan_status')
+        cache.clear()
+
+    def test_entity_profiles(self):
+        entity = self.first_entity
+
+        profile = Entity.profiles_for([entity.id])[entity.id]
+
+        trends = entity.trends(since=profile['since'])
+
+        for trend in ('balance_trend', 'debt_trend', 'donation_trend', 'expend_trend'):
+            self.assertEqual(profile[trend], trends[trend])
+
+        latest_filing = entity.filing_set\
+                              .filter(filing_period__exclude_from_cascading=False)\
+                              .exclude(final__isnull=True)\
+                              .order_by('-date_added').first()
+
+        self.assertEqual(profile['latest_filing'], latest_filing)
+
+    def test_warm_profiles(self):
+        self.assertEqual(Entity.warm_profiles(), Candidate.objects.count())
+
+        with self.assertNumQueries(0):
+            profile = Entity.profile_for(self.first_entity.id)
+
+        self.assertEqual(profile, Entity.profiles_for([self.first_entity.id])[self.first_entity.id])
+
+    def test_refresh_moves_generation(self):
+        generation = Entity.etl_generation(refresh=True)
+        key = Entity.profile_cache_key(self.first_entity.id, generation)
+
+        Entity.warm_profiles()
+        self.assertIsNotNone(cache.get(key))
+
+        call_command('import_data', refresh_only='current_loan_status')
+
+        # Profiles from before the refresh don't get used anymore, and the
+        # ones for the new generation are already there
+        new_generation = Entity.etl_generation()
+
+        self.assertGreater(new_generation, generation)
+        self.assertIsNotNone(cache.get(Entity.profile_cache_key(self.first_entity.id,
+                                                                new_generation)))
+
+    def test_no_warming_without_new_data(self):
+        from camp_fin.management.commands.import_data import Command
+
+        command = Command()
+        command.warmProfiles(Entity.etl_generation(refresh=True))
+
+        key = Entity.profile_cache_key(self.first_entity.id, Entity.etl_generation())
+
+        self.assertIsNone(cache.get(key))
+
+    def test_candidate_detail_profile(self):
+        Entity.warm_profiles()
+
+        view = CandidateDetail()
+        view.request = RequestFactory().get('/candidates/first-candidate/')
+        view.object = self.first_candidate
+
+        # Only the candidate's latest campaign comes from the database
+        with self.assertNumQueries(1):
+            context = view.get_context_data(object=self.first_candidate)
+
+        profile = Entity.profile_for(self.first_entity.id)
+
+        self.assertEqual(context['donation_trend'], profile['donation_trend'])
+        self.assertEqual(context['loans'], profile['loans'])
+
+
+class TestSearchAPI(DatabaseTestCase):
+    '''
+    Test paging through search results in SQL.
+    '''
+    def setUp(self):
+        super().setUp()
+        call_command('make_search_index')
+
+    def search(self, **params):
+        params.update({'term': 'candidate', 'table_name': 'candidate'})
+
+        response = self.client.get('/api/search/', params)
+        self.assertEqual(response.status_code, 200)
+
+        return response.json()['candidate']
+
+    def test_search_pagination(self):
+        everything = self.search()
+
+        self.assertEqual(everything['meta']['total_rows'], 4)
+        self.assertFalse(everything['meta']['count_estimated'])
+
+        page = self.search(length=2, start=1, **{'order[0][column]': 0,
+                                                 'columns[0][data]': 'id',
+                                                 'order[0][dir]': 'desc'})
+
+        ids = sorted([c['id'] for c in everything['objects']], reverse=True)
+
+        self.assertEqual([c['id'] for c in page['objects']], ids[1:3])
+        self.assertEqual(page['meta']['recordsTotal'], 4)
+
+    def test_search_count_cap(self):
+        count_cap = SearchAPIView.count_cap
+        SearchAPIView.count_cap = 2
+
+        try:
+            results = self.search(length=1)
+        finally:
+            SearchAPIView.count_cap = count_cap
+
+        self.assertTrue(results['meta']['count_estimated'])
+        self.assertGreaterEqual(results['meta']['total_rows'], 3)
+        self.assertEqual(len(results['objects']), 1)
+
+    def test_search_bad_order_column(self):
+        results = self.search(**{'order[0][column]': 0,
+                                 'columns[0][data]': 'id; DROP TABLE camp_fin_candidate',
+                                 'order[0][dir]': 'asc'})
+
+        self.assertEqual(results['meta']['total_rows'], 4)
+
+    def test_search_all_tables(self):
+        response = self.client.get('/api/search/', {'term': 'candidate'})
+        self.assertEqual(response.status_code, 200)
+
+        results = response.json()
+
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results['candidate']['meta']['total_rows'], 4)
+        self.assertFalse(any(table['meta']['partial'] for table in results.values()))
+
+    def test_search_table_timeout(self):
+        document_query = SearchAPIView.document_query
+        statement_timeout = SearchAPIView.statement_timeout
+
+        def slow_document_query(view, table):
+            query = document_query(view, table)
+
+            if table == 'candidate':
+                query = '''
+                    SELECT * FROM ({}) AS matches
+                    WHERE pg_sleep(1) IS NOT NULL
+                '''.format(query)
+
+            return query
+
+        SearchAPIView.document_query = slow_document_query
+        SearchAPIView.statement_timeout = 100
+
+        try:
+            response = self.client.get('/api/search/', {'term': 'candidate'})
+        finally:
+            SearchAPIView.document_query = document_query
+            SearchAPIView.statement_timeout = statement_timeout
+
+        self.assertEqual(response.status_code, 200)
+
+        results = response.json()
+
+        self.assertTrue(results['candidate']['meta']['partial'])
+        self.assertEqual(results['candidate']['objects'], [])
+
+        self.assertFalse(results['pac']['meta']['partial'])
+        self.assertFalse(results['lobbyist']['meta']['partial'])
+
+    def test_search_csv(self):
+        csv_batch_size = SearchAPIView.csv_batch_size
+        SearchAPIView.csv_batch_size = 1
+
+        try:
+            response = self.client.get('/api/search/', {
+                'term': 'candidate',
+                'table_name': ['candidate', 'lobbyist'],
+                'format': 'csv',
+                'order[0][column]': 0,
+                'columns[0][data]': 'id',
+                'order[0][dir]': 'desc',
+            })
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertIn('attachment', response['Content-Disposition'])
+
+            chunks = list(response.streaming_content)
+        finally:
+            SearchAPIView.csv_batch_size = csv_batch_size
+
+        self.assertGreater(len(chunks), 1)
+
+        # The last chunk carries the central directory, nothing trails it
+        self.assertTrue(chunks[-1])
+
+        archive = zipfile.ZipFile(BytesIO(b''.join(chunks)))
+
+        # Lobbyists don't get exported
+        self.assertEqual(archive.namelist(), ['candidate.csv'])
+        self.assertIsNone(archive.testzip())
+
+        with archive.open('candidate.csv') as f:
+            rows = list(csv.DictReader(TextIOWrapper(f, encoding='utf-8')))
+
+        ids = [int(row['id']) for row in rows]
+
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+
+class TestSearchDocuments(DatabaseTestCase):
+    '''
+    Test searching the search_document table and keeping it up to date.
+    '''
+    def setUp(self):
+        super().setUp()
+        call_command('make_search_index')
+
+    def search(self, term, table):
+        response = self.client.get('/api/search/', {'term': term, 'table_name': table})
+        self.assertEqual(response.status_code, 200)
+
+        return response.json()[table]['objects']
+
+    def test_search_ranking(self):
+        contribution = self.first_contribution
+
+        for field in ('address', 'company_name'):
+            Transaction.objects.create(amount=10.0,
+                                       received_date=contribution.received_date,
+                                       date_added=contribution.date_added,
+                                       transaction_type=contribution.transaction_type,
+                                       filing=contribution.filing,
+                                       **{field: 'Lumen'})
+
+        call_command('make_search_index')
+
+        results = self.search('lumen', 'contribution')
+
+        # A match on a name outranks a match on an address
+        self.assertEqual([r['company_name'] for r in results], ['Lumen', None])
+
+    def test_refresh_search_documents(self):
+        from camp_fin.management.commands.import_data import Command
+
+        Candidate.objects.filter(id=self.first_candidate.id)\
+                         .update(first_name='Zebulon', full_name='Zebulon Candidate')
+
+        self.assertEqual(self.search('zebulon', 'candidate'), [])
+
+        command = Command()
+        command.configure({'force': False, 'shadow': False, 'tolerant': False})
+        command.connect()
+
+        try:
+            command.executeTransaction('DROP TABLE IF EXISTS new_candidate')
+            command.executeTransaction('DROP TABLE IF EXISTS change_candidate')
+            command.executeTransaction('''
+                CREATE TABLE change_candidate AS
+                  SELECT id FROM camp_fin_candidate WHERE id = %s
+            ''', self.first_candidate.id)
+
+            count = command.refreshSearchDocuments(['candidate'])
+        finally:
+            command.executeTransaction('DROP TABLE IF EXISTS change_candidate')
+            command.connection.close()
+
+        # The candidate along with the contribution and the expenditure that
+        # they filed
+        self.assertEqual(count, 3)
+
+        candidates = self.search('zebulon', 'candidate')
+
+        self.assertEqual([c['id'] for c in candidates], [self.first_candidate.id])
+        self.assertEqual(candidates[0]['full_name'], 'Zebulon Candidate')
+
+        contributions = {c['id']: c for c in self.search('anonymous', 'contribution')}
+
+        self.assertEqual(contributions[self.first_contribution.id]['transaction_subject'],
+                         'Zebulon Candidate')
+
+
+    def test_import_fills_empty_documents(self):
+        from camp_fin.management.commands.import_data import Command
+
+        # Like a database that has been migrated, but never had
+        # make_search_index run on it
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE search_document')
+
+        self.assertEqual(self.search('candidate', 'candidate'), [])
+
+        command = Command()
+        command.configure({'force': False, 'shadow': False, 'tolerant': False})
+        command.connect()
+
+        try:
+            command.executeTransaction('DROP TABLE IF EXISTS new_candidate')
+            command.executeTransaction('DROP TABLE IF EXISTS change_candidate')
+            command.executeTransaction('''
+                CREATE TABLE new_candidate AS
+                  SELECT id FROM camp_fin_candidate
+            ''')
+
+            command.refreshSearchDocuments(['candidate'])
+        finally:
+            command.executeTransaction('DROP TABLE IF EXISTS new_candidate')
+            command.connection.close()
+
+        candidates = self.search('candidate', 'candidate')
+
+        self.assertEqual(len(candidates), Candidate.objects.count())
+
+
+class TestKeysetPagination(DatabaseTestCase):
+    '''
+    Test paging through transactions and search results with cursors.
+    '''
+    def setUp(self):
+        super().setUp()
+
+        received = self.first_contribution.received_date
+
+        # Two of these share a date, so the ID has to break the tie
+        for days in (1, 2, 2, 3, 5, 8):
+            Transaction.objects.create(amount=days * 10.0,
+                                       received_date=received - datetime.timedelta(days=days),
+                                       date_added=received,
+                                       last_name='Keyset',
+                                       transaction_type=self.first_contribution.transaction_type,
+                                       filing=self.first_filing)
+
+        call_command('make_search_index')
+
+        self.expected = list(Transaction.objects.filter(filing=self.first_filing,
+                                                        transaction_type__contribution=True)\
+                                                .order_by('-received_date', '-id')\
+                                                .values_list('id', flat=True))
+
+    def follow(self, url, params, get_page):
+        '''
+        Page through an endpoint until it runs out of next pages. `get_page`
+        takes a response and returns its objects and the URL of the next page.
+        '''
+        pages = []
+
+        response = self.client.get(url, params).json()
+
+        while True:
+            objects, next_link = get_page(response)
+            pages.append([o['id'] for o in objects])
+
+            if not next_link:
+                return pages
+
+            response = self.client.get(next_link).json()
+
+    def test_transaction_cursor_pagination(self):
+        url = '/api/contributions/'
+        params = {'candidate_id': self.first_candidate.id,
+                  'pagination': 'cursor',
+                  'limit': 3}
+
+        pages = self.follow(url, params, lambda r: (r['results'], r['next']))
+
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertTrue(all(len(page) == 3 for page in pages[:-1]))
+
+        first = self.client.get(url, params).json()
+        self.assertIsNone(first['previous'])
+
+        second = self.client.get(first['next']).json()
+        back = self.client.get(second['previous']).json()
+
+        self.assertEqual([o['id'] for o in back['results']], pages[0])
+
+        # Offsets still work for DataTables
+        offset = self.client.get(url, {'candidate_id': self.first_candidate.id,
+                                       'limit': 3,
+                                       'offset': 3}).json()
+
+        self.assertEqual(offset['count'], len(self.expected))
+        self.assertEqual([o['id'] for o in offset['results']], self.expected[3:6])
+
+    def test_transaction_cursor_by_amount(self):
+        params = {'candidate_id': self.first_candidate.id,
+                  'pagination': 'cursor',
+                  'ordering': 'amount',
+                  'limit': 2}
+
+        pages = self.follow('/api/contributions/', params, lambda r: (r['results'], r['next']))
+
+        expected = list(Transaction.objects.filter(id__in=self.expected)\
+                                           .order_by('amount', 'id')\
+                                           .values_list('id', flat=True))
+
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_loan_cursor_pagination(self):
+        for params in ({'pagination': 'cursor'}, {'offset': 0}):
+            params['candidate_id'] = self.first_candidate.id
+
+            response = self.client.get('/api/loans/', params)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['results'], [])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/contributions/', {'candidate_id': self.first_candidate.id,
+                                                           'cursor': 'nonsense'})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_cursor_pagination(self):
+        params = {'term': 'keyset',
+                  'table_name': 'contribution',
+                  'pagination': 'cursor',
+                  'length': 4}
+
+        def get_page(response):
+            table = response['contribution']
+            next_cursor = table['meta']['next']
+
+            if next_cursor:
+                return table['objects'], '/api/search/?' + urlencode(dict(params, cursor=next_cursor))
+
+            return table['objects'], None
+
+        pages = self.follow('/api/search/', params, get_page)
+
+        keyset_ids = [i for i in self.expected if i != self.first_contribution.id]
+
+        self.assertEqual(sum(pages, []), keyset_ids)
+        self.assertEqual([len(page) for page in pages], [4, 2])
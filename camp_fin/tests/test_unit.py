@@ -1,3 +1,13 @@
+import os
+import random
+import datetime
+from decimal import Decimal
+from collections import namedtuple
+
+import pytz
+from dateutil.rrule import rrule, MONTHLY
+
+from django.conf import settings
 from django.urls import resolve, reverse
 from django.test import TestCase
 from django.db.utils import IntegrityError
@@ -14,6 +24,7 @@ from camp_fin.models import (Race, Campaign, Filing, Division,
 from camp_fin.views import (RacesView, RaceDetail, LobbyistList, LobbyistDetail,
                             LobbyistTransactionList)
 from camp_fin.base_views import TransactionDownloadViewSet
+from camp_fin.models import monthly_trends
 from camp_fin.decorators import check_date_params
 from camp_fin.templatetags.helpers import format_years
 from camp_fin.tests.conftest import StatelessTestCase, DatabaseTestCase
@@ -210,6 +221,73 @@ class TestAdmin(StatelessTestCase):
         self.assertEqual(len(empty_table), 1)
 
 
+def legacy_monthly_trends(since, end_month, contributions, expenditures):
+    '''
+    The loop that Entity.trends used to build its monthly series with, kept
+    to check the vectorized version against.
+    '''
+    def stack_trends(trend):
+        stacked_trend = []
+        for begin, end, rate in trend:
+            if not stacked_trend:
+                stacked_trend.append((rate, begin))
+                stacked_trend.append((rate, end))
+
+            elif begin == stacked_trend[-1][1]:
+                stacked_trend.append((rate, begin))
+                stacked_trend.append((rate, end))
+
+            elif begin > stacked_trend[-1][1]:
+                previous_rate, previous_end = stacked_trend[-1]
+                stacked_trend.append((previous_rate, begin))
+                stacked_trend.append((rate, begin))
+                stacked_trend.append((rate, end))
+
+            elif begin < stacked_trend[-1][1]:
+                previous_rate, previous_end = stacked_trend.pop()
+                stacked_trend.append((previous_rate, begin))
+                stacked_trend.append((rate + previous_rate, begin))
+
+                if end < previous_end:
+                    stacked_trend.append((rate + previous_rate, end))
+                    stacked_trend.append((previous_rate, end))
+                    stacked_trend.append((previous_rate, previous_end))
+
+                elif end > previous_end:
+                    stacked_trend.append((rate + previous_rate, previous_end))
+                    stacked_trend.append((rate, previous_end))
+                    stacked_trend.append((rate, end))
+                else:
+                    stacked_trend.append((rate + previous_rate, end))
+
+        return [[rate, *date] for rate, date in stacked_trend]
+
+    contributions_lookup = {r.month.date(): r.amount for r in contributions}
+    expenditures_lookup = {r.month.date(): r.amount for r in expenditures}
+
+    donation_trend, expend_trend = [], []
+
+    for month in rrule(freq=MONTHLY, dtstart=datetime.datetime(int(since), 1, 1), until=end_month):
+        replacements = {'month': month.month - 1}
+
+        if replacements['month'] < 1:
+            replacements['month'] = 12
+            replacements['year'] = month.year - 1
+
+        begin_date = month.replace(**replacements)
+
+        begin_date_array = [begin_date.year, begin_date.month, begin_date.day]
+        end_date_array = [month.year, month.month, month.day]
+
+        contribution_amount = contributions_lookup.get(month.date(), 0)
+        expenditure_amount = expenditures_lookup.get(month.date(), 0)
+
+        donation_trend.append([begin_date_array, end_date_array, contribution_amount])
+        expend_trend.append([begin_date_array, end_date_array, (-1 * expenditure_amount)])
+
+    return stack_trends(donation_trend), stack_trends(expend_trend)
+
+
 class TestUtils(TestCase):
     '''
     Test utility methods.
@@ -241,6 +319,95 @@ class TestUtils(TestCase):
                               '2012 - 2013, 2015 - 2017, 2019')
         assert (format_years(['2019', '2018', '2018', '2017']) == '2017 - 2019')
 
+    def test_monthly_trends(self):
+        amount = namedtuple('Amount', ['amount', 'month'])
+
+        def random_amounts(since, end_month):
+            rows = []
+            months = (end_month.year - int(since) + 2) * 12
+
+            for i in random.sample(range(months), random.randint(0, months)):
+                year, month = int(since) + i // 12, i % 12 + 1
+
+                # Mostly the first of the month, like the aggregates, but
+                # now and then a day that the old lookup would have missed
+                day = 1 if random.random() > 0.1 else random.randint(2, 28)
+
+                value = random.choice([round(random.uniform(-500, 5000), 2),
+                                       0.0,
+                                       random.randint(0, 1000),
+                                       Decimal('{:.2f}'.format(random.uniform(0, 5000)))])
+
+                rows.append(amount(value, datetime.datetime(year, month, day, tzinfo=pytz.utc)))
+
+            return rows
+
+        random.seed(20180101)
+
+        for trial in range(200):
+            since = str(random.randint(2005, 2020))
+            end_month = datetime.date(int(since), 1, 1) + \
+                datetime.timedelta(days=random.randint(-60, 365 * 6))
+
+            contributions = random_amounts(since, end_month)
+            expenditures = random_amounts(since, end_month)
+
+            expected = legacy_monthly_trends(since, end_month, contributions, expenditures)
+            actual = monthly_trends(since, end_month, contributions, expenditures)
+
+            assert repr(actual) == repr(expected)
+
+    def test_etl_critical_path(self):
+        # Import inside the test so that the ETL engine connects to the test
+        # database
+        from camp_fin.management.commands.import_data import build_etl_graph, critical_path
+
+        graph = build_etl_graph(['entity', 'candidate', 'pac', 'county'])
+
+        assert graph['pac'] == {'entity', 'candidate'}
+        assert graph['county'] == set()
+
+        durations = {'entity': 3, 'candidate': 1, 'pac': 2, 'county': 5}
+
+        assert critical_path(graph, durations) == (['entity', 'candidate', 'pac'], 6)
+
+    def test_xlsx_stream_dedupe(self):
+        from camp_fin.management.commands.import_data import (dedupe_rows, csv_chunks,
+                                                              IterStream, BITMAP_MAX_PK)
+
+        rows = [(1, 'a'), (2, 'b'), (1, 'c'), ('x', 'd'), ('x', 'e'),
+                (BITMAP_MAX_PK, 'f'), (BITMAP_MAX_PK, 'g'), (2, 'h')]
+
+        unique = list(dedupe_rows(rows, 0))
+
+        assert [r[1] for r in unique] == ['a', 'b', 'd', 'f']
+
+        stream = IterStream(csv_chunks(unique, chunk_size=4))
+
+        assert stream.read(5) == b'1,a\r\n'
+        assert stream.read() == '2,b\r\nx,d\r\n{},f\r\n'.format(BITMAP_MAX_PK).encode('utf-8')
+
+    def test_xlsx_rows_keep_first_row(self):
+        from openpyxl import load_workbook
+        from camp_fin.management.commands.import_data import xlsx_rows
+
+        path = os.path.join(settings.BASE_DIR, 'data', 'Cam_County.xlsx')
+
+        # Read-only sheets hand back the same generator every time `rows` is
+        # asked for, so the old converter stripped the header twice
+        wb = load_workbook(path, read_only=True)
+
+        try:
+            sheet = wb.worksheets[0]
+            assert sheet.rows is sheet.rows
+        finally:
+            wb.close()
+
+        rows = list(xlsx_rows(path, 'countyid'))
+
+        assert rows[0][:2] == ('CountyId', 'Description')
+        assert rows[1][:2] == (1, 'Bernalillo')
+
 class TestAPI(StatelessTestCase):
     '''
     Test API endpoints.
@@ -1,14 +1,17 @@
+import re
+import json
 import itertools
 from collections import namedtuple, OrderedDict
 from datetime import datetime, timedelta
 import time
 import csv
 from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
 
 from django.views.generic import ListView, TemplateView, DetailView
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.http import HttpResponseNotFound, HttpResponse, StreamingHttpResponse
-from django.db import transaction, connection, connections
+from django.db import transaction, connection, connections, OperationalError
 from django.db.models import Max, prefetch_related_objects
 from django.utils import timezone
 from django.core.urlresolvers import reverse_lazy
@@ -22,10 +25,12 @@ from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 
 from dateutil.rrule import rrule, MONTHLY
+from psycopg2 import errorcodes
 
 from rest_framework import serializers, viewsets, filters, generics, metadata, \
     renderers
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound
 
 from pages.models import Page
 
@@ -36,10 +41,10 @@ from .base_views import (PaginatedList, TransactionDetail, TransactionBaseViewSe
                          TopMoneyView, TopEarnersBase, PagesMixin, TransactionDownloadViewSet, \
                          Echo, iterate_cursor, LobbyistTransactionDownloadViewSet)
 from .api_parts import CandidateSerializer, PACSerializer, TransactionSerializer, \
-    TransactionSearchSerializer, CandidateSearchSerializer, PACSearchSerializer, \
     LoanTransactionSerializer, TreasurerSearchSerializer, DataTablesPagination, \
-    TransactionCSVRenderer, SearchCSVRenderer, LobbyistSearchSerializer, \
-    OrganizationSearchSerializer, LobbyistTransactionSearchSerializer
+    TransactionCSVRenderer, SearchCSVRenderer, wants_cursor, encode_cursor, \
+    decode_cursor, keyset_direction
+from .search import SEARCH_SOURCES, source_query
 from .templatetags.helpers import format_money, get_transaction_verb
 
 TWENTY_TEN = timezone.make_aware(datetime(2010, 1, 1))
@@ -282,10 +287,8 @@ class RacesView(PaginatedList):
 
         if self.sort_order == 'asc':
             ordering = ''
-            reverse = False
         else:
             ordering = '-'
-            reverse = True
 
         queryset = Race.objects.filter(election_season__year=self.year)
 
@@ -299,30 +302,33 @@ class RacesView(PaginatedList):
                            .prefetch_related('campaign_set__candidate')\
                            .prefetch_related('campaign_set__candidate__entity')
 
-        # Distinguish between columns that can be ordered in SQL, and columns
-        # that need to be ordered in Python
-        db_order = ('office', 'county__name', 'district__name', 'division__name')
-        py_order = ('num_candidates', 'total_funds')
-
-        if self.order_by in db_order:
-            # For columns that correspond directly to DB attributes, sort the
-            # Queryset in SQL
-            ordering += self.order_by
+        # Map columns to the names they're sorted by in SQL. Candidate counts
+        # and funds are annotated onto the queryset so that sorting and
+        # pagination can both happen in the database.
+        db_order = {
+            'office': 'office',
+            'county__name': 'county__name',
+            'district__name': 'district__name',
+            'division__name': 'division__name',
+            'num_candidates': 'candidate_count',
+            'total_funds': 'funds_total',
+        }
 
-            queryset = queryset.order_by(ordering)
+        queryset = Race.with_totals(queryset)
 
-        elif self.order_by in py_order:
-            # For columns that correspond to properties on the Race model,
-            # sort the Queryset in Python (worse performance)
-            queryset = sorted(queryset,
-                              key=lambda race: getattr(race, self.order_by),
-                              reverse=reverse)
+        if self.order_by in db_order:
+            # Break ties on the ID so that pages don't overlap
+            queryset = queryset.order_by(ordering + db_order[self.order_by],
+                                         ordering + 'id')
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
+        # Load funds for all of the campaigns on the page at once
+        Race.load_campaign_funds(context['object_list'])
+
         context['sort_order'] = self.sort_order
         context['toggle_order'] = 'desc'
         context['year'] = self.year
@@ -363,6 +369,7 @@ class RacesView(PaginatedList):
 class RaceDetail(DetailView):
     template_name = 'camp_fin/race-detail.html'
     model = Race
+    queryset = Race.objects.prefetch_related('campaign_set__candidate')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -373,13 +380,13 @@ class RaceDetail(DetailView):
         year = race.funding_period
 
         # Create a map of entity IDs and funding trends for each candidate
-        active_entities = [Entity.objects.get(id=camp.candidate.entity_id)
-                           for camp in race.active_campaigns]
-        context['active_trends'] = [entity.trends(since=year) for entity in active_entities]
+        active_entities = [camp.candidate.entity_id for camp in race.active_campaigns]
+        dropout_entities = [camp.candidate.entity_id for camp in race.sorted_dropouts]
+
+        trends = Entity.trends_for(active_entities + dropout_entities, since=year)
 
-        dropout_entities = [Entity.objects.get(id=camp.candidate.entity_id)
-                            for camp in race.sorted_dropouts]
-        context['dropout_trends'] = [entity.trends(since=year) for entity in dropout_entities]
+        context['active_trends'] = [trends[entity_id] for entity_id in active_entities]
+        context['dropout_trends'] = [trends[entity_id] for entity_id in dropout_entities]
 
         # Find max and min of contrib/expend
         context['max'], context['min'] = 0, 0
@@ -1074,52 +1081,18 @@ class CommitteeDetailBaseView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        entity_id = context['object'].entity_id
-        entity = Entity.objects.get(id=entity_id)
-
-        # Determine the date of the first contribution/expenditure
-        min_date_query = '''
-            WITH all_cash AS (
-                SELECT month
-                FROM contributions_by_month
-                WHERE entity_id = %s
-                UNION
-                SELECT month
-                FROM expenditures_by_month
-                WHERE entity_id = %s
-              )
-            SELECT COALESCE(MIN(all_cash.month::date), '2010-01-01'::date)
-            FROM all_cash
-        '''
-
-        with connection.cursor() as cursor:
-            cursor.execute(min_date_query, [entity.id, entity.id])
-            row = cursor.fetchone()
-
-        if row[0].year > 2010:
-            year = str(row[0].year)
-        else:
-            year = '2010'
+        # Trends, the latest filing and loans only change between imports,
+        # so they come from a cached profile
+        profile = Entity.profile_for(context['object'].entity_id)
+        context['profile'] = profile
 
-        trends = entity.trends(since=year)
-        context.update(trends)
+        for trend in ('balance_trend', 'debt_trend', 'donation_trend', 'expend_trend'):
+            context[trend] = profile[trend]
 
-        latest_filing = context['object'].entity.filing_set\
-                                                .filter(filing_period__exclude_from_cascading=False)\
-                                                .exclude(final__isnull=True)\
-                                                .order_by('-date_added').first()
+        context['latest_filing'] = profile['latest_filing']
 
-        context['latest_filing'] = latest_filing
-
-        if latest_filing:
-            total_loans = latest_filing.total_loans or 0
-            total_inkind = latest_filing.total_inkind or 0
-
-            # Count pure donations, if applicable
-            if total_loans > 0 or total_inkind > 0:
-                donations = latest_filing.total_contributions - (latest_filing.total_loans +
-                                                                latest_filing.total_inkind)
-                context['donations'] = donations
+        if profile['donations'] is not None:
+            context['donations'] = profile['donations']
 
         return context
 
@@ -1131,28 +1104,7 @@ class CandidateDetail(CommitteeDetailBaseView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        current_loans = '''
-            SELECT
-              loan.*,
-              status.*
-            FROM camp_fin_candidate AS c
-            JOIN camp_fin_filing AS f
-              USING(entity_id)
-            JOIN camp_fin_loan AS loan
-              ON f.id = loan.filing_id
-            JOIN current_loan_status AS status
-              ON loan.id = status.loan_id
-            WHERE c.id = %s
-        '''
-
-        cursor = connection.cursor()
-
-        cursor.execute(current_loans, [context['object'].id])
-
-        columns = [c[0] for c in cursor.description]
-        loan_tuple = namedtuple('Loans', columns)
-
-        context['loans'] = [loan_tuple(*r) for r in cursor]
+        context['loans'] = context['profile']['loans']
 
         latest_campaign = context['object'].campaign_set\
                                            .order_by('-election_season__year')\
@@ -1360,28 +1312,36 @@ class TopExpensesView(TopMoneyView):
 class LoanViewSet(TransactionBaseViewSet):
     queryset = LoanTransaction.objects.filter(transaction_date__gte=TWENTY_TEN)
     serializer_class = LoanTransactionSerializer
-
-SERIALIZER_LOOKUP = {
-    'candidate': CandidateSearchSerializer,
-    'pac': PACSearchSerializer,
-    'contribution': TransactionSearchSerializer,
-    'expenditure': TransactionSearchSerializer,
-    'lobbyist': LobbyistSearchSerializer,
-    'organization': OrganizationSearchSerializer,
-    'lobbyisttransaction': LobbyistTransactionSearchSerializer,
-}
+    ordering_fields = ('amount', 'transaction_date')
+    cursor_fields = ('transaction_date', 'amount')
 
 @method_decorator(never_cache, name='dispatch')
 class SearchAPIView(viewsets.ViewSet):
     renderer_classes = (renderers.JSONRenderer, SearchCSVRenderer)
 
+    # Count matches exactly up to this many, and estimate past it
+    count_cap = 10000
+
+    # Tables that ?pagination=cursor can page through, and the fields that
+    # they can be keyed on
+    cursor_tables = ('contribution', 'expenditure')
+    cursor_fields = ('received_date', 'amount')
+
+    # Rows to fetch from the database at a time when streaming CSVs
+    csv_batch_size = 2000
+
+    # How many tables to search at once, and how many milliseconds to wait
+    # for each one
+    search_workers = settings.SEARCH_WORKERS
+    statement_timeout = settings.SEARCH_STATEMENT_TIMEOUT
+
     def list(self, request):
 
         table_names = request.GET.getlist('table_name')
         term = request.GET.get('term')
         datatype = request.GET.get('datatype')
 
-        limit = request.GET.get('limit', 50)
+        limit = request.GET.get('limit', DataTablesPagination.default_limit)
         offset = request.GET.get('offset', 0)
 
         order_by_col = None
@@ -1402,6 +1362,24 @@ class SearchAPIView(viewsets.ViewSet):
         if not term:
             return Response({'error': 'term is required'}, status=400)
 
+        try:
+            limit, offset = int(limit), int(offset)
+        except ValueError:
+            return Response({'error': 'limit and offset must be integers'}, status=400)
+
+        if limit < 0:
+            # DataTables asks for -1 when it wants everything
+            limit = DataTablesPagination.default_limit
+
+        offset = max(offset, 0)
+
+        # Only sort on plain column names, since they go straight into SQL
+        if order_by_col and not re.match(r'^\w+$', order_by_col):
+            order_by_col = None
+
+        if sort_order.upper() not in ('ASC', 'DESC'):
+            sort_order = 'ASC'
+
         if not table_names:
             table_names = [
                 'candidate',
@@ -1413,243 +1391,340 @@ class SearchAPIView(viewsets.ViewSet):
                 'lobbyisttransaction',
             ]
 
+        if request.GET.get('format') == 'csv':
+            return self.stream_csv(table_names, term, order_by_col, sort_order)
+
+        args = (term, limit, offset, order_by_col, sort_order)
+
+        if len(table_names) > 1 and self.search_workers > 1:
+            return Response(self.search_concurrently(table_names, *args))
+
         response = {}
 
         for table in table_names:
+            response[table] = self.search_table(table, *args)
 
-            if table == 'pac':
-                query = '''
-                    SELECT * FROM (
-                      SELECT DISTINCT ON (pac.id)
-                        pac.*,
-                        address.street || ' ' ||
-                        address.city || ', ' ||
-                        state.postal_code || ' ' ||
-                        address.zipcode AS address
-                     FROM camp_fin_pac AS pac
-                     LEFT JOIN camp_fin_address AS address
-                        ON pac.address_id = address.id
-                     LEFT JOIN camp_fin_state AS state
-                        ON address.state_id = state.id
-                     JOIN camp_fin_filing AS filing
-                        ON filing.entity_id = pac.entity_id
-                     WHERE pac.search_name @@ plainto_tsquery('english', %s)
-                        AND filing.date_added >= '2010-01-01'
-                     ORDER BY pac.id
-                    ) AS s
-                '''.format(table)
-
-            if table == 'candidate':
-                query = '''
-                    SELECT * FROM (
-                      SELECT DISTINCT ON (candidate.id)
-                        candidate.*,
-                        campaign.committee_name,
-                        county.name AS county_name,
-                        election.year AS election_year,
-                        party.name AS party_name,
-                        office.description AS office_name,
-                        officetype.description AS office_type,
-                        district.name AS district_name,
-                        division.name AS division_name
-                      FROM camp_fin_candidate AS candidate
-                      JOIN camp_fin_campaign AS campaign
-                        ON candidate.id = campaign.candidate_id
-                      JOIN camp_fin_electionseason AS election
-                        ON campaign.election_season_id = election.id
-                      JOIN camp_fin_politicalparty AS party
-                        ON campaign.political_party_id = party.id
-                      LEFT JOIN camp_fin_county AS county
-                        ON campaign.county_id = county.id
-                      JOIN camp_fin_office AS office
-                        ON campaign.office_id = office.id
-                      JOIN camp_fin_officetype AS officetype
-                        ON office.office_type_id = officetype.id
-                      LEFT JOIN camp_fin_district AS district
-                        ON campaign.district_id = district.id
-                      LEFT JOIN camp_fin_division AS division
-                        ON campaign.division_id = division.id
-                      WHERE candidate.search_name @@ plainto_tsquery('english', %s)
-                        AND campaign.date_added >= '2010-01-01'
-                      ORDER BY candidate.id, election.year DESC
-                    ) AS s
-                '''.format(table)
-
-            if table == 'contribution':
-                query = '''
-                    SELECT
-                      o.*,
-                      CASE WHEN o.occupation = 'None' THEN ''
-                           ELSE initcap(o.occupation)
-                      END AS donor_occupation,
-                      tt.description AS transaction_type,
-                      CASE WHEN
-                        pac.name IS NULL OR TRIM(pac.name) = ''
-                      THEN
-                        candidate.full_name
-                      ELSE pac.name
-                      END AS transaction_subject,
-                      pac.slug AS pac_slug,
-                      candidate.slug AS candidate_slug,
-                      o.address || ' ' ||
-                        o.city || ', ' ||
-                        o.state || ' ' ||
-                        o.zipcode AS full_address
-                    FROM camp_fin_transaction AS o
-                    JOIN camp_fin_transactiontype AS tt
-                      ON o.transaction_type_id = tt.id
-                    JOIN camp_fin_filing AS filing
-                      ON o.filing_id = filing.id
-                    JOIN camp_fin_entity AS entity
-                      ON filing.entity_id = entity.id
-                    LEFT JOIN camp_fin_pac AS pac
-                      ON entity.id = pac.entity_id
-                    LEFT JOIN camp_fin_candidate AS candidate
-                      ON entity.id = candidate.entity_id
-                    LEFT JOIN camp_fin_contact AS contact
-                      ON o.contact_id = contact.id
-                    LEFT JOIN camp_fin_address AS address
-                      ON contact.address_id = address.id
-                    LEFT JOIN camp_fin_state AS state
-                      ON address.state_id = state.id
-                    WHERE o.search_name @@ plainto_tsquery('english', %s)
-                      AND tt.contribution = TRUE
-                      AND o.received_date >= '2010-01-01'
-                '''
-
-            elif table == 'expenditure':
-                query = '''
-                    SELECT
-                      o.*,
-                      tt.description AS transaction_type,
-                      CASE WHEN
-                        pac.name IS NULL OR TRIM(pac.name) = ''
-                      THEN
-                        candidate.full_name
-                      ELSE pac.name
-                      END AS transaction_subject,
-                      pac.slug AS pac_slug,
-                      candidate.slug AS candidate_slug
-                    FROM camp_fin_transaction AS o
-                    JOIN camp_fin_transactiontype AS tt
-                      ON o.transaction_type_id = tt.id
-                    JOIN camp_fin_filing AS filing
-                      ON o.filing_id = filing.id
-                    JOIN camp_fin_entity AS entity
-                      ON filing.entity_id = entity.id
-                    LEFT JOIN camp_fin_pac AS pac
-                      ON entity.id = pac.entity_id
-                    LEFT JOIN camp_fin_candidate AS candidate
-                      ON entity.id = candidate.entity_id
-                    WHERE o.search_name @@ plainto_tsquery('english', %s)
-                      AND tt.contribution = FALSE
-                      AND o.received_date >= '2010-01-01'
-                '''
-
-            elif table == 'lobbyist':
-                query = '''
-                    SELECT
-                        lob.slug,
-                        concat_ws(' ', lob.prefix, lob.first_name, lob.middle_name,
-                                       lob.last_name, lob.suffix)
-                        AS name
-                    FROM camp_fin_lobbyist AS lob
-                    WHERE lob.search_name @@ plainto_tsquery('english', %s)
-                '''
-
-            elif table == 'organization':
-                query = '''
-                    SELECT
-                        org.name AS name,
-                        org.slug AS slug,
-                        CASE WHEN
-                            add.street IS NULL OR TRIM(add.street) = ''
-                        THEN
-                            ''
-                        ELSE
-                            add.street || ' ' ||
-                            add.city || ', ' ||
-                            state.postal_code || ' ' ||
-                            add.zipcode
-                        END AS address
-                    FROM camp_fin_organization AS org
-                    JOIN camp_fin_address AS add
-                      ON org.permanent_address_id = add.id
-                    JOIN camp_fin_state AS state
-                      ON add.state_id = state.id
-                    WHERE org.search_name @@ plainto_tsquery('english', %s)
-                '''
-
-            elif table == 'lobbyisttransaction':
-                query = '''
-                    SELECT
-                      lobbyist.slug AS lobbyist_slug,
-                      concat_ws(' ', lobbyist.prefix, lobbyist.first_name, lobbyist.middle_name,
-                                     lobbyist.last_name, lobbyist.suffix) AS lobbyist_name,
-                      trans.name,
-                      trans.beneficiary,
-                      trans.expenditure_purpose,
-                      trans.received_date,
-                      trans.amount,
-                      trans.date_added,
-                      tt.description AS transaction_type,
-                      CASE WHEN tt.group_id = 2
-                        THEN 'Political contribution'
-                      ELSE 'Candidate'
-                      END AS transaction_group
-                    FROM camp_fin_lobbyisttransaction AS trans
-                    JOIN camp_fin_lobbyisttransactiontype AS tt
-                      ON trans.lobbyist_transaction_type_id = tt.id
-                    JOIN camp_fin_lobbyistreport AS report
-                      ON trans.lobbyist_report_id = report.id
-                    JOIN camp_fin_lobbyist AS lobbyist
-                      ON report.entity_id = lobbyist.entity_id
-                    WHERE trans.search_name @@ plainto_tsquery('english', %s)
-                '''
-
-            if order_by_col:
-                query = '''
-                    {0} ORDER BY {1} {2}
-                '''.format(query, order_by_col, sort_order)
-
-            serializer = SERIALIZER_LOOKUP[table]
-
-            cursor = connection.cursor()
-            cursor.execute(query, [term])
+        return Response(response)
 
-            columns = [c[0] for c in cursor.description]
-            result_tuple = namedtuple(table, columns)
+    def search_table(self, table, term, limit, offset, order_by_col, sort_order):
+        '''
+        Count the matches in a table and fetch a page of them. Unless they're
+        sorted on something else, the best matches come first.
+        '''
+        query = self.document_query(table)
 
-            objects =  [result_tuple(*r) for r in cursor]
+        serializer = SEARCH_SOURCES[table]['serializer']
 
-            meta = OrderedDict()
+        cursor = connection.cursor()
+
+        meta = OrderedDict()
+
+        if wants_cursor(self.request) and table in self.cursor_tables:
+            count, estimated = self.count_matches(cursor, query, term)
+
+            page, next_cursor, previous_cursor = self.keyset_page(cursor,
+                                                                  table,
+                                                                  query,
+                                                                  term,
+                                                                  limit,
+                                                                  order_by_col,
+                                                                  sort_order)
+
+            meta = OrderedDict([
+                ('total_rows', count),
+                ('count_estimated', estimated),
+                ('limit', limit),
+                ('next', next_cursor),
+                ('previous', previous_cursor),
+            ])
+
+            objects = serializer([row.payload for row in page], many=True).data
 
-            if not request.GET.get('format') == 'csv':
-                paginator = DataTablesPagination()
+        else:
+            count, estimated = self.count_matches(cursor, query, term)
+
+            if order_by_col in ('id', 'received_date', 'amount'):
+                ordering = '{0} {1}, id'.format(order_by_col, sort_order)
+            elif order_by_col:
+                ordering = "payload -> '{0}' {1}, id".format(order_by_col, sort_order)
+            else:
+                ordering = 'rank DESC, id'
+
+            page_query = '''
+                SELECT payload FROM (
+                  {0}
+                ) AS matches
+                ORDER BY {1}
+                LIMIT %s
+                OFFSET %s
+            '''.format(query, ordering)
+
+            cursor.execute(page_query, [term, limit, offset])
+
+            objects = serializer([row[0] for row in cursor], many=True).data
+
+            draw = int(self.request.GET.get('draw', 0))
+
+            meta = OrderedDict([
+                ('total_rows', count),
+                ('count_estimated', estimated),
+                ('limit', limit),
+                ('offset', offset),
+                ('recordsTotal', count),
+                ('recordsFiltered', limit),
+                ('draw', draw),
+            ])
 
-                page = paginator.paginate_queryset(objects, self.request, view=self)
+        return OrderedDict([
+            ('meta', meta),
+            ('objects', objects),
+        ])
 
-                serializer = serializer(page, many=True)
+    def search_concurrently(self, table_names, *args):
+        '''
+        Search several tables at once, each on its own thread and database
+        connection, so that the search takes as long as the slowest table
+        rather than all of them added up.
+        '''
+        workers = min(self.search_workers, len(table_names))
 
-                objects = serializer.data
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = {table: pool.submit(self.search_table_with_timeout, table, *args) \
+                           for table in table_names}
 
-                draw = int(request.GET.get('draw', 0))
+        return {table: result.result() for table, result in results.items()}
 
-                meta = OrderedDict([
-                    ('total_rows', paginator.count),
+    def search_table_with_timeout(self, table, term, limit, offset, order_by_col, sort_order):
+        '''
+        Search a table, but give up on it once its queries run past
+        `statement_timeout` and hand back an empty result that's marked as
+        partial instead. Meant to run on its own thread, so it closes the
+        connection that Django opened for the thread when it's done.
+        '''
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL statement_timeout = %s',
+                                   [self.statement_timeout])
+
+                results = self.search_table(table,
+                                            term,
+                                            limit,
+                                            offset,
+                                            order_by_col,
+                                            sort_order)
+
+            results['meta']['partial'] = False
+
+        except OperationalError as e:
+            if getattr(e.__cause__, 'pgcode', None) != errorcodes.QUERY_CANCELED:
+                raise
+
+            results = OrderedDict([
+                ('meta', OrderedDict([
+                    ('total_rows', 0),
+                    ('count_estimated', False),
                     ('limit', limit),
                     ('offset', offset),
-                    ('recordsTotal', paginator.count),
-                    ('recordsFiltered', limit),
-                    ('draw', draw),
-                ])
-
-            response[table] = OrderedDict([
-                ('meta', meta),
-                ('objects', objects),
+                    ('partial', True),
+                ])),
+                ('objects', []),
             ])
 
-        return Response(response)
+        finally:
+            connection.close()
+
+        return results
+
+    def stream_csv(self, table_names, term, order_by_col, sort_order):
+        '''
+        Stream every match in a zip of CSVs. Each table is read through a
+        server-side cursor and written into the archive as its rows arrive,
+        so a broad search never has to fit in memory.
+        '''
+        renderer = SearchCSVRenderer()
+
+        def tables():
+            for table in renderer.table_names:
+
+                if table not in table_names:
+                    continue
+
+                query = self.search_query(table)
+
+                if order_by_col:
+                    query = '''
+                        SELECT * FROM (
+                          {0}
+                        ) AS matches
+                        ORDER BY {1} {2}
+                    '''.format(query, order_by_col, sort_order)
+
+                yield table, self.stream_rows(query, [term])
+
+        def archive():
+            # Outside of a transaction, Postgres has to copy every row that a
+            # server-side cursor will return before handing back the first one
+            with transaction.atomic():
+                yield from renderer.stream(tables(), batch_size=self.csv_batch_size)
+
+        return StreamingHttpResponse(archive(), content_type=renderer.media_type)
+
+    def stream_rows(self, query, params):
+        '''
+        Yield the header and then the rows of a query, fetching them from a
+        server-side cursor a batch at a time.
+        '''
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(query, params)
+
+            rows = cursor.fetchmany(self.csv_batch_size)
+
+            yield [c[0] for c in cursor.description]
+
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(self.csv_batch_size)
+
+    def search_query(self, table):
+        '''
+        SQL that finds the rows in a table that match a search term, which
+        it takes as its only parameter.
+        '''
+        return source_query(table, "{alias}.search_name @@ plainto_tsquery('english', %s)")
+
+    def document_query(self, table):
+        '''
+        SQL that finds the search documents of a kind that match a search
+        term, along with how well they match it.
+        '''
+        return '''
+            SELECT
+              doc.object_id AS id,
+              doc.received_date,
+              doc.amount,
+              doc.payload,
+              ts_rank(doc.search_vector, query) AS rank
+            FROM search_document AS doc,
+                 plainto_tsquery('english', %s) AS query
+            WHERE doc.kind = '{0}'
+              AND doc.search_vector @@ query
+        '''.format(table)
+
+    def keyset_page(self, cursor, table, query, term, limit, order_by_col, sort_order):
+        '''
+        Fetch a page of search results after (or before) the position in the
+        `cursor` parameter, keyed on a date or amount and the ID. A cursor
+        only applies to the table that it came from, so any other tables in
+        the same request start from the top. Returns the page and the cursors
+        for the pages on either side of it.
+        '''
+        token = self.request.GET.get('cursor')
+
+        position = decode_cursor(token) if token else None
+
+        if position and position.get('table') != table:
+            position = None
+
+        if position:
+            ordering = position.get('ordering', '')
+        elif order_by_col in self.cursor_fields:
+            ordering = order_by_col if sort_order.upper() == 'ASC' else '-' + order_by_col
+        else:
+            ordering = '-' + self.cursor_fields[0]
+
+        field = ordering.lstrip('-')
+
+        if field not in self.cursor_fields:
+            raise NotFound('Invalid cursor')
+
+        reverse = bool(position and position.get('reverse'))
+        comparison, order = keyset_direction(ordering.startswith('-'), reverse)
+
+        params = [term]
+        where = ''
+
+        if position:
+            try:
+                value, pk = position['value'], int(position['id'])
+                assert isinstance(value, (str, int, float))
+            except (KeyError, TypeError, ValueError, AssertionError):
+                raise NotFound('Invalid cursor')
+
+            where = 'WHERE (matches.{0}, matches.id) {1} (%s, %s)'.format(field, comparison)
+            params.extend([value, pk])
+
+        page_query = '''
+            SELECT * FROM (
+              {query}
+            ) AS matches
+            {where}
+            ORDER BY {field} {order}, id {order}
+            LIMIT %s
+        '''.format(query=query,
+                   where=where,
+                   field=field,
+                   order=order)
+
+        cursor.execute(page_query, params + [limit + 1])
+
+        columns = [c[0] for c in cursor.description]
+        result_tuple = namedtuple(table, columns)
+
+        page = [result_tuple(*r) for r in cursor]
+
+        more = len(page) > limit
+        page = page[:limit]
+
+        if reverse:
+            page.reverse()
+            has_next, has_previous = True, more
+        else:
+            has_next, has_previous = more, position is not None
+
+        def position_of(row, reverse=False):
+            return encode_cursor({
+                'table': table,
+                'ordering': ordering,
+                'value': getattr(row, field),
+                'id': row.id,
+                'reverse': reverse,
+            })
+
+        next_cursor = position_of(page[-1]) if page and has_next else None
+        previous_cursor = position_of(page[0], reverse=True) if page and has_previous else None
+
+        return page, next_cursor, previous_cursor
+
+    def count_matches(self, cursor, query, term):
+        '''
+        Count the rows that a search query matches, but stop counting at
+        `count_cap`. Past that, use the planner's estimate instead, since an
+        exact count of a common name can take longer than the search itself.
+        Returns the count and whether it's an estimate.
+        '''
+        count_query = '''
+            SELECT COUNT(*) FROM (
+              SELECT 1 FROM (
+                {0}
+              ) AS matches
+              LIMIT %s
+            ) AS capped
+        '''.format(query)
+
+        cursor.execute(count_query, [term, self.count_cap + 1])
+        count = cursor.fetchone()[0]
+
+        if count <= self.count_cap:
+            return count, False
+
+        cursor.execute('EXPLAIN (FORMAT JSON) {}'.format(query), [term])
+        plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return max(int(plan[0]['Plan']['Plan Rows']), count), True
 
     def finalize_response(self, request, response, *args, **kwargs):
         response = super().finalize_response(request, response, *args, **kwargs)
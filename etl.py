@@ -1,3 +1,4 @@
+import io
 import os
 import csv
 from nmid.database import Base, engine
@@ -30,7 +31,7 @@ def iterFile(path):
         yield from reader
 
 def rewriteKeys(row):
-    
+
     new_row = {}
     for key in row.keys():
         try:
@@ -40,52 +41,140 @@ def rewriteKeys(row):
 
     return new_row
 
-def makeNulls(row):
+def loadNameMap(table, id_col, name_cols):
+    '''
+    Map every name that's already in a table to its id, in one query.
+    '''
+    rows = '''
+        SELECT {id_col}, {name_cols}
+        FROM {table}
+    '''.format(id_col=id_col,
+               name_cols=', '.join(name_cols),
+               table=table)
+
+    return {tuple(row[c] for c in name_cols): row[id_col] \
+                for row in engine.execute(rows)}
+
+def insertNames(names, table, id_col, name_cols):
+    '''
+    Create all of the given names with a single multi-row insert and return
+    a map of the new names to their ids.
+    '''
+    values = []
+    params = {}
+
+    for i, name in enumerate(names):
+        values.append('({})'.format(', '.join([':{0}_{1}'.format(c, i) for c in name_cols])))
+        params.update({'{0}_{1}'.format(c, i): v for c, v in zip(name_cols, name)})
+
+    insert = '''
+        INSERT INTO {table} (
+          {name_cols}
+        ) VALUES {values}
+        ON CONFLICT DO NOTHING
+        RETURNING {id_col}, {name_cols}
+    '''.format(table=table,
+               name_cols=', '.join(name_cols),
+               values=', '.join(values),
+               id_col=id_col)
+
+    with engine.begin() as conn:
+        inserted = conn.execute(sa.text(insert), **params)
 
-    for k,v in row.items():
-        if row[k] == '':
-            row[k] = None
-    
-    return row
+        return {tuple(row[c] for c in name_cols): row[id_col] for row in inserted}
 
-def insertRows(rows, table_name):
+def copyRows(rows, table_name):
+    '''
+    Send rows to the database with COPY. They go through a temporary table
+    so that rows that are already there get skipped like they used to.
+    '''
     field_names = ', '.join(rows[0].keys())
-    param_names = ', '.join([':{}'.format(f) for f in rows[0].keys()])
-
-    insert = ''' 
-        INSERT INTO {table_name} (
-          {field_names}
-        ) VALUES (
-          {param_names}
-        )
-        ON CONFLICT DO NOTHING
-        RETURNING *
-    '''.format(field_names=field_names,
-               param_names=param_names,
-               table_name=table_name)
-    
-    with engine.begin() as conn:
-        inserted = conn.execute(sa.text(insert), *rows)
-    
-    return inserted
 
-def getRelation(table, **query_data):
-    where_clause = ' AND '.join(["{0} = :{0}".format(k) for k in \
-                                                            query_data.keys()])
+    f = io.StringIO()
+    writer = csv.writer(f)
 
-    rows = ''' 
-        SELECT * FROM {table}
-        WHERE {where_clause}
-    '''.format(table=table,
-               where_clause=where_clause)
-    
-    return engine.execute(sa.text(rows), **query_data).first()
+    # Empty strings come out of COPY as NULL
+    writer.writerows([row.values() for row in rows])
+    f.seek(0)
+
+    conn = engine.raw_connection()
+
+    try:
+        with conn.cursor() as curs:
+            curs.execute('''
+                CREATE TEMP TABLE copy_{0}
+                ON COMMIT DROP
+                AS SELECT {1} FROM {0} LIMIT 0
+            '''.format(table_name, field_names))
+
+            curs.copy_expert('''
+                COPY copy_{0} ({1}) FROM STDIN WITH CSV
+            '''.format(table_name, field_names), f)
+
+            curs.execute('''
+                INSERT INTO {0} ({1})
+                SELECT {1} FROM copy_{0}
+                ON CONFLICT DO NOTHING
+            '''.format(table_name, field_names))
+
+        conn.commit()
+    finally:
+        conn.close()
+
+def loadFiles(directory, table, id_col, name_fields, label):
+    '''
+    Load every file in a directory of transactions, creating the candidates
+    or PACs that they belong to along the way.
+
+    `name_fields` maps the columns in the table that identify a name to the
+    columns in the files that they come from.
+    '''
+    name_cols = list(name_fields.keys())
+    name_map = loadNameMap(table, id_col, name_cols)
+
+    inserted = 0
+
+    for file_name in os.listdir(directory):
+        file_path = os.path.join(directory, file_name)
+
+        rows = []
+        new_names = {}
+
+        for row in iterFile(file_path):
+            name = tuple(row[f] for f in name_fields.values())
+
+            if name not in name_map:
+                new_names[name] = True
+
+            rows.append((name, rewriteKeys(row)))
+
+        if new_names:
+            created = insertNames(list(new_names), table, id_col, name_cols)
+
+            # Someone else might have added a name since we looked
+            if len(created) < len(new_names):
+                created = loadNameMap(table, id_col, name_cols)
+
+            name_map.update(created)
+
+            print('Created', len(new_names), 'new', label, 'from', file_name)
+
+        if rows:
+            transactions = []
+
+            for name, row in rows:
+                row[id_col] = name_map[name]
+                transactions.append(row)
+
+            copyRows(transactions, 'transactions')
+            inserted += len(transactions)
+            print('Inserted', inserted, label, 'transactions')
 
 
 if __name__ == "__main__":
     import sys
     import nmid.models
-    
+
     try:
         if sys.argv[1] == 'init':
             Base.metadata.drop_all(bind=engine)
@@ -99,71 +188,14 @@ if __name__ == "__main__":
     candidates_dir = os.path.join(data_dir, 'candidates')
     pacs_dir = os.path.join(data_dir, 'pacs')
 
-    bulk_insert = []
-    inserted = 0
-
-    for candidate_file in os.listdir(candidates_dir):
-        file_path = os.path.join(candidates_dir, candidate_file)
-        
-        for row in iterFile(file_path):
-            
-            cand_dict = {
-                'first_name': row['First Name'],
-                'last_name': row['Last Name'],
-            }
-
-            candidate = getRelation('candidates', **cand_dict)
-            
-            if not candidate:
-                candidate = insertRows([cand_dict], 'candidates').first()
-                
-                print('Created new candidate', 
-                      candidate.first_name, 
-                      candidate.last_name)
-
-            row = rewriteKeys(row)
-            row = makeNulls(row)
-            row['candidate_id'] = candidate.candidate_id
-            bulk_insert.append(row)
-
-            if len(bulk_insert) % 10000 == 0:
-                insertRows(bulk_insert, 'transactions')
-                inserted += 10000
-                print('Inserted', inserted, 'candidate transactions')
-                bulk_insert = []
-    
-    if bulk_insert:
-        insertRows(bulk_insert, 'transactions')
-        inserted += len(bulk_insert)
-        print('Inserted', inserted, 'candidates')
-
-    bulk_insert = []
-    inserted = 0
-    
-    for pac_file in os.listdir(pacs_dir):
-        file_path = os.path.join(pacs_dir, pac_file)
-        
-        for row in iterFile(file_path):
-            pac_dict = {'name': row['PAC Name']}
-
-            pac = getRelation('pacs', **pac_dict)
-            
-            if not pac:
-                pac = insertRows([pac_dict], 'pacs').first()
-                print('Created new PAC', pac.name)
-
-            row = rewriteKeys(row)
-            row = makeNulls(row)
-            row['pac_id'] = pac.pac_id
-            bulk_insert.append(row)
-
-            if len(bulk_insert) % 10000 == 0:
-                insertRows(bulk_insert, 'transactions')
-                inserted += 10000
-                print('Inserted', inserted, 'pac transactions')
-                bulk_insert = []
-    
-    if bulk_insert:
-        insertRows(bulk_insert, 'transactions')
-        inserted += len(bulk_insert)
-        print('Inserted', inserted, 'pacs')
+    loadFiles(candidates_dir,
+              'candidates',
+              'candidate_id',
+              {'first_name': 'First Name', 'last_name': 'Last Name'},
+              'candidate')
+
+    loadFiles(pacs_dir,
+              'pacs',
+              'pac_id',
+              {'name': 'PAC Name'},
+              'pac')
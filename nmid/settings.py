@@ -146,3 +146,9 @@ SITE_META = {
 
 # Year to pull races from
 ELECTION_YEAR = '2018'
+
+# Searches across several tables run their queries this many at a time, each
+# on its own database connection. A table that takes longer than the timeout
+# (in milliseconds) is left out of the results and marked as partial.
+SEARCH_WORKERS = 4
+SEARCH_STATEMENT_TIMEOUT = 10000